@@ -0,0 +1,268 @@
+'''
+Benchmarks document generation for every version directory under src/version
+and for synthetic templates (see synthetic.py) at several scales.
+
+Each template is loaded once and a corpus of selection sets is generated with
+it: the selections used by the tests and random selection sets drawn from the
+values the template's annotations are compared to. The median time of each
+phase over the corpus and the peak memory (as traced by tracemalloc) of
+loading the template and of generating a document are saved as JSON.
+
+Compared against a baseline, any phase slower (or any peak larger) than the
+baseline by more than the tolerance is reported and the exit status is 1.
+
+    python benchmarks/run.py --output results.json --baseline benchmarks/baseline.json
+'''
+import argparse
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+SRC_DIR = SCRIPT_DIR.parent / 'src'
+sys.path[:0] = [str(SRC_DIR), str(SCRIPT_DIR)]
+
+from incremental import RenderSession
+from keep_mask import get_keep_mask_layout, render_document_xml
+from render_program import get_render_program, render_document_xml as run_program
+from mogrifier import MogrifyContext, mogrify_doc
+from preview import get_outline
+from template import INFO_BOX_SELECTION, Template, get_source_doc_path
+from synthetic import write_synthetic_version
+
+RESULTS_FORMAT = 1
+VERSION_DIR = SRC_DIR / 'version'
+SELECTIONS_PATH = SCRIPT_DIR.parent / 'tests' / 'static' / 'selections'
+BASELINE_PATH = SCRIPT_DIR / 'baseline.json'
+
+DEFAULT_SCALES = [1, 10, 100]
+DEFAULT_RANDOM_SETS = 8
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.25
+# differences below these are noise whatever the tolerance
+MIN_TIME_DELTA = 0.005
+MIN_MEMORY_DELTA = 1.0
+
+# probability that a random selection set leaves a selection out
+UNSET_PROBABILITY = 0.1
+
+PHASES = ['instantiate', 'mogrify', 'generate_doc', 'serialize', 'mask', 'program', 'preview']
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(description='Benchmarks sequence document generation')
+    parser.add_argument('--versions', nargs='*', help='Version directories to benchmark (default: all)')
+    parser.add_argument('--scales', nargs='*', type=int, default=DEFAULT_SCALES, help='Scales of the synthetic templates')
+    parser.add_argument('--random-sets', type=int, default=DEFAULT_RANDOM_SETS, help='Random selection sets per template')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='Times each selection set is generated')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the messages logged while generating')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the (slower) traced memory measurements')
+    parser.add_argument('--work-dir', help='Directory for the synthetic templates (default: a temporary directory)')
+    parser.add_argument('-o', '--output', help='Path to save the results to')
+    parser.add_argument('--baseline', help='Results to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed relative slowdown')
+    parser.add_argument('--update-baseline', action='store_true', help=f'Save the results as {BASELINE_PATH.name}')
+
+    return parser.parse_args(args)
+
+def get_version_dirs(names: Optional[List[str]] = None) -> List[Path]:
+    return sorted(
+        path for path in VERSION_DIR.iterdir()
+        if path.is_dir() and (not names or path.name in names)
+    )
+
+def get_random_selections(template: Template, rng: random.Random) -> Dict:
+    ''' A selection set for the selections template consults: one of the values
+        each selection is compared to, or a boolean for the others
+    '''
+    selections = {}
+    for name in sorted(template.references):
+        values = sorted(template.references[name])
+        if name != INFO_BOX_SELECTION and rng.random() < UNSET_PROBABILITY:
+            continue
+        selections[name] = [rng.choice(values)] if values else [rng.random() < 0.5]
+
+    return selections
+
+def get_corpus(template: Template, random_sets: int, seed: int) -> List[Dict]:
+    with open(SELECTIONS_PATH) as fh:
+        corpus = [json.load(fh)]
+
+    rng = random.Random(seed)
+    corpus.extend(get_random_selections(template, rng) for _ in range(random_sets))
+
+    return corpus
+
+def timed(function: Callable, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+def traced_peak(function: Callable, *args) -> float:
+    ''' Peak memory allocated while running function, in MB
+    '''
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / (1024 * 1024)
+
+def render_phases(template: Template, selections: Dict) -> Dict[str, float]:
+    times = {}
+    (document, scan), times['instantiate'] = timed(template.instantiate)
+    _, times['mogrify'] = timed(mogrify_doc, document, template.name_map, selections, MogrifyContext(scan))
+    times['generate_doc'] = times['instantiate'] + times['mogrify']
+    _, times['serialize'] = timed(template.serialize, document)
+    # the same document xml, written without a copy of the template (see keep_mask.py)
+    _, times['mask'] = timed(render_document_xml, template, selections)
+    _, times['program'] = timed(run_program, template, selections)
+
+    def preview():
+        session = RenderSession(template)
+        session.update(selections)
+        return list(get_outline(session))
+    _, times['preview'] = timed(preview)
+
+    return times
+
+def benchmark_template(path: Path, args) -> Dict:
+    template, load_time = timed(Template, path)
+    _, layout_time = timed(get_keep_mask_layout, template)
+    _, program_time = timed(get_render_program, template)
+    corpus = get_corpus(template, args.random_sets, args.seed)
+
+    times = {phase: [] for phase in PHASES}
+    for _ in range(args.repeat):
+        for selections in corpus:
+            for phase, seconds in render_phases(template, selections).items():
+                times[phase].append(seconds)
+
+    result = {
+        'annotations': len(template.annotations),
+        'selection_sets': len(corpus),
+        'time': {
+            'load': load_time,
+            'mask_layout': layout_time,
+            'compile_program': program_time,
+            **{phase: statistics.median(times[phase]) for phase in PHASES},
+        },
+    }
+    if not args.no_memory:
+        result['memory'] = {
+            'load': traced_peak(Template, path),
+            'render': traced_peak(lambda: template.serialize(template.render(corpus[0]))),
+            'render_mask': traced_peak(lambda: template.serialize_xml(render_document_xml(template, corpus[0]))),
+            'render_program': traced_peak(lambda: template.serialize_xml(run_program(template, corpus[0]))),
+        }
+
+    return result
+
+def run_benchmarks(args) -> Dict:
+    cases = {}
+
+    for path in get_version_dirs(args.versions):
+        name = f'version/{path.name}'
+        sys.stderr.write(f'Benchmarking {name}\n')
+        try:
+            get_source_doc_path(path)
+        except FileNotFoundError as e:
+            cases[name] = {'error': str(e)}
+            continue
+        cases[name] = benchmark_template(path, args)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(args.work_dir or temp_dir)
+        for scale in args.scales:
+            name = f'synthetic/x{scale}'
+            sys.stderr.write(f'Benchmarking {name}\n')
+            path = write_synthetic_version(work_dir / f'x{scale}', scale, args.seed)
+            cases[name] = benchmark_template(path, args)
+
+    return {
+        'format': RESULTS_FORMAT,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'cases': cases,
+    }
+
+def compare_results(results: Dict, baseline: Dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    ''' Descriptions of the measurements of results worse than in baseline by
+        more than tolerance (relative) and than the noise floor (absolute)
+    '''
+    regressions = []
+    for name, case in results['cases'].items():
+        base = baseline['cases'].get(name)
+        if base is None or 'error' in base:
+            continue
+        if 'error' in case:
+            regressions.append(f'{name}: {case["error"]}')
+            continue
+
+        for kind, unit, min_delta in (('time', 's', MIN_TIME_DELTA), ('memory', 'MB', MIN_MEMORY_DELTA)):
+            for measure, value in case.get(kind, {}).items():
+                base_value = base.get(kind, {}).get(measure)
+                if base_value is None:
+                    continue
+                if value > base_value * (1 + tolerance) and value - base_value > min_delta:
+                    regressions.append(
+                        f'{name} {kind} {measure}: {value:.4f}{unit} (baseline {base_value:.4f}{unit}, '
+                        f'{value / base_value - 1:+.0%})'
+                    )
+
+    return regressions
+
+def print_results(results: Dict, output=sys.stdout):
+    for name, case in results['cases'].items():
+        if 'error' in case:
+            output.write(f'{name}: skipped, {case["error"]}\n')
+            continue
+        times = ', '.join(f'{phase} {seconds * 1000:.1f}ms' for phase, seconds in case['time'].items())
+        output.write(f'{name} ({case["annotations"]} annotations): {times}\n')
+        if 'memory' in case:
+            memory = ', '.join(f'{measure} {mb:.1f}MB' for measure, mb in case['memory'].items())
+            output.write(f'{" " * len(name)}  peak memory: {memory}\n')
+
+def save_results(results: Dict, path):
+    with open(path, 'w') as fh:
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.write('\n')
+
+def main():
+    args = parse_args(sys.argv[1:])
+    # the random selection sets leave selections out on purpose, which the
+    # mogrifier reports for every annotation reading them
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    results = run_benchmarks(args)
+    print_results(results)
+
+    if args.output:
+        save_results(results, args.output)
+    if args.update_baseline:
+        save_results(results, BASELINE_PATH)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            sys.stderr.write('Regressions against {}:\n'.format(args.baseline))
+            for regression in regressions:
+                sys.stderr.write(f'  {regression}\n')
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
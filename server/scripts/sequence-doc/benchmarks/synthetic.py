@@ -0,0 +1,168 @@
+'''
+Synthetic version directories for benchmarking: a source docx and a mappings
+csv shaped like the real ones (nested annotated sections, info boxes, unit
+annotations and tables with row, column and table toggles), generated at any
+scale so generation time can be measured against template size.
+
+At scale n a template has n times the sections, tables and options of the
+scale 1 template and its sections nest n times as deep.
+'''
+import csv
+import random
+from pathlib import Path
+from typing import Dict, List
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from template import MAPPING_FILE_PATH, MAPPINGS_MODELICA_INSTANCE, MAPPINGS_MODELICA_VALUES, MAPPINGS_SHORT_ID, SOURCE_DOC_PATH
+
+ANNOTATION_STYLE = 'Toggle'
+INFO_BOX_STYLE = 'Info. box'
+INSTR_BOX_STYLE = 'Instr. box'
+
+# size of the scale 1 template
+BASE_SECTIONS = 60
+BASE_DEPTH = 3
+BASE_TABLES = 6
+BASE_OPTIONS = 40
+TABLE_ROWS = 8
+TABLE_COLUMNS = 4
+ENUM_VALUES = 4
+
+# a section in INFO_BOX_INTERVAL has an info box
+INFO_BOX_INTERVAL = 5
+UNITS_INTERVAL = 3
+
+LONG_NAME_PREFIX = 'Synthetic.Options.'
+VALUE_PREFIX = 'Synthetic.Values.'
+UNITS_NAME = 'Synthetic.Options.units'
+
+def get_scaled_size(scale: int) -> Dict[str, int]:
+    return {
+        'sections': BASE_SECTIONS * scale,
+        'depth': BASE_DEPTH * scale,
+        'tables': BASE_TABLES * scale,
+        'options': BASE_OPTIONS * scale,
+    }
+
+def get_options(count: int) -> Dict[str, List[str]]:
+    ''' Short names of the options, half of them booleans (no values) and half
+        enumerations, with the short names of their values
+    '''
+    options = {}
+    for index in range(count):
+        if index % 2:
+            options[f'mode{index}'] = [f'mode{index}_{value}' for value in range(ENUM_VALUES)]
+        else:
+            options[f'opt{index}'] = []
+
+    return options
+
+def write_mappings(path: Path, options: Dict[str, List[str]]):
+    with open(path, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, [MAPPINGS_SHORT_ID, MAPPINGS_MODELICA_INSTANCE, MAPPINGS_MODELICA_VALUES])
+        writer.writeheader()
+        writer.writerow({MAPPINGS_SHORT_ID: 'UNITS', MAPPINGS_MODELICA_INSTANCE: UNITS_NAME})
+        for system in ('SI', 'IP'):
+            writer.writerow({MAPPINGS_SHORT_ID: system, MAPPINGS_MODELICA_VALUES: VALUE_PREFIX + system})
+        for option, values in options.items():
+            writer.writerow({MAPPINGS_SHORT_ID: option, MAPPINGS_MODELICA_INSTANCE: LONG_NAME_PREFIX + option})
+            for value in values:
+                writer.writerow({MAPPINGS_SHORT_ID: value, MAPPINGS_MODELICA_VALUES: VALUE_PREFIX + value})
+
+def get_condition(rng: random.Random, options: Dict[str, List[str]], nesting: int = 1) -> str:
+    ''' Random condition, in the syntax of the annotations
+    '''
+    kind = rng.random()
+    if nesting and kind < 0.15:
+        op = rng.choice(['AND', 'OR'])
+        operands = ' '.join(f'[{get_condition(rng, options, nesting - 1)}]' for _ in range(2))
+        return f'{op} {operands}'
+
+    option = rng.choice(list(options))
+    values = options[option]
+    if not values:
+        return f"{rng.choice(['YES', 'NO'])} {option}"
+    if kind < 0.5:
+        return f'ANY {option} ' + ' '.join(rng.sample(values, 2))
+
+    return f"{rng.choice(['EQUALS', 'NOT_EQUALS'])} {option} {rng.choice(values)}"
+
+def add_toggle(paragraph, text: str):
+    paragraph.add_run(f'[{text}]', ANNOTATION_STYLE)
+
+def add_styles(document: Document, depth: int):
+    styles = document.styles
+    styles.add_style(ANNOTATION_STYLE, WD_STYLE_TYPE.CHARACTER)
+    styles.add_style(INFO_BOX_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    styles.add_style(INSTR_BOX_STYLE, WD_STYLE_TYPE.PARAGRAPH)
+    # the default template only has Heading 1 to Heading 9
+    names = {style.name for style in styles}
+    for level in range(1, depth + 1):
+        if f'Heading {level}' not in names:
+            styles.add_style(f'Heading {level}', WD_STYLE_TYPE.PARAGRAPH)
+
+def add_table(document: Document, rng: random.Random, options: Dict[str, List[str]]):
+    table = document.add_table(rows=TABLE_ROWS, cols=TABLE_COLUMNS)
+    header = table.rows[0].cells
+    add_toggle(header[0].paragraphs[0], f'TABLE [{get_condition(rng, options)}]')
+    header[0].paragraphs[0].add_run('Parameter')
+    add_toggle(header[TABLE_COLUMNS - 1].paragraphs[0], f'COLUMN [{get_condition(rng, options)}]')
+    header[TABLE_COLUMNS - 1].paragraphs[0].add_run('Optional')
+
+    for index, row in enumerate(table.rows[1:]):
+        cells = row.cells
+        add_toggle(cells[0].paragraphs[0], f'ROW [{get_condition(rng, options)}]')
+        cells[0].paragraphs[0].add_run(f'Row {index}')
+        for column, cell in enumerate(cells[1:], 1):
+            paragraph = cell.paragraphs[0]
+            if column == 1 and index % UNITS_INTERVAL == 0:
+                add_toggle(paragraph, f'UNITS [{index} m] [{index * 3} ft]')
+            else:
+                paragraph.add_run(f'Value {index}.{column}')
+
+def write_source_doc(path: Path, size: Dict[str, int], options: Dict[str, List[str]], seed: int):
+    rng = random.Random(seed)
+    document = Document()
+    add_styles(document, size['depth'])
+
+    # the sections are laid out as chains of nested sections, one chain per
+    # group, with the tables spread evenly between the chains
+    chains = max(1, size['sections'] // size['depth'])
+    tables_per_chain, extra_tables = divmod(size['tables'], chains)
+    section = 0
+
+    for chain in range(chains):
+        for level in range(1, size['depth'] + 1):
+            heading = document.add_paragraph(style=f'Heading {level}')
+            add_toggle(heading, get_condition(rng, options))
+            heading.add_run(f'Section {chain}.{level}')
+
+            body = document.add_paragraph()
+            add_toggle(body, get_condition(rng, options))
+            body.add_run(f'Requirements of section {chain}.{level}, ')
+            if section % UNITS_INTERVAL == 0:
+                add_toggle(body, f'UNITS [{section} °C] [{section * 2} °F]')
+            body.add_run(' as selected.')
+
+            if section % INFO_BOX_INTERVAL == 0:
+                document.add_paragraph(f'Information about section {chain}.{level}', INFO_BOX_STYLE)
+                document.add_paragraph(f'Instructions for section {chain}.{level}', INSTR_BOX_STYLE)
+            section += 1
+
+        for _ in range(tables_per_chain + (chain < extra_tables)):
+            add_table(document, rng, options)
+
+    document.save(path)
+
+def write_synthetic_version(directory, scale: int = 1, seed: int = 0) -> Path:
+    ''' Writes a version directory at the given scale in directory and returns its path
+    '''
+    path = Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    size = get_scaled_size(scale)
+    options = get_options(size['options'])
+
+    write_mappings(path / MAPPING_FILE_PATH, options)
+    write_source_doc(path / SOURCE_DOC_PATH, size, options, seed)
+
+    return path
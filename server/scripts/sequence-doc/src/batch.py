@@ -0,0 +1,158 @@
+'''
+Batch mode: renders many selection sets in one invocation. Templates are loaded
+once in the parent process and the documents are generated by a pool of forked
+workers that share the loaded templates.
+
+Selection sets are read from a JSON lines file (or stdin) or from a directory of
+.json files. A line is either a bare selections object or a job as accepted by
+the long-running mode (see serve.py), e.g. {"id": "ahu-1", "version": "...", "selections": {...}}
+
+One document is written per selection set to the output directory along with a
+manifest.jsonl recording the status, timing and error of each item. Documents
+are named after the job ids, reduced to safe file names and made unique; a job's
+own "output" must be inside the output directory. Items that aren't valid JSON
+objects (or whose "version" isn't a string) fail on their own with their line
+number (or file name) as id, and so do the items of a version that can't be
+loaded.
+'''
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Iterator, List
+from serve import run_job
+from template import get_template
+
+MANIFEST_FILE_NAME = 'manifest.jsonl'
+# characters allowed in the file names made from job ids
+UNSAFE_NAME_CHARACTERS = re.compile(r'[^\w.-]+')
+
+def read_jobs(source: str, version: str, defaults: dict = None) -> Iterator[dict]:
+    ''' Reads selection sets from a JSON lines file, a directory of .json files
+        or stdin ('-') and turns each into a job, with the fields of defaults
+        (e.g. "renderer") unless the item sets them. Items that can't be read
+        are turned into jobs holding an "error" instead.
+    '''
+    defaults = {'version': version, **(defaults or {})}
+    if source != '-' and os.path.isdir(source):
+        for path in sorted(Path(source).glob('*.json')):
+            with open(path) as fh:
+                yield to_job(fh.read(), path.stem, defaults)
+        return
+
+    input_stream = sys.stdin if source == '-' else open(source)
+    try:
+        for line_number, line in enumerate(input_stream, start=1):
+            line = line.strip()
+            if line:
+                yield to_job(line, str(line_number), defaults)
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+
+def to_job(text: str, default_id: str, defaults: dict) -> dict:
+    try:
+        item = json.loads(text)
+    except ValueError as e:
+        return {'id': default_id, 'error': f'Invalid job: {e}'}
+    if not isinstance(item, dict):
+        return {'id': default_id, 'error': f'Invalid job: expected a JSON object, got {type(item).__name__}'}
+
+    if 'selections' in item:
+        job = {'id': default_id, **defaults, **item}
+    else:
+        job = {'id': default_id, **defaults, 'selections': item}
+    if not isinstance(job['version'], str):
+        return {'id': job['id'], 'error': f'Invalid job: version must be a string, got {type(job["version"]).__name__}'}
+
+    return job
+
+def get_output_name(job_id) -> str:
+    ''' A file name made of job_id that can't leave the output directory
+    '''
+    name = UNSAFE_NAME_CHARACTERS.sub('_', str(job_id)).lstrip('.')
+    return name or 'job'
+
+def assign_outputs(jobs: List[dict], output_dir: str):
+    ''' Sets the output path of each job: a unique file named after its id,
+        or its own "output" if that is inside output_dir. Jobs with another
+        output are given an "error".
+    '''
+    root = Path(output_dir).resolve()
+    taken = set()
+
+    for job in jobs:
+        if 'error' in job or 'output' not in job:
+            continue
+        output = Path(root, job['output']).resolve()
+        if root not in output.parents:
+            job['error'] = f'Output "{job["output"]}" is outside of the output directory'
+        elif output in taken:
+            job['error'] = f'Output "{job["output"]}" is used by another job'
+        else:
+            job['output'] = str(output)
+            taken.add(output)
+
+    for job in jobs:
+        if 'error' in job or 'output' in job:
+            continue
+        name = get_output_name(job['id'])
+        output = root / f'{name}.docx'
+        suffix = 1
+        while output in taken:
+            suffix += 1
+            output = root / f'{name}-{suffix}.docx'
+        job['output'] = str(output)
+        taken.add(output)
+
+def run_batch(jobs: List[dict], output_dir: str, processes: int = None) -> List[dict]:
+    ''' Generates a document for each job into output_dir and returns the manifest
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    assign_outputs(jobs, output_dir)
+
+    # load each template in this process so forked workers inherit them, the
+    # items of a version that can't be loaded fail without being run
+    for version in {job['version'] for job in jobs if 'error' not in job}:
+        try:
+            get_template(version)
+        except Exception as e:
+            logging.exception('Unable to load version "%s"', version)
+            for job in jobs:
+                if 'error' not in job and job['version'] == version:
+                    job['error'] = f'Unable to load version "{version}": {type(e).__name__}: {e}'
+    runnable = [job for job in jobs if 'error' not in job]
+
+    processes = min(processes or os.cpu_count() or 1, len(runnable)) or 1
+    start = time.perf_counter()
+
+    if processes == 1:
+        responses = [run_job(job) for job in runnable]
+    else:
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+        with context.Pool(processes) as pool:
+            responses = pool.map(run_job, runnable, chunksize=1)
+
+    # in the order the jobs were read
+    responses = iter(responses)
+    manifest = [
+        {'id': job['id'], 'status': 'error', 'error': job['error']} if 'error' in job else next(responses)
+        for job in jobs
+    ]
+
+    with open(os.path.join(output_dir, MANIFEST_FILE_NAME), 'w') as fh:
+        for entry in manifest:
+            fh.write(json.dumps(entry) + '\n')
+
+    failed = sum(entry['status'] != 'ok' for entry in manifest)
+    logging.info(
+        'Generated %d documents (%d failed) in %.2fs with %d processes',
+        len(manifest) - failed, failed, time.perf_counter() - start, processes,
+    )
+
+    return manifest
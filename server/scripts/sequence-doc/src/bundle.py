@@ -0,0 +1,103 @@
+'''
+Compiled template bundles. Loading a version directory parses the source docx,
+scans it, compiles its annotations and indexes its sections: about a second of
+work repeated by every process loading the version. A bundle stores the result
+of that work (see template.Template.save_bundle) next to the version's files so
+other processes only have to map it into memory.
+
+Layout of a bundle:
+
+    MAGIC | header length (4 bytes, little endian) | header (JSON) | sections
+
+The header holds the bundle format, the digest of the version files the bundle
+was compiled from (see template.get_file_digest), the compile diagnostics and
+the offset and length of every section, relative to the end of the header.
+Sections are raw bytes: the source docx, kept as is so its members can be
+written out without copying, the serialized document part the template's render
+program (see render_program.py) slices, and the pickled template index and
+render program.
+
+Bundles are mapped read-only and shared, so the pages of processes loading the
+same bundle are shared too. Like .pyc files, bundles are trusted build output:
+only load them from the version directories they were compiled into.
+'''
+import json
+import mmap
+import os
+import struct
+import tempfile
+from pathlib import Path
+from typing import Dict, Tuple
+
+BUNDLE_FILE = 'template.bundle'
+MAGIC = b'SEQDOCB\x00'
+# bump when the layout or the pickled index changes
+BUNDLE_FORMAT = 3
+HEADER_LENGTH = struct.Struct('<I')
+
+class BundleError(Exception):
+    ''' The file is not a bundle of the current format
+    '''
+
+def write_bundle(path: Path, header: Dict, sections: Dict[str, bytes]):
+    ''' Writes sections with header (to which the format and section offsets
+        are added) atomically to path
+    '''
+    offsets = {}
+    offset = 0
+    for name, data in sections.items():
+        offsets[name] = [offset, len(data)]
+        offset += len(data)
+
+    encoded = json.dumps(
+        {**header, 'format': BUNDLE_FORMAT, 'sections': offsets},
+        sort_keys=True,
+    ).encode('utf-8')
+
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(HEADER_LENGTH.pack(len(encoded)))
+        fh.write(encoded)
+        for data in sections.values():
+            fh.write(data)
+    # readable by the workers like the version files, mkstemp creates it private
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+
+def read_header(data) -> Tuple[Dict, int]:
+    ''' The header of a bundle and the offset its sections start at
+    '''
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise BundleError('Not a template bundle')
+
+    start = len(MAGIC) + HEADER_LENGTH.size
+    (length,) = HEADER_LENGTH.unpack_from(data, len(MAGIC))
+    header = json.loads(bytes(data[start:start + length]))
+    if header.get('format') != BUNDLE_FORMAT:
+        raise BundleError(f'Bundle format {header.get("format")}, expected {BUNDLE_FORMAT}')
+
+    return header, start + length
+
+def map_bundle(path: Path) -> Tuple[Dict, Dict[str, memoryview]]:
+    ''' Maps a bundle into memory. Returns its header and a view of each of
+        its sections; the file stays mapped as long as a view is referenced.
+    '''
+    with open(path, 'rb') as fh:
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapped)
+    try:
+        header, start = read_header(view)
+    except (BundleError, ValueError, struct.error):
+        view.release()
+        mapped.close()
+        raise
+
+    sections = {
+        name: view[start + offset:start + offset + length]
+        for name, (offset, length) in header['sections'].items()
+    }
+
+    return header, sections
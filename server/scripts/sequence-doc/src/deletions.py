@@ -0,0 +1,47 @@
+'''
+The mogrifier passes only decide what to delete: removing elements right away
+would shift the positions and sections the following passes rely on. Deletions
+are recorded in a DeletionPlan and applied once all passes ran.
+'''
+from typing import List
+
+class DeletionPlan:
+    ''' Elements scheduled for removal. An element is recorded once however
+        often it is scheduled, and elements inside another scheduled element
+        are dropped when the plan is applied as removing the ancestor removes them.
+    '''
+    def __init__(self):
+        # dict rather than set to apply the removals in the order they were planned
+        self._elements = {}
+
+    def add(self, element):
+        self._elements[element] = None
+
+    def __contains__(self, element) -> bool:
+        return element in self._elements
+
+    def __len__(self) -> int:
+        return len(self._elements)
+
+    def roots(self) -> List:
+        ''' Scheduled elements without a scheduled ancestor
+        '''
+        elements = self._elements
+        return [
+            element for element in elements
+            if not any(ancestor in elements for ancestor in element.iterancestors())
+        ]
+
+    def apply(self) -> int:
+        ''' Removes the scheduled elements from their documents and returns the
+            number of elements removed (not counting their descendants)
+        '''
+        removed = 0
+        for element in self.roots():
+            parent = element.getparent()
+            if parent is not None:
+                parent.remove(element)
+                removed += 1
+
+        self._elements = {}
+        return removed
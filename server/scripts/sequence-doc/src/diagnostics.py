@@ -0,0 +1,70 @@
+'''
+Problems noticed while generating a document repeat: a selection missing from
+the store is reported by every annotation reading it, a short name missing from
+the mappings by every annotation naming it. Instead of logging each occurrence
+from the inner loops, messages are collected in a Diagnostics and logged once
+per run (or per template load), each distinct message with the number of times
+it was seen. Messages are only formatted when they are logged.
+
+How much gets logged is set with --log-level or the SEQUENCE_DOC_LOG_LEVEL
+environment variable.
+'''
+import logging
+import os
+from typing import Dict, Optional
+
+LOG_LEVEL_ENV = 'SEQUENCE_DOC_LOG_LEVEL'
+DEFAULT_LOG_LEVEL = 'WARNING'
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+class Diagnostics:
+    ''' Deduplicated log messages, keyed by level, message and arguments
+    '''
+    def __init__(self):
+        self._messages: Dict[tuple, int] = {}
+
+    def report(self, level: int, message: str, *args):
+        key = (level, message, args)
+        self._messages[key] = self._messages.get(key, 0) + 1
+
+    def error(self, message: str, *args):
+        self.report(logging.ERROR, message, *args)
+
+    def warning(self, message: str, *args):
+        self.report(logging.WARNING, message, *args)
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def counts(self) -> Dict[str, int]:
+        ''' Occurrences of each message (before formatting), e.g. how many
+            times any selection was found missing
+        '''
+        counts = {}
+        for (_, message, _), count in self._messages.items():
+            counts[message] = counts.get(message, 0) + count
+        return counts
+
+    def emit(self, logger: logging.Logger = None):
+        ''' Logs each distinct message once and forgets them
+        '''
+        logger = logger or logging.getLogger()
+        for (level, message, args), count in self._messages.items():
+            if count > 1:
+                logger.log(level, message + ' (seen %d times)', *args, count)
+            else:
+                logger.log(level, message, *args)
+
+        self._messages = {}
+
+def get_log_level(level: Optional[str] = None) -> str:
+    ''' level, else the level set in the environment, else the default
+    '''
+    level = (level or os.environ.get(LOG_LEVEL_ENV) or DEFAULT_LOG_LEVEL).upper()
+    if level not in LOG_LEVELS:
+        raise ValueError(f'Unknown log level "{level}"')
+    return level
+
+def configure_logging(level: Optional[str] = None):
+    logging.basicConfig()
+    logging.getLogger().setLevel(get_log_level(level))
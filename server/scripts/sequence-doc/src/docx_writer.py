@@ -0,0 +1,123 @@
+'''
+Writes generated documents without recompressing the parts that never change.
+Document.save serializes and deflates every part of the package, yet only the
+main document part (word/document.xml) differs from the source docx; the rest
+(styles, numbering, fonts and above all the media) is identical for every
+request. A SourcePackage keeps the compressed bytes of each member of the
+source docx and writes them out as is, compressing only the replaced members.
+'''
+import io
+import struct
+import zipfile
+import zlib
+from typing import BinaryIO, Dict, List, Tuple
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_RECORD = struct.Struct('<IHHHHIIH')
+END_RECORD_SIGNATURE = 0x06054b50
+
+# general purpose flag for utf-8 member names
+UTF8_FLAG = 0x800
+ZIP_VERSION = 20
+
+COMPRESSION_METHODS = {
+    'deflate': zipfile.ZIP_DEFLATED,
+    'store': zipfile.ZIP_STORED,
+}
+
+class Member:
+    ''' A zip member: its metadata and its (compressed) data
+    '''
+    def __init__(self, name: str, date_time: Tuple, method: int, crc: int, size: int, data: bytes):
+        self.name = name
+        self.date_time = date_time
+        self.method = method
+        self.crc = crc
+        self.size = size
+        self.data = data
+
+def compress_member(name: str, date_time: Tuple, content: bytes, method: int, level: int = None) -> Member:
+    if method == zipfile.ZIP_STORED:
+        data = content
+    else:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15)
+        data = compressor.compress(content) + compressor.flush()
+
+    return Member(name, date_time, method, zlib.crc32(content), len(content), data)
+
+def get_dos_date_time(date_time: Tuple) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    return (
+        (hour << 11) | (minute << 5) | (second // 2),
+        ((year - 1980) << 9) | (month << 5) | day,
+    )
+
+def write_zip(members: List[Member], output: BinaryIO):
+    ''' Writes members, whose data is already compressed, as a zip archive
+    '''
+    central_directory = []
+    offset = 0
+
+    for member in members:
+        name = member.name.encode('utf-8')
+        flags = 0 if member.name.isascii() else UTF8_FLAG
+        time, date = get_dos_date_time(member.date_time)
+        fields = (
+            ZIP_VERSION, flags, member.method, time, date,
+            member.crc, len(member.data), member.size, len(name),
+        )
+
+        output.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, *fields, 0))
+        output.write(name)
+        output.write(member.data)
+
+        central_directory.append(
+            CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, ZIP_VERSION, *fields, 0, 0, 0, 0, 0, offset)
+            + name
+        )
+        offset += LOCAL_HEADER.size + len(name) + len(member.data)
+
+    directory = b''.join(central_directory)
+    output.write(directory)
+    output.write(END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, len(members), len(members), len(directory), offset, 0))
+
+class SourcePackage:
+    ''' The members of a source docx with their compressed bytes, read once.
+        source is the path of the docx or its content, e.g. a memoryview of a
+        mapped bundle (see bundle.py) which the members' data then are views of.
+    '''
+    def __init__(self, source):
+        if not isinstance(source, (bytes, memoryview)):
+            with open(source, 'rb') as fh:
+                source = fh.read()
+
+        self.members: List[Member] = []
+        with zipfile.ZipFile(io.BytesIO(source)) as archive:
+            for info in archive.infolist():
+                header = LOCAL_HEADER.unpack_from(source, info.header_offset)
+                name_length, extra_length = header[-2:]
+                start = info.header_offset + LOCAL_HEADER.size + name_length + extra_length
+                self.members.append(Member(
+                    info.filename,
+                    info.date_time,
+                    info.compress_type,
+                    info.CRC,
+                    info.file_size,
+                    source[start:start + info.compress_size],
+                ))
+
+    def write(self, output: BinaryIO, replacements: Dict[str, bytes], method: int = zipfile.ZIP_DEFLATED, level: int = None):
+        ''' Writes the package with the content of the members named in
+            replacements replaced (compressed with method and level). All other
+            members are copied with their original compressed bytes.
+        '''
+        members = []
+        for member in self.members:
+            if member.name in replacements:
+                member = compress_member(member.name, member.date_time, replacements[member.name], method, level)
+            members.append(member)
+
+        write_zip(members, output)
@@ -0,0 +1,383 @@
+'''
+Annotations (the text styled as toggles in the source document) are compiled
+into expression trees. Short names are resolved through the name map at compile
+time, so evaluating an annotation against a set of selections is only a walk
+over the tree.
+
+    [AND [EQUALS AHU MZVAV] [OR [YES CO2] [YES OCC]]]
+
+compiles to
+
+    And((Equals(<AHU long name>, <MZVAV long name>), Or((Yes(<CO2 long name>), Yes(<OCC long name>)))))
+
+Evaluating a condition returns True if the annotated section should be deleted.
+'''
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Union
+from diagnostics import Diagnostics
+
+OP_LIST = ['AND', 'OR', 'YES', 'NO', 'EQUALS', 'NOT_EQUALS', 'ANY', 'DELETE']
+TABLE_OP_LIST = ['TABLE', 'ROW', 'COLUMN']
+UNITS_OP = 'UNITS'
+
+TOKEN_PATTERN = re.compile(r'\[|]|\w+')
+
+class Group:
+    ''' A bracketed part of an annotation: words and nested groups
+    '''
+    def __init__(self, start: int):
+        self.items = []
+        self.start = start
+        self.raw = ''
+        self.closed = False
+
+def parse_annotation(text: str) -> List[Union[str, Group]]:
+    ''' Splits annotation text into words and (arbitrarily nested) bracket groups.
+        Unbalanced brackets don't fail: unclosed groups end with the text and
+        unmatched closing brackets are ignored.
+    '''
+    top = Group(0)
+    stack = [top]
+
+    for match in TOKEN_PATTERN.finditer(text):
+        token = match.group()
+        if token == '[':
+            group = Group(match.end())
+            stack[-1].items.append(group)
+            stack.append(group)
+        elif token == ']':
+            if len(stack) > 1:
+                group = stack.pop()
+                group.raw = text[group.start:match.start()]
+                group.closed = True
+        else:
+            stack[-1].items.append(token)
+
+    for group in stack[1:]:
+        group.raw = text[group.start:]
+
+    return top.items
+
+def flatten_words(items: List[Union[str, Group]]) -> List[str]:
+    words = []
+    for item in items:
+        if isinstance(item, Group):
+            words.extend(flatten_words(item.items))
+        else:
+            words.append(item)
+
+    return words
+
+@dataclass(frozen=True)
+class Node:
+    ''' Base expression node
+    '''
+
+@dataclass(frozen=True)
+class Condition(Node):
+    ''' Node that decides whether to delete an annotated section
+    '''
+    def deletes(self, selections: 'SelectionSet') -> bool:
+        raise NotImplementedError
+
+@dataclass(frozen=True)
+class Constant(Condition):
+    ''' Condition already decided at compile time, e.g. for an invalid operation
+    '''
+    delete: bool
+
+    def deletes(self, selections):
+        return self.delete
+
+@dataclass(frozen=True)
+class Delete(Condition):
+    def deletes(self, selections):
+        return True
+
+@dataclass(frozen=True)
+class Yes(Condition):
+    name: str
+
+    def deletes(self, selections):
+        if self.name not in selections:
+            selections.diagnostics.error('Path "%s" not found in store, deleting', self.name)
+            return True
+        return not selections.is_set(self.name)
+
+@dataclass(frozen=True)
+class No(Condition):
+    name: str
+
+    def deletes(self, selections):
+        if self.name not in selections:
+            selections.diagnostics.error('Path "%s" not found in store, deleting', self.name)
+            return True
+        return selections.is_set(self.name)
+
+@dataclass(frozen=True)
+class Equals(Condition):
+    name: str
+    value: str
+
+    def deletes(self, selections):
+        if self.name not in selections:
+            selections.diagnostics.error('Path "%s" not found in store, deleting', self.name)
+            return True
+        return self.value not in selections.values(self.name)
+
+@dataclass(frozen=True)
+class NotEquals(Condition):
+    name: str
+    value: str
+
+    def deletes(self, selections):
+        if self.name not in selections:
+            selections.diagnostics.error('Path "%s" not found in store, keeping', self.name)
+            return False
+        return self.value in selections.values(self.name)
+
+@dataclass(frozen=True)
+class AnyOf(Condition):
+    name: str
+    values: frozenset
+
+    def deletes(self, selections):
+        if self.name not in selections:
+            selections.diagnostics.error('Path "%s" not found in store, deleting', self.name)
+            return True
+        return self.values.isdisjoint(selections.values(self.name))
+
+@dataclass(frozen=True)
+class And(Condition):
+    ''' Keeps the section only if every operand keeps it
+    '''
+    operands: tuple
+
+    def deletes(self, selections):
+        return any(selections.deletes(operand) for operand in self.operands)
+
+@dataclass(frozen=True)
+class Or(Condition):
+    ''' Keeps the section if any operand keeps it
+    '''
+    operands: tuple
+
+    def deletes(self, selections):
+        return all(selections.deletes(operand) for operand in self.operands)
+
+@dataclass(frozen=True)
+class TableToggle(Node):
+    ''' Applies a condition to the table, row or column holding the annotation
+    '''
+    target: str
+    condition: Condition
+
+@dataclass(frozen=True)
+class Units(Node):
+    ''' Text to use for each unit system
+    '''
+    si_text: str
+    ip_text: str
+
+def get_references(node: Optional[Node]) -> Dict[str, Set[str]]:
+    ''' Long names of the selections evaluating an expression reads, each with
+        the values it is compared to (empty for YES and NO)
+    '''
+    references = {}
+
+    def collect(node):
+        if isinstance(node, (And, Or)):
+            for operand in node.operands:
+                collect(operand)
+        elif isinstance(node, TableToggle):
+            collect(node.condition)
+        elif isinstance(node, (Yes, No)):
+            references.setdefault(node.name, set())
+        elif isinstance(node, (Equals, NotEquals)):
+            references.setdefault(node.name, set()).add(node.value)
+        elif isinstance(node, AnyOf):
+            references.setdefault(node.name, set()).update(node.values)
+
+    collect(node)
+
+    return references
+
+class SelectionSet:
+    ''' Selections prepared for evaluating expressions: selected values are turned
+        into frozensets on first use and condition results are memoized, so
+        identical (sub) expressions are only evaluated once per document
+    '''
+    def __init__(self, selections: Dict[str, List], diagnostics: Diagnostics = None):
+        self.selections = selections
+        # collects the selections found missing, see diagnostics.py
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        self._values = {}
+        self._is_set = {}
+        self._results = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.selections
+
+    def values(self, name: str):
+        values = self._values.get(name)
+        if values is None:
+            try:
+                values = frozenset(self.selections[name])
+            except TypeError:
+                # unhashable values, fall back to scanning
+                values = tuple(self.selections[name])
+            self._values[name] = values
+        return values
+
+    def is_set(self, name: str) -> bool:
+        is_set = self._is_set.get(name)
+        if is_set is None:
+            is_set = self._is_set[name] = any(self.selections[name])
+        return is_set
+
+    def deletes(self, condition: Condition) -> bool:
+        result = self._results.get(condition)
+        if result is None:
+            result = self._results[condition] = condition.deletes(self)
+        return result
+
+class AnnotationCompiler:
+    ''' Compiles annotation text against a name map. Compiled annotations are
+        cached by text and equal sub-expressions are shared between annotations.
+    '''
+    def __init__(self, name_map: Dict[str, str], diagnostics: Diagnostics = None):
+        self.name_map = name_map
+        self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+        # annotations that failed to compile and short names missing from the
+        # name map, reported to diagnostics when compiled
+        self.invalid_tags: Set[str] = set()
+        self.missing_names: Set[str] = set()
+        self._annotations = {}
+        self._nodes = {}
+
+    def compile(self, text: str) -> Optional[Node]:
+        ''' Returns None if text isn't an annotation operation
+        '''
+        if text not in self._annotations:
+            self._annotations[text] = self._compile_annotation(text)
+        return self._annotations[text]
+
+    def _intern(self, node: Node) -> Node:
+        return self._nodes.setdefault(node, node)
+
+    def _compile_annotation(self, text: str) -> Optional[Node]:
+        items = parse_annotation(text)
+        if items and isinstance(items[0], Group):
+            # words trailing the annotation's brackets count as arguments
+            items = items[0].items + [item for item in items[1:] if isinstance(item, str)]
+
+        if not items or not isinstance(items[0], str):
+            return None
+
+        op = items[0]
+        if op in OP_LIST:
+            return self._compile_condition(items, text)
+        if op in TABLE_OP_LIST:
+            return self._compile_table_toggle(items, text)
+        if op == UNITS_OP:
+            return self._compile_units(items, text)
+
+        return None
+
+    def _compile_table_toggle(self, items, text: str) -> Node:
+        args = items[1:]
+        # both [ROW YES have_CO2Sen] and [ROW [YES have_CO2Sen]] are accepted
+        if len(args) == 1 and isinstance(args[0], Group):
+            args = args[0].items
+
+        if not args or args[0] not in OP_LIST:
+            self.diagnostics.error('Invalid format for tag: %s', text)
+            self.invalid_tags.add(text)
+            condition = Constant(False)
+        else:
+            condition = self._compile_condition(args, text)
+
+        return self._intern(TableToggle(items[0], condition))
+
+    def _compile_units(self, items, text: str) -> Node:
+        groups = items[1:]
+        if (
+            len(groups) != 2
+            or not all(isinstance(group, Group) and group.closed and group.raw for group in groups)
+        ):
+            self.diagnostics.error('Invalid format for tag: %s', text)
+            self.invalid_tags.add(text)
+            return Constant(False)
+
+        return self._intern(Units(groups[0].raw, groups[1].raw))
+
+    def _compile_condition(self, items, text: str) -> Condition:
+        op = items[0]
+        args = items[1:]
+
+        if op in ('AND', 'OR'):
+            if len(args) < 2 or not all(isinstance(arg, Group) for arg in args):
+                self.diagnostics.error('Invalid format for tag: %s, deleting', text)
+                self.invalid_tags.add(text)
+                return Constant(True)
+
+            operands = []
+            for group in args:
+                if not group.items or group.items[0] not in OP_LIST:
+                    self.diagnostics.error('Invalid operation: %s, deleting', group.raw)
+                    self.invalid_tags.add(text)
+                    return Constant(True)
+                operands.append(self._compile_condition(group.items, text))
+
+            node = And(tuple(operands)) if op == 'AND' else Or(tuple(operands))
+            return self._intern(node)
+
+        if op == 'DELETE':
+            return self._intern(Delete())
+
+        words = flatten_words(args)
+        if (
+            (op in ('YES', 'NO') and len(words) != 1)
+            or (op in ('EQUALS', 'NOT_EQUALS') and len(words) != 2)
+            or (op == 'ANY' and len(words) < 2)
+        ):
+            self.diagnostics.error('Invalid operation: %s, deleting', text)
+            self.invalid_tags.add(text)
+            return Constant(True)
+
+        short_name = words[0]
+        if short_name not in self.name_map:
+            self.diagnostics.error('%s not found, deleting', short_name)
+            self.missing_names.add(short_name)
+            return Constant(True)
+        name = self.name_map[short_name]
+
+        if op == 'YES':
+            return self._intern(Yes(name))
+        if op == 'NO':
+            return self._intern(No(name))
+
+        if op == 'ANY':
+            values = []
+            for short_compare in words[1:]:
+                if short_compare in self.name_map:
+                    values.append(self.name_map[short_compare])
+                else:
+                    self.diagnostics.error('%s not found, ignoring it in: %s', short_compare, text)
+                    self.missing_names.add(short_compare)
+            return self._intern(AnyOf(name, frozenset(values)))
+
+        short_compare = words[1]
+        if short_compare not in self.name_map:
+            self.missing_names.add(short_compare)
+            if op == 'NOT_EQUALS':
+                self.diagnostics.error('%s not found, keeping', short_compare)
+                return Constant(False)
+            self.diagnostics.error('%s not found, deleting', short_compare)
+            return Constant(True)
+        value = self.name_map[short_compare]
+
+        if op == 'EQUALS':
+            return self._intern(Equals(name, value))
+        return self._intern(NotEquals(name, value))
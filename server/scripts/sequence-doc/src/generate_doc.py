@@ -1,26 +1,34 @@
 import json
+import os
 import argparse
 import sys
-from pathlib import Path
-import logging
-from typing import TextIO
+from typing import List, TextIO
 from docx import Document
-import os
-import csv
-from mogrifier import mogrify_doc
+from diagnostics import LOG_LEVEL_ENV, LOG_LEVELS, Diagnostics, configure_logging
+from docx_writer import COMPRESSION_METHODS
+from incremental import RenderSession
+from template import MEMORY_BUDGET_ENV, TEMPLATE_CACHE_SIZE, compile_bundles, generate_name_map, get_template, preload_templates, template_cache
+from stats import GenerationStats
+import keep_mask
+import output_cache
+import preview
+import render_program
 
 
 DEFAULT_DOC_VERSION = 'Current G36 Decisions'
 OUTPUT_PATH = 'Current Guideline 36.docx'
-MAPPING_FILE_PATH = 'Guideline 36-2021 (mappings).csv'
-SOURCE_DOC_PATH = 'Guideline 36-2021 (sequence selection source).docx'
-MAPPINGS_SHORT_ID = 'Short ID'
-MAPPINGS_MODELICA_INSTANCE = 'Modelica Parameter'
-MAPPINGS_MODELICA_VALUES = 'Modelica Path'
 
 ANNOTATION_STYLE = 'Toggle'
-
-logging.getLogger().setLevel(logging.DEBUG)
+OUTPUT_FORMATS = ['docx', 'outline', 'html']
+# default --output of each --format
+OUTPUT_PATHS = {
+    'docx': OUTPUT_PATH,
+    'outline': 'Current Guideline 36.jsonl',
+    'html': 'Current Guideline 36.html',
+}
+# mogrify edits a copy of the template, mask writes the kept parts of it (see
+# keep_mask.py) and program joins the kept segments of it (see render_program.py)
+RENDERERS = ['mogrify', 'mask', 'program']
 
 def parse_args(args) -> str:
     parser = argparse.ArgumentParser(
@@ -28,9 +36,56 @@ def parse_args(args) -> str:
         description = 'Generates a sequence document from ctrl-flow selections'
     )
     parser.add_argument('-v', '--version', default=DEFAULT_DOC_VERSION)
-    parser.add_argument('-o', '--output', default=OUTPUT_PATH)
+    parser.add_argument('-o', '--output',
+        help=f'path of the generated document, "-" writes it to stdout (defaults to "{OUTPUT_PATH}", with the extension of --format)')
+    parser.add_argument('--serve', action='store_true',
+        help='keep running and generate a document for each JSON line job read from stdin')
+    parser.add_argument('--socket',
+        help='with --serve, read jobs from this unix socket instead of stdin')
+    parser.add_argument('--preload', nargs='+', metavar='VERSION',
+        help='with --serve, load the templates of these versions ("all" for every version) before taking jobs')
+    parser.add_argument('--workers', type=int,
+        help='with --serve, load every template and fork this many workers to generate documents in parallel')
+    parser.add_argument('--queue-depth', type=int,
+        help='with --workers, jobs waiting for a worker beyond which new jobs are shed (defaults to 4 per worker)')
+    parser.add_argument('--max-jobs', type=int,
+        help='with --workers, replace a worker after it handled this many jobs')
+    parser.add_argument('--max-rss', type=int,
+        help='with --workers, replace a worker once its resident memory exceeds this many MB')
+    parser.add_argument('--memory-budget', type=int, default=os.environ.get(MEMORY_BUDGET_ENV),
+        help=f'MB of loaded templates to keep, evicting the least recently used ones (defaults to ${MEMORY_BUDGET_ENV}, unbounded if unset)')
+    parser.add_argument('--batch',
+        help='generate a document for each selection set in a JSON lines file ("-" for stdin) or directory of .json files, with --renderer, --compression and --compress-level unless an item sets them')
+    parser.add_argument('--output-dir', default='.',
+        help='with --batch, directory for the generated documents and manifest')
+    parser.add_argument('--processes', type=int,
+        help='with --batch, number of worker processes (defaults to the number of cores)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='docx',
+        help='"outline" writes the surviving headings, paragraphs and tables as JSON lines and "html" as an html fragment, without building a docx')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION_METHODS), default='deflate',
+        help='how to compress the document xml, "store" skips compression for local hops')
+    parser.add_argument('--compress-level', type=int, choices=range(0, 10), metavar='0-9',
+        help='deflate level of the document xml')
+    parser.add_argument('--renderer', choices=RENDERERS, default='mogrify',
+        help='"mask" writes the document xml straight from the template instead of editing a copy of it and "program" joins its precompiled segments, giving the same document')
+    parser.add_argument('--compile', nargs='+', metavar='VERSION',
+        help='compile the templates of these versions ("all" for every version) into bundles loaded instead of the version files')
+    parser.add_argument('--manifest', action='store_true',
+        help='print the selection long names and values the version can consult as JSON')
+    parser.add_argument('--stats', action='store_true',
+        help='write the timings and counters of the generation to stderr as one JSON line')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, type=str.upper,
+        help=f'least severe messages to log (defaults to ${LOG_LEVEL_ENV}, else WARNING)')
+    parser.add_argument('--cache-dir', default=os.environ.get(output_cache.CACHE_DIR_ENV),
+        help=f'directory to cache generated documents in (defaults to ${output_cache.CACHE_DIR_ENV}, no caching if unset)')
+    parser.add_argument('--cache-size', type=int, default=output_cache.DEFAULT_CACHE_SIZE // (1024 * 1024),
+        help='maximum size of the document cache in MB')
 
     args = parser.parse_args(args)
+    if args.batch and args.format != 'docx':
+        parser.error('--batch only generates docx documents')
+    if args.output is None:
+        args.output = OUTPUT_PATHS[args.format]
 
     return args
 
@@ -38,48 +93,165 @@ def extract_input(input_stream: TextIO) -> dict:
     # TODO: define expected object type
     return json.load(input_stream)
 
-def generate_name_map(mappings_path: str) -> dict:
-    # load mappings
-    mappings = {}
+def generate_doc(selections, version, stats: GenerationStats = None) -> Document:
+    ''' Gathers source document and short code map and
+        passes everything on to doc mogrifier
+
+        This is separated from main for easier testing. Timings and counters
+        are recorded in stats if given (see stats.py)
+    '''
+    if stats is None:
+        stats = GenerationStats()
+    # parsed source document, short code mappings and annotations are cached
+    # per version, each call works on its own copy of the document
+    with stats.phase('load_template'):
+        template = get_template(version)
 
-    with open(mappings_path) as fh:
-        reader = csv.DictReader(fh)
-        for row in reader:
-            if row[MAPPINGS_SHORT_ID] and mappings.get(row[MAPPINGS_SHORT_ID]):
-                logging.error('Duplicate entry for "%s"', row[MAPPINGS_SHORT_ID])
-            if row[MAPPINGS_SHORT_ID]:
-                mappings[row[MAPPINGS_SHORT_ID]] = row[MAPPINGS_MODELICA_INSTANCE] or row[MAPPINGS_MODELICA_VALUES]
+    return template.render(selections, stats)
 
-    return mappings
+def generate_preview(selections, version, stats: GenerationStats = None) -> List[dict]:
+    ''' Blocks of the document generated for selections, see preview.py
+    '''
+    if stats is None:
+        stats = GenerationStats()
+    diagnostics = Diagnostics()
+    with stats.phase('load_template'):
+        session = RenderSession(get_template(version))
+    with stats.phase('preview'):
+        session.update(selections)
+        blocks = list(preview.get_outline(session, diagnostics))
 
-def get_local_path_prefix(version: str) -> Path:
-    return Path(os.path.dirname(__file__), 'version', version)
+    stats.count_diagnostics(diagnostics)
+    diagnostics.emit()
 
-def generate_doc(selections, version) -> Document:
-    ''' Gathers source document and short code map and
-        passes everything on to doc mogrifier
+    return blocks
 
-        This is separated from main for easier testing
+def get_selection_manifest(version: str) -> dict:
+    ''' The selections a version's template can consult, so callers can send
+        only those (see template.Template.get_selection_manifest)
     '''
-    local_file_prefix = get_local_path_prefix(version)
+    return {'version': version, **get_template(version).get_selection_manifest()}
 
-    # load source document starting point
-    source_doc_path = local_file_prefix / SOURCE_DOC_PATH
-    document = Document(source_doc_path)
+def generate_doc_bytes(
+    selections,
+    version,
+    compression: str = 'deflate',
+    compress_level: int = None,
+    stats: GenerationStats = None,
+    renderer: str = 'mogrify',
+) -> bytes:
+    ''' Generates a document and returns the serialized docx. Only the main
+        document part gets compressed, with compression ('deflate' or 'store')
+        and compress_level, see template.Template.serialize. Documents are
+        served from the output cache when one is configured (see output_cache.py).
+        Timings and counters are recorded in stats if given. Both renderers
+        (see RENDERERS) generate the same bytes.
+    '''
+    if stats is None:
+        stats = GenerationStats()
+    with stats.phase('load_template'):
+        template = get_template(version)
+
+    def render() -> bytes:
+        method = COMPRESSION_METHODS[compression]
+        if renderer in ('mask', 'program'):
+            render_xml = keep_mask.render_document_xml if renderer == 'mask' else render_program.render_document_xml
+            data = render_xml(template, selections, stats)
+            with stats.phase('save'):
+                return template.serialize_xml(data, method, compress_level)
+
+        document = template.render(selections, stats)
+        with stats.phase('save'):
+            return template.serialize(document, method, compress_level)
 
-    # load short code mappings
-    short_code_path = local_file_prefix / MAPPING_FILE_PATH
-    name_map = generate_name_map(short_code_path)
+    cache = output_cache.get_output_cache()
+    if cache is None:
+        return render()
 
-    return mogrify_doc(document, name_map, selections)
+    with stats.phase('cache'):
+        key = output_cache.get_cache_key(version, template, selections, compression, compress_level)
+        data = cache.get(key)
+    stats.count('cache_hits', int(data is not None))
+    if data is None:
+        data = render()
+        with stats.phase('cache'):
+            cache.put(key, data)
+
+    return data
 
 def main():
     '''
     '''
     args = parse_args(sys.argv[1:])
+    configure_logging(args.log_level)
+    output_cache.configure(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.memory_budget is not None:
+        template_cache.configure(TEMPLATE_CACHE_SIZE, args.memory_budget * 1024 * 1024)
+
+    if args.compile:
+        for compiled in compile_bundles(args.compile):
+            sys.stdout.write(json.dumps(compiled) + '\n')
+        return 0
+
+    if args.manifest:
+        json.dump(get_selection_manifest(args.version), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 0
+
+    if args.serve:
+        # imported here as serve, workers and batch depend on this module
+        import serve
+        import workers
+        pool = None
+        if args.workers:
+            workers.prepare_templates(args.preload or ['all'])
+            pool = workers.WorkerPool(
+                args.workers,
+                args.queue_depth,
+                args.max_jobs,
+                args.max_rss * 1024 * 1024 if args.max_rss else None,
+            )
+            pool.start()
+        elif args.preload:
+            preload_templates(args.preload)
+        try:
+            if args.socket:
+                serve.serve_socket(args.socket, pool)
+            else:
+                serve.serve_stream(sys.stdin, sys.stdout, pool)
+        finally:
+            if pool is not None:
+                pool.stop()
+        return 0
+
+    if args.batch:
+        import batch
+        defaults = {'renderer': args.renderer, 'compression': args.compression, 'compress_level': args.compress_level}
+        jobs = list(batch.read_jobs(args.batch, args.version, defaults))
+        manifest = batch.run_batch(jobs, args.output_dir, args.processes)
+        return 0 if all(entry['status'] == 'ok' for entry in manifest) else 1
+
     selections = extract_input(sys.stdin)
-    document = generate_doc(selections, args.version)
-    document.save(args.output)
+    stats = GenerationStats()
+    if args.format != 'docx':
+        blocks = generate_preview(selections, args.version, stats)
+        write = preview.write_outline if args.format == 'outline' else preview.write_html
+        if args.output == '-':
+            write(blocks, sys.stdout)
+        else:
+            with open(args.output, 'w', encoding='utf-8') as fh:
+                write(blocks, fh)
+    else:
+        data = generate_doc_bytes(selections, args.version, args.compression, args.compress_level, stats, args.renderer)
+        if args.output == '-':
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        else:
+            with open(args.output, 'wb') as fh:
+                fh.write(data)
+
+    if args.stats:
+        sys.stderr.write(stats.to_json() + '\n')
 
     return 0
 
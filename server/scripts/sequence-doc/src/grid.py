@@ -0,0 +1,75 @@
+'''
+Cell positions of a table. A cell's column is its position in the table grid
+(w:tblGrid): cells spanning several grid columns (w:gridSpan) and rows
+starting after empty grid columns (w:gridBefore) shift the cells after them.
+Vertically merged cells (w:vMerge) are separate cells in each row so they need
+no special handling.
+'''
+from typing import Dict, List, Tuple
+
+W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+TR_TAG = W + 'tr'
+TC_TAG = W + 'tc'
+GRID_COL_TAG = W + 'gridCol'
+TBL_GRID_TAG = W + 'tblGrid'
+VAL_ATTRIBUTE = W + 'val'
+
+def get_int_property(parent, path: str, default: int) -> int:
+    element = parent.find(path)
+    if element is None or element.get(VAL_ATTRIBUTE) is None:
+        return default
+    return int(element.get(VAL_ATTRIBUTE))
+
+class TableGrid:
+    ''' Grid positions of the cells of a table element, computed once.
+        positions maps a cell (w:tc) element to (row index, first grid column, span)
+    '''
+    def __init__(self, tbl):
+        self.tbl = tbl
+        self.rows: List[List[Tuple]] = []
+        self.positions: Dict = {}
+        self._removed_columns = set()
+
+        for row_index, tr in enumerate(tbl.iterchildren(TR_TAG)):
+            column = get_int_property(tr, f'{W}trPr/{W}gridBefore', 0)
+            cells = []
+            for tc in tr.iterchildren(TC_TAG):
+                span = get_int_property(tc, f'{W}tcPr/{W}gridSpan', 1)
+                position = (row_index, column, span)
+                self.positions[tc] = position
+                cells.append((tc, column, span))
+                column += span
+            self.rows.append(cells)
+
+    def get_columns(self, tc) -> range:
+        ''' Grid columns covered by a cell
+        '''
+        _, column, span = self.positions[tc]
+        return range(column, column + span)
+
+    def remove_columns(self, columns: range) -> List:
+        ''' Removes grid columns from the table. Cells only partly within the
+            columns are narrowed right away; the cells entirely within them and
+            the w:gridCol elements are returned for the caller to delete.
+        '''
+        columns = [column for column in columns if column not in self._removed_columns]
+        self._removed_columns.update(columns)
+        to_delete = []
+
+        for cells in self.rows:
+            for tc, start, span in cells:
+                cell_columns = range(start, start + span)
+                if not any(column in cell_columns for column in columns):
+                    continue
+                remaining = span - len(self._removed_columns.intersection(cell_columns))
+                if remaining:
+                    tc.find(f'{W}tcPr/{W}gridSpan').set(VAL_ATTRIBUTE, str(remaining))
+                else:
+                    to_delete.append(tc)
+
+        grid = self.tbl.find(TBL_GRID_TAG)
+        if grid is not None:
+            grid_columns = list(grid.iterchildren(GRID_COL_TAG))
+            to_delete.extend(grid_columns[column] for column in columns if column < len(grid_columns))
+
+        return to_delete
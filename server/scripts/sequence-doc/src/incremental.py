@@ -0,0 +1,176 @@
+'''
+Incremental evaluation for interactive previews. A RenderSession keeps the
+outcome (keep or delete) of every annotation of a template for the selections
+it last saw, and the keep-mask those outcomes give: the template elements
+(as element paths, see template.get_element_path) hidden in the generated document.
+
+When the selections change, only the annotations reading a changed selection
+are evaluated again (through the template's dependency index) and the mask is
+patched with the elements of the annotations that flipped, so an update costs
+time proportional to what changed rather than to the template size.
+
+The mask leaves out what a render changes without deleting: converted units
+and cells narrowed by a COLUMN toggle. render() runs the full pipeline.
+'''
+import weakref
+from collections import Counter
+from typing import Dict, List, Optional
+from docx import Document
+from expression import Condition, SelectionSet, TableToggle
+from grid import GRID_COL_TAG, TBL_GRID_TAG, TableGrid
+from template import INFO_BOX_SELECTION, ElementResolver, Template, get_element_path
+import utils
+
+MISSING = object()
+
+# element paths deleted by each annotation, per template
+annotation_effects = weakref.WeakKeyDictionary()
+
+def get_annotation_effects(template: Template) -> List[List[tuple]]:
+    ''' For each annotation of template, the paths of the elements it deletes
+        when its condition says so
+    '''
+    effects = annotation_effects.get(template)
+    if effects is not None:
+        return effects
+
+    resolve = ElementResolver(template.document.element).resolve
+    grids = {}
+    effects = []
+
+    for located in template.annotations:
+        expression = located['expression']
+        paths = []
+
+        if isinstance(expression, Condition):
+            container, position = located['paragraph'][:-1], located['paragraph'][-1]
+            paths = [container + (index,) for index in template.outlines[container].section(position)]
+        elif isinstance(expression, TableToggle) and 'table' in located:
+            if located['op'] == 'ROW':
+                paths = [located['row']]
+            elif located['op'] == 'TABLE':
+                paths = [located['table']]
+            elif located['op'] == 'COLUMN':
+                if located['table'] not in grids:
+                    grids[located['table']] = TableGrid(resolve(located['table']))
+                paths = get_column_paths(grids[located['table']], resolve(located['cell']))
+
+        effects.append(paths)
+
+    annotation_effects[template] = effects
+    return effects
+
+def get_column_paths(grid: TableGrid, tc) -> List[tuple]:
+    ''' Cells entirely within the grid columns of tc, and their w:gridCol elements
+    '''
+    columns = grid.get_columns(tc)
+    paths = []
+    for cells in grid.rows:
+        for cell, start, span in cells:
+            if columns.start <= start and start + span <= columns.stop:
+                paths.append(get_element_path(cell))
+
+    tbl_grid = grid.tbl.find(TBL_GRID_TAG)
+    if tbl_grid is not None:
+        grid_columns = list(tbl_grid.iterchildren(GRID_COL_TAG))
+        paths.extend(get_element_path(grid_columns[column]) for column in columns if column < len(grid_columns))
+
+    return paths
+
+class RenderSession:
+    ''' Per user state of an interactive preview of one template
+    '''
+    def __init__(self, template: Template):
+        self.template = template
+        self.effects = get_annotation_effects(template)
+        self.selections: Dict = {}
+        # True when the annotation deletes, None before the first update
+        self.outcomes: List[Optional[bool]] = [None] * len(template.annotations)
+        self.delete_info_boxes = False
+        # number of reasons each hidden element is hidden for
+        self.mask = Counter()
+        self._started = False
+
+    def hidden(self) -> List[tuple]:
+        ''' Paths of the hidden elements
+        '''
+        return list(self.mask)
+
+    def _hide(self, paths, patch: Dict):
+        for path in paths:
+            self.mask[path] += 1
+            if self.mask[path] == 1:
+                if path in patch['shown']:
+                    patch['shown'].remove(path)
+                else:
+                    patch['hidden'].add(path)
+
+    def _show(self, paths, patch: Dict):
+        for path in paths:
+            self.mask[path] -= 1
+            if not self.mask[path]:
+                del self.mask[path]
+                if path in patch['hidden']:
+                    patch['hidden'].remove(path)
+                else:
+                    patch['shown'].add(path)
+
+    def update(self, selections: Dict) -> Dict:
+        ''' Applies new selections. Returns the indexes of the annotations whose
+            outcome changed and the paths hidden and shown again since the last update
+        '''
+        template = self.template
+        patch = {'changed': [], 'hidden': set(), 'shown': set()}
+
+        if not self._started:
+            self._started = True
+            self._hide(template.toggle_runs, patch)
+            self._hide(template.instr_boxes, patch)
+            affected = range(len(template.annotations))
+            changed_names = set(template.referenced_names)
+        else:
+            changed_names = {
+                name for name in template.referenced_names
+                if self.selections.get(name, MISSING) != selections.get(name, MISSING)
+            }
+            affected = sorted({
+                index for name in changed_names for index in template.dependents.get(name, [])
+            })
+
+        if INFO_BOX_SELECTION in changed_names:
+            delete_info_boxes = utils.reduce_to_boolean(selections[INFO_BOX_SELECTION])
+            if delete_info_boxes != self.delete_info_boxes:
+                self.delete_info_boxes = delete_info_boxes
+                (self._hide if delete_info_boxes else self._show)(template.info_boxes, patch)
+
+        selection_set = SelectionSet(selections)
+        for index in affected:
+            deletes = self._evaluate(template.annotations[index], selection_set)
+            if deletes == self.outcomes[index]:
+                continue
+            if deletes:
+                self._hide(self.effects[index], patch)
+            elif self.outcomes[index]:
+                self._show(self.effects[index], patch)
+            self.outcomes[index] = deletes
+            patch['changed'].append(index)
+
+        selection_set.diagnostics.emit()
+        self.selections = selections
+        patch['hidden'] = sorted(patch['hidden'])
+        patch['shown'] = sorted(patch['shown'])
+
+        return patch
+
+    def _evaluate(self, located: Dict, selections: SelectionSet) -> bool:
+        expression = located['expression']
+        if isinstance(expression, Condition):
+            return selections.deletes(expression)
+        if isinstance(expression, TableToggle) and 'table' in located:
+            return selections.deletes(expression.condition)
+        return False
+
+    def render(self) -> Document:
+        ''' Generates the document for the current selections
+        '''
+        return self.template.render(self.selections)
@@ -0,0 +1,335 @@
+'''
+Keep-mask rendering: generates documents without copying or modifying the
+template. mogrify_doc edits a copy of the template's document body, so every
+request pays for a deep copy of the tree before making its edits. Here the
+annotations are evaluated once into a KeepMask: the paths (see
+template.get_element_path) of the template elements left out of the generated
+document, and the few elements written differently (the first run of converted
+UNITS annotations and cells narrowed by a COLUMN toggle) with their bytes.
+
+The document part is then written from the template's serialized document part:
+the bytes of kept elements are copied as they are and the walk only descends
+into the elements holding a hidden or replaced element. The template is only
+read, so one loaded template serves any number of concurrent renders, each
+holding just its mask and its output.
+
+The output is byte for byte the document part mogrify_doc produces.
+'''
+import copy
+import re
+import weakref
+from array import array
+from typing import Dict, List, Optional, Set, Tuple
+from xml.parsers import expat
+from lxml import etree
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from diagnostics import Diagnostics
+from expression import Condition, SelectionSet, TableToggle
+from grid import GRID_COL_TAG, TBL_GRID_TAG, W, TableGrid
+from incremental import get_annotation_effects
+from mogrifier import get_unit_system, get_unit_text
+from stats import GenerationStats
+from template import INFO_BOX_SELECTION, UNIT_SYSTEMS, ElementResolver, Template, get_element_path
+import utils
+
+# namespace declarations lxml adds to the start tag of a detached copy
+NAMESPACE_DECLARATION = re.compile(rb'\s+xmlns(?::[\w.-]+)?="[^"]*"')
+
+# edits of the children of an element, see KeepMaskLayout.write
+HIDDEN = None
+DESCEND = object()
+
+# layout of each template, built on first use
+keep_mask_layouts = weakref.WeakKeyDictionary()
+
+class DocumentIndex:
+    ''' Byte ranges of the nodes (elements, comments and processing
+        instructions) of a serialized xml document, numbered in document order.
+        A node's range runs from its start tag up to the next node or its
+        parent's end tag, so like an lxml removal it takes the node's tail along.
+    '''
+    def __init__(self, data: bytes):
+        self.data = data
+        self.starts = array('I')
+        self.stops = array('I')
+        # number of nodes in each node's subtree, itself included
+        self.sizes = array('I')
+        self._children = {}
+
+        parser = expat.ParserCreate()
+        open_elements = []
+        # last child seen of each open element, the root's parent first
+        last_children = [None]
+
+        def add_node() -> int:
+            node = len(self.starts)
+            position = parser.CurrentByteIndex
+            self.starts.append(position)
+            self.stops.append(len(data))
+            self.sizes.append(1)
+            if last_children[-1] is not None:
+                self.stops[last_children[-1]] = position
+            last_children[-1] = node
+            return node
+
+        def start_element(name, attributes):
+            open_elements.append(add_node())
+            last_children.append(None)
+
+        def end_element(name):
+            last_child = last_children.pop()
+            if last_child is not None:
+                self.stops[last_child] = parser.CurrentByteIndex
+            node = open_elements.pop()
+            self.sizes[node] = len(self.starts) - node
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        parser.CommentHandler = lambda data: add_node()
+        parser.ProcessingInstructionHandler = lambda target, data: add_node()
+        parser.ordered_attributes = True
+        parser.Parse(data, True)
+
+    def children(self, node: int) -> List[int]:
+        ''' The child nodes of node, as lxml lists them
+        '''
+        children = self._children.get(node)
+        if children is None:
+            children = []
+            child = node + 1
+            while child < node + self.sizes[node]:
+                children.append(child)
+                child += self.sizes[child]
+            self._children[node] = children
+
+        return children
+
+def serialize_variant(element, edit, *args) -> bytes:
+    ''' The bytes of element, tail included, once edit(copy, *args) changed a
+        copy of it. The element must not declare namespaces itself as the
+        declarations lxml adds to the copy are dropped.
+    '''
+    variant = copy.deepcopy(element)
+    edit(variant, *args)
+    data = etree.tostring(variant, encoding='UTF-8', xml_declaration=False)
+    end = data.index(b'>')
+
+    return NAMESPACE_DECLARATION.sub(b'', data[:end]) + data[end:]
+
+def set_run_text(r, paragraph: Paragraph, text: str):
+    ''' What convert_units does to the first run of a UNITS annotation
+    '''
+    run = Run(r, paragraph)
+    run.text = text
+    run.style = None
+
+def set_grid_span(grid_span, span: int):
+    ''' What TableGrid.remove_columns does to a narrowed cell
+    '''
+    grid_span.set(f'{W}val', str(span))
+
+class KeepMaskLayout:
+    ''' What rendering with a mask needs from a template, built once: its
+        serialized document part indexed (see DocumentIndex), the bytes of
+        the first run of each UNITS annotation once converted to each unit
+        system, and the cells of the tables holding a COLUMN toggle.
+    '''
+    def __init__(self, template: Template):
+        self.index = DocumentIndex(template.document.part.blob)
+        self.effects = get_annotation_effects(template)
+
+        root = template.document.element
+        resolve = ElementResolver(root).resolve
+
+        self.units = {}
+        for position in template.unit_annotations:
+            located = template.annotations[position]
+            r = resolve(located['runs'][0])
+            paragraph = Paragraph(r.getparent(), template.document._body)
+            self.units[located['runs'][0]] = {
+                system: serialize_variant(r, set_run_text, paragraph, get_unit_text(located['expression'], system))
+                for system in UNIT_SYSTEMS
+            }
+
+        self.tables = {}
+        for located in template.annotations:
+            if located['op'] != 'COLUMN' or 'table' not in located or located['table'] in self.tables:
+                continue
+            grid = TableGrid(resolve(located['table']))
+            cells = {}
+            for row in grid.rows:
+                for tc, start, span in row:
+                    narrowed = {}
+                    if span > 1:
+                        grid_span = tc.find(f'{W}tcPr/{W}gridSpan')
+                        narrowed = {
+                            'path': get_element_path(grid_span),
+                            'variants': {
+                                remaining: serialize_variant(grid_span, set_grid_span, remaining)
+                                for remaining in range(1, span)
+                            },
+                        }
+                    cells[get_element_path(tc)] = (start, span, narrowed)
+            tbl_grid = grid.tbl.find(TBL_GRID_TAG)
+            grid_columns = [] if tbl_grid is None else list(tbl_grid.iterchildren(GRID_COL_TAG))
+            self.tables[located['table']] = {
+                'cells': cells,
+                'grid_columns': [get_element_path(column) for column in grid_columns],
+            }
+
+    def write(self, mask: 'KeepMask') -> bytes:
+        ''' The document part with the hidden elements left out and the
+            replaced elements replaced
+        '''
+        # edits of the children of each element on the way to a hidden or
+        # replaced element, by child position
+        edits: Dict[tuple, Dict] = {}
+
+        def add_edit(path: tuple, edit):
+            edits.setdefault(path[:-1], {})[path[-1]] = edit
+            path = path[:-1]
+            while path:
+                siblings = edits.setdefault(path[:-1], {})
+                if path[-1] in siblings:
+                    break
+                siblings[path[-1]] = DESCEND
+                path = path[:-1]
+
+        for path, data in mask.replaced.items():
+            add_edit(path, data)
+        # hidden elements win over their descendants' edits
+        for path in mask.hidden:
+            add_edit(path, HIDDEN)
+
+        index = self.index
+        data = memoryview(index.data)
+        output = [data[:index.starts[0]]]
+
+        def write_node(node: int, path: tuple):
+            cursor = index.starts[node]
+            children = index.children(node)
+            node_edits = edits.get(path, {})
+            for position in sorted(node_edits):
+                child = children[position]
+                output.append(data[cursor:index.starts[child]])
+                edit = node_edits[position]
+                if edit is DESCEND:
+                    write_node(child, path + (position,))
+                elif edit is not HIDDEN:
+                    output.append(edit)
+                cursor = index.stops[child]
+            output.append(data[cursor:index.stops[node]])
+
+        write_node(0, ())
+        return b''.join(output)
+
+def get_keep_mask_layout(template: Template) -> KeepMaskLayout:
+    layout = keep_mask_layouts.get(template)
+    if layout is None:
+        layout = keep_mask_layouts[template] = KeepMaskLayout(template)
+    return layout
+
+class KeepMask:
+    ''' The elements of a template a selection set leaves out of the generated
+        document, by path, and the bytes of the elements written differently
+    '''
+    def __init__(self):
+        self.hidden: Set[tuple] = set()
+        self.replaced: Dict[tuple, bytes] = {}
+
+def evaluate_annotations(template: Template, tables: Dict, selections: Dict, diagnostics: Diagnostics) -> Tuple[List[bool], Dict[tuple, Set[int]]]:
+    ''' Whether each annotation deletes the section, table or row it controls
+        (False for COLUMN toggles and annotations without a condition), and the
+        grid columns COLUMN toggles remove from each table of tables (see
+        KeepMaskLayout.tables)
+    '''
+    selection_set = SelectionSet(selections, diagnostics)
+    deletes = []
+    removed_columns: Dict[tuple, Set[int]] = {}
+
+    for located in template.annotations:
+        expression = located['expression']
+        deleted = False
+        if isinstance(expression, Condition):
+            deleted = selection_set.deletes(expression)
+        elif isinstance(expression, TableToggle):
+            if 'table' not in located:
+                diagnostics.error('Table tag outside of a table: %s', located['text'])
+            elif selection_set.deletes(expression.condition):
+                if located['op'] == 'COLUMN':
+                    # (first grid column, span, ...) of the cell
+                    start, span = tables[located['table']]['cells'][located['cell']][:2]
+                    removed_columns.setdefault(located['table'], set()).update(range(start, start + span))
+                else:
+                    deleted = True
+        deletes.append(deleted)
+
+    return deletes, removed_columns
+
+def get_keep_mask(template: Template, selections: Dict, diagnostics: Optional[Diagnostics] = None) -> KeepMask:
+    ''' Evaluates the annotations of template for selections, making the same
+        decisions as the passes of mogrify_doc
+    '''
+    layout = get_keep_mask_layout(template)
+    diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+    mask = KeepMask()
+    hidden = mask.hidden
+
+    # info and instruction boxes
+    if utils.reduce_to_boolean(selections[INFO_BOX_SELECTION]):
+        hidden.update(template.info_boxes)
+    hidden.update(template.instr_boxes)
+
+    # sections, tables and rows, and the grid columns removed from each table
+    deletes, removed_columns = evaluate_annotations(template, layout.tables, selections, diagnostics)
+    for deleted, effects in zip(deletes, layout.effects):
+        if deleted:
+            hidden.update(effects)
+
+    for table, columns in removed_columns.items():
+        table_layout = layout.tables[table]
+        for cell, (start, span, narrowed) in table_layout['cells'].items():
+            remaining = span - len(columns.intersection(range(start, start + span)))
+            if not remaining:
+                hidden.add(cell)
+            elif remaining < span:
+                mask.replaced[narrowed['path']] = narrowed['variants'][remaining]
+        grid_columns = table_layout['grid_columns']
+        hidden.update(grid_columns[column] for column in columns if column < len(grid_columns))
+
+    # toggle text, but for the converted units
+    hidden.update(template.toggle_runs)
+    unit_system = get_unit_system(template.unit_selection, selections, diagnostics) if layout.units else None
+    if unit_system is not None:
+        for path, variants in layout.units.items():
+            hidden.discard(path)
+            mask.replaced[path] = variants[unit_system]
+
+    return mask
+
+def render_document_xml(template: Template, selections: Dict, stats: GenerationStats = None) -> bytes:
+    ''' The document part generated for selections, see the module docstring.
+        Timings and counters are recorded in stats if given.
+    '''
+    if stats is None:
+        stats = GenerationStats()
+    diagnostics = Diagnostics()
+
+    with stats.phase('mask_layout'):
+        layout = get_keep_mask_layout(template)
+    stats.count_compile_errors(template.compiler)
+    stats.count_annotations(template.annotations)
+
+    with stats.phase('evaluate'):
+        mask = get_keep_mask(template, selections, diagnostics)
+    stats.count('elements_hidden', len(mask.hidden))
+    stats.count('elements_replaced', len(mask.replaced))
+
+    with stats.phase('write_xml'):
+        data = layout.write(mask)
+
+    stats.count_diagnostics(diagnostics)
+    diagnostics.emit()
+
+    return data
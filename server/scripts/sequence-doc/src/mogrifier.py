@@ -6,224 +6,202 @@ gets returned, with all template language removed
 import re
 from docx import Document
 from docx.text.paragraph import Paragraph
-from docx.table import Table
-import logging
+from docx.text.run import Run
+from docx.table import Table, _Cell, _Row
+from lxml import etree
 import utils
-from typing import Dict, List
-
-logging.getLogger().setLevel(logging.DEBUG)
+from typing import Dict, List, Optional, Tuple
+from deletions import DeletionPlan
+from diagnostics import Diagnostics
+from expression import UNITS_OP, AnnotationCompiler, Condition, SelectionSet, TableToggle, Units
+from grid import TableGrid
+from outline import OutlineIndex
+from stats import GenerationStats
+from styles import StyleTable
 
 P_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p'
-BOOKMARK_TAGS = ['{http://schemas.openxmlformats.org/wordprocessingml/2006/main}bookmarkEnd', "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}bookmarkStart"]
-SECTION_TAG = ["{http://schemas.openxmlformats.org/wordprocessingml/2006/main}sectPr"]
 TABLE_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tbl'
-ANNOTATION_STYLE = 'Toggle'
+R_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}r'
+TR_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tr'
+TC_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tc'
+
+NAMESPACES = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+get_run_style_id = etree.XPath('string(w:rPr/w:rStyle/@w:val)', namespaces=NAMESPACES)
+get_paragraph_style_id = etree.XPath('string(w:pPr/w:pStyle/@w:val)', namespaces=NAMESPACES)
+
+UNIT_SYSTEMS = ['SI', 'IP']
 
-OP_LIST = ['AND', 'OR', 'YES', 'NO', 'EQUALS', 'NOT_EQUALS', 'ANY', 'DELETE']
-TABLE_OP_LIST = ['TABLE', 'ROW', 'COLUMN']
 # Type hints
 Selections = Dict[str, List]
 
-elements_to_delete = []
-
-def initialize_remove_list():
-    ''' Resets global remove list to an empty array
+class MogrifyContext:
+    ''' State of one mogrify_doc run: the scan of the document (see
+        scan_document), the elements scheduled for deletion, the run's timings
+        and counters (see stats.py) and the messages it logs when done (see
+        diagnostics.py). Nothing else is kept between calls, so documents can be
+        mogrified concurrently as long as each run gets its own context.
     '''
-    global elements_to_delete
-    elements_to_delete = []
-
-def remove_node(node):
-    ''' Controls access to a global list for nodes to be deleted
+    def __init__(self, scan: Dict = None, stats: GenerationStats = None):
+        self.scan = scan
+        self.deletions = DeletionPlan()
+        self.stats = stats if stats is not None else GenerationStats()
+        self.diagnostics = Diagnostics()
+
+def remove_node(node, ctx: MogrifyContext):
+    ''' Schedules a python-docx object or lxml element for deletion
     '''
     try:
-       remove_element(node._element)
+       remove_element(node._element, ctx)
     except AttributeError:
         # node is actually an element, not a Paragraph
-        remove_element(node)
+        remove_element(node, ctx)
 
-def remove_element(element):
-    ''' Adds a lxml element to global list for deletion
+def remove_element(element, ctx: MogrifyContext):
+    ''' Adds a lxml element to the deletion plan of the run
     '''
-    global elements_to_delete
-    elements_to_delete.append(element)
+    ctx.deletions.add(element)
 
-def get_heading_level(paragraph):
-    ''' Gets heading level of paragraph
+def remove_section(paragraph: Paragraph, outlines: OutlineIndex):
+    ''' Removes a section of text and its siblings, see outline.py
     '''
-    style = paragraph.style.name
-    match = re.match(r'Heading (\d+)', style)
-
-    if not match:
-        logging.info('Saw unrecognized style: {}'.format(style))
-        return 100
-    return int(match.group(1))
+    outlines.remove_section(paragraph._p)
 
-def remove_info_box(paragraph, run_op_lookup: Dict):
-    '''
-        Removes info box text within a section (paragraph is a detected info box in a section)
-        Also removes any sibling elements within the paragraph
-    '''
-    remove_node(paragraph)
-
-    for sib_el in paragraph._element.itersiblings(P_TAG):
-        sib_p = Paragraph(sib_el, paragraph._parent)
-        sib_level = get_heading_level(sib_p)
-        
-        if (sib_level == 0):
-            for run in sib_p.runs:
-                if run.element in run_op_lookup and run_op_lookup[run.element]['op'] in ('VENT', 'ENERGY'):
-                    # We've reached another VENT/ENERGY toggle, stop
-                    return
-        else:
-            # reached end of info box, stop
-            return
-                
-        remove_node(sib_p)
-
-def remove_section(paragraph: Paragraph, run_op_lookup: Dict):
-    ''' Removes a section of text and its siblings
-    '''
-    style = paragraph.style.name
-    level = get_heading_level(paragraph)
-    
-    if style in ('Info. box', 'InfoboxList', 'InfoTableTitle'):
-        return remove_info_box(paragraph, run_op_lookup)
-
-    for sib_el in paragraph._element.itersiblings():
-        if sib_el.tag == P_TAG:
-            sib_p = Paragraph(sib_el, paragraph._parent)
-            sib_level = get_heading_level(sib_p)
-
-            if (sib_level <= level) and (sib_level != 9999):
-                break
-
-            remove_node(sib_p)
-        elif sib_el.tag == TABLE_TAG:
-            # Assume table matches indentation of parent paragraph
-            # so just go ahead and remove
-            sib_t = Table(sib_el, paragraph._parent)
-            remove_node(sib_t)
-        elif sib_el.tag in BOOKMARK_TAGS:
-            remove_node(sib_el)
-        elif sib_el.tag in SECTION_TAG:
-            break
-        else:
-            logging.error('Saw unrecognized tag "%s"', sib_el.tag)
-
-    remove_node(paragraph)
-
-def edit_table(table_item):
+def edit_table(table_item, ctx: MogrifyContext):
     ''' Removes items from table or whole table depending on the operation
     '''
     if table_item['op'] == 'COLUMN':
-        for cell in table_item['column'].cells:
-            remove_node(cell)
+        grid = table_item['grid']
+        for element in grid.remove_columns(grid.get_columns(table_item['cell']._tc)):
+            remove_node(element, ctx)
 
     if table_item['op'] == 'ROW':
-        remove_node(table_item['row'])
+        remove_node(table_item['row'], ctx)
 
     if table_item['op'] == 'TABLE':
-        remove_node(table_item['table'])
+        remove_node(table_item['table'], ctx)
 
-def get_column(table: Table, table_cell):
-    ''' Determins the column of a cell within a table
-    '''
-    for column in table.columns:
-        for cell in column.cells:
-            if cell.text == table_cell.text:
-                return column
+def get_op(text: str) -> str:
+    tokens = utils.remove_empty_strings(re.split(r'\W+', text))
+    return tokens[0] if tokens else ''
 
-def create_control_structures(doc):
-    ''' Sets up the control structure for Sections and Tables
+def get_table_location(table: Table, grid: TableGrid, tr, tc) -> Dict:
+    ''' Table, row, grid column and cell of an annotation in a table
+    '''
+    _, column, _ = grid.positions[tc]
+
+    return {
+        'table': table,
+        'grid': grid,
+        'row': _Row(tr, table),
+        'column': column,
+        'cell': _Cell(tc, table),
+    }
+
+def scan_document(doc) -> Dict:
+    ''' Walks the document body once and collects everything the mogrifier
+        passes act on:
+        - control_structure: the annotations, see create_control_structures
+        - run_op_lookup: annotation run element -> annotation (outside of tables)
+        - info_boxes, instr_boxes: info and instruction box paragraph elements
+        - toggle_runs: all toggle styled run elements
+        - styles: the document's styles.StyleTable
+        - outlines: section extents for remove_section, see outline.OutlineIndex
+
+        mogrify_doc adds the UNITS annotations (units, see get_unit_ops) and
+        the unit system selection (unit_selection, see get_unit_selection)
+        once the annotations are compiled, unless a template provided them.
+
+        As before, only paragraphs in the body and in the cells of top level
+        tables are considered.
     '''
-    control_structures = []
-    run_op_lookup = {}
-
-    current = None
-
-    ## Sections
-    for para in doc.paragraphs:
-        for run in para.runs:
-            if (
-                (current and run.style.name != ANNOTATION_STYLE)
-                or
-                (current and para is not current['paragraph'])
-            ):
-                current['text'] = current['text'].strip()
-                if current['text']:
-                    control_structures.append(current)
-                current = None
-                
-            if not current and run.style.name == ANNOTATION_STYLE:
+    styles = StyleTable(doc)
+
+    scan = {
+        'control_structure': [],
+        'run_op_lookup': {},
+        'info_boxes': [],
+        'instr_boxes': [],
+        'toggle_runs': [],
+        'styles': styles,
+        'outlines': OutlineIndex(styles),
+    }
+
+    def close(current):
+        current['text'] = current['text'].strip()
+        if current['text']:
+            current['op'] = get_op(current['text'])
+            scan['control_structure'].append(current)
+
+    def scan_paragraph(p, parent, table_location=None):
+        # proxies are only built for paragraphs holding annotations
+        paragraph = None
+        current = None
+
+        for r in p.iterchildren(R_TAG):
+            if not styles.character(get_run_style_id(r)).is_toggle:
+                if current:
+                    close(current)
+                    current = None
+                continue
+
+            scan['toggle_runs'].append(r)
+            if paragraph is None:
+                paragraph = Paragraph(p, parent)
+            run = Run(r, paragraph)
+
+            if not current:
                 current = {
-                    'paragraph': para,
+                    'paragraph': paragraph,
                     'text': '',
                     'runs': [],
                 }
-                run_op_lookup[run.element] = current
-
-            if current and run.style.name == ANNOTATION_STYLE:
-                run_op_lookup[run.element] = current
-                current['runs'].append(run)
-                current['text'] += run.text
-
-    ## Tables
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for para in cell.paragraphs:
-                    for run in para.runs:
-                        if (
-                            (current and run.style.name != ANNOTATION_STYLE)
-                            or
-                            (current and para is not current['paragraph'])
-                        ):
-                            current['text'] = current['text'].strip()
-                            if current['text']:
-                                control_structures.append(current)
-                            current = None
-
-                        if not current and run.style.name == ANNOTATION_STYLE:
-                            current = {
-                                'paragraph': para,
-                                'text': '',
-                                'runs': [],
-                                'table': table,
-                                'row': row,
-                                'column': get_column(table, cell),
-                                'cell': cell,
-                            }
-                            run.op = current
-
-                        if current and run.style.name == ANNOTATION_STYLE:
-                            run.op = current
-                            current['runs'].append(run)
-                            current['text'] += run.text
-
-    for op in control_structures:
-        tokens = utils.remove_empty_strings(re.split(r'\W+', op['text']))
-        if tokens:
-            op['op'] = tokens[0]
-        else:
-            op['op'] = ''
-
-    # Debugging
-    # for op in control_structures:
-    #     logging.info(op)
-
-    return control_structures, run_op_lookup
-
-def remove_info_and_instr_boxes(doc, selections: Selections):
+                if table_location:
+                    current.update(table_location())
+
+            if not table_location:
+                scan['run_op_lookup'][r] = current
+            current['runs'].append(run)
+            current['text'] += run.text
+
+        if current:
+            close(current)
+
+    body = doc._body
+    for element in body._element.iterchildren(P_TAG, TABLE_TAG):
+        if element.tag == P_TAG:
+            style = styles.paragraph(get_paragraph_style_id(element))
+            if style.is_info_box:
+                scan['info_boxes'].append(element)
+            if style.is_instr_box:
+                scan['instr_boxes'].append(element)
+            scan_paragraph(element, body)
+            continue
+
+        table = Table(element, body)
+        grid = TableGrid(element)
+        for tr in element.iterchildren(TR_TAG):
+            for tc in tr.iterchildren(TC_TAG):
+                for p in tc.iterchildren(P_TAG):
+                    scan_paragraph(p, table, lambda: get_table_location(table, grid, tr, tc))
+
+    return scan
+
+def create_control_structures(doc):
+    ''' Sets up the control structure for Sections and Tables
+    '''
+    scan = scan_document(doc)
+
+    return scan['control_structure'], scan['run_op_lookup']
+
+def remove_info_and_instr_boxes(selections: Selections, ctx: MogrifyContext):
     ''' Removes info and instruction boxes
     '''
-    info_box_styles = ['Info. box', 'InfoboxList', 'InfoTableTitle']
-    instr_box_style = 'Instr. box'
+    if utils.reduce_to_boolean(selections['DEL_INFO_BOX']):
+        for para in ctx.scan['info_boxes']:
+            remove_node(para, ctx)
 
-    for para in doc.paragraphs:
-        if utils.reduce_to_boolean(selections['DEL_INFO_BOX']) and para.style.name in info_box_styles:
-            remove_node(para)
-        if para.style.name == instr_box_style:
-            remove_node(para)
+    for para in ctx.scan['instr_boxes']:
+        remove_node(para, ctx)
 
 def evaluate_annotation(op, name_map, selections: Selections):
     '''
@@ -243,185 +221,24 @@ def evaluate_annotation(op, name_map, selections: Selections):
         + `[OR [any toggle] [any toggle]]` - Keep this section if one of the nested toggles would keep the section. The nested toggles can be any of these toggles including AND or OR. Otherwise remove.
         + `[DELETE]` - Remove this section.
     '''
-    if op['op'] == 'YES':
-        # 1: map short name to long name
-        tokens = utils.remove_empty_strings(re.split(r'\W+', op['text']))
-        if len(tokens) == 2:
-            short_name = tokens[1]
-        else:
-            logging.error('Invalid operation: %s, deleting', op['text'])
-            return True
+    compiler = AnnotationCompiler(name_map)
+    expression = compiler.compile(op['text'])
+    if not isinstance(expression, Condition):
+        return False
 
-        if short_name not in name_map:
-            logging.error('%s not found, deleting', short_name)
-            return True
-            
-        long_name = name_map[short_name]
-
-        # 2: check if relevant selection is available
-        if long_name not in selections:
-            logging.error('Path "%s" not found in store, deleting', long_name)
-            return True
-        # 3: apply the operation type
-        elif not utils.reduce_to_boolean(selections[long_name]):
-            return True
-            
-    if op['op'] == 'NO':
-        tokens = utils.remove_empty_strings(re.split(r'\W+', op['text']))
-        if len(tokens) == 2:
-            short_name = tokens[1]
-        else:
-            logging.error('Invalid operation: %s, deleting', op['text'])
-            return True
+    selection_set = SelectionSet(selections)
+    deletes = selection_set.deletes(expression)
+    selection_set.diagnostics.emit()
 
-        if short_name not in name_map:
-            logging.error('%s not found, deleting', short_name)
-            return True
-            
-        long_name = name_map[short_name]
-
-        if long_name not in selections:
-            logging.error('Path "%s" not found in store, deleting', long_name)
-            return True
-        elif utils.reduce_to_boolean(selections[long_name]):
-            return True
-
-    if op['op'] == 'EQUALS':
-        tokens = utils.remove_empty_strings(re.split(r'\W+', op['text']))
-        if len(tokens) == 3:
-            short_name = tokens[1]
-            short_compare = tokens[2]
-        else:
-            logging.error('Invalid operation: %s, deleting', op['text'])
-            return True
-        
-        if short_name not in name_map:
-            logging.error('%s not found, deleting', short_name)
-            return True
-
-        if short_compare not in name_map:
-            logging.error('%s not found, deleting', short_compare)
-            return True
-
-        long_name = name_map[short_name]
-        long_compare = name_map[short_compare]
-                
-        if long_name not in selections:
-            logging.error('Path "%s" not found in store, deleting', long_name)
-            return True
-        elif long_compare not in selections[long_name]:
-            return True
-
-    if op['op'] == 'NOT_EQUALS':
-        tokens = utils.remove_empty_strings(re.split(r'\W+', op['text']))
-        if len(tokens) == 3:
-            short_name = tokens[1]
-            short_compare = tokens[2]
-        else:
-            logging.error('Invalid operation: %s, deleting', op['text'])
-            return True
-        
-        if short_name not in name_map:
-            logging.error('%s not found, deleting', short_name)
-            return True
-
-        if short_compare not in name_map:
-            logging.error('%s not found, keeping', short_compare)
-            return False
-
-        long_name = name_map[short_name]
-        long_compare = name_map[short_compare]
-                
-        if long_name not in selections:
-            logging.error('Path "%s" not found in store, keeping', long_name)
-            return False
-        elif long_compare in selections[long_name]:
-            return True
-            
-    if op['op'] == 'ANY':
-        tokens = [token for token in re.split(r'\W+', op['text']) if token]
-        if len(tokens) >= 3:
-            short_name = tokens[1]
-            short_compare = tokens[2:]
-        else:
-            logging.error('Invalid operation: %s, deleting', op['text'])
-            return True
+    return deletes
 
-        if short_name not in name_map:
-            logging.error('%s not found, deleting', short_name)
-            return True
-            
-        long_name = name_map[short_name]
-        long_compare = map(lambda name: name_map[name], short_compare)
-                
-        if long_name not in selections:
-            logging.error('Path "%s" not found in store, deleting', long_name)
-            return True
-        elif not utils.common_member(selections[long_name], long_compare):
-            return True
-            
-    if op['op'] == 'DELETE':
-        return True
-
-    if op['op'] == 'AND':
-        match = re.match(r'\[AND \[(.+)] \[(.+)]]', op['text'])
-        if not match:
-            logging.error('Invalid format for tag:  %s, deleting', op['text'])
-            return True
-
-        condition_one = condition_two = False
-        group_one_tokens = re.split(r'\W+', match.group(1))
-        group_one_op = group_one_tokens[0]
-        group_two_tokens = re.split(r'\W+', match.group(2))
-        group_two_op = group_two_tokens[0]
-
-        if group_one_op in OP_LIST:
-            nested_op = {**op, 'text': f'[{match.group(1)}]', 'op': group_one_op}
-            condition_one = evaluate_annotation(nested_op, name_map, selections)
-        else:
-            logging.error('Invalid operation: %s, deleting', group_one_op)
-            return True
-
-        if group_two_op in OP_LIST:
-            nested_op = {**op, 'text': f'[{match.group(2)}]', 'op': group_two_op}
-            condition_two = evaluate_annotation(nested_op, name_map, selections)
-        else:
-            logging.error('Invalid operation: %s, deleting', group_two_op)
-            return True
-
-        return condition_one or condition_two
-
-    if op['op'] == 'OR':
-        match = re.match(r'\[OR \[(.+)] \[(.+)]]', op['text'])
-        if not match:
-            logging.error('Invalid format for tag:  %s, deleting', op['text'])
-            return True
-
-        condition_one = condition_two = False
-        group_one_tokens = re.split(r'\W+', match.group(1))
-        group_one_op = group_one_tokens[0]
-        group_two_tokens = re.split(r'\W+', match.group(2))
-        group_two_op = group_two_tokens[0]
-
-        if group_one_op in OP_LIST:
-            nested_op = {**op, 'text': f'[{match.group(1)}]', 'op': group_one_op}
-            condition_one = evaluate_annotation(nested_op, name_map, selections)
-        else:
-            logging.error('Invalid operation: %s, deleting', group_one_op)
-            return True
-
-        if group_two_op in OP_LIST:
-            nested_op = {**op, 'text': f'[{match.group(2)}]', 'op': group_two_op}
-            condition_two = evaluate_annotation(nested_op, name_map, selections)
-        else:
-            logging.error('Invalid operation: %s, deleting', group_two_op)
-            return True
-
-        return condition_one and condition_two
-
-    return False
-
-def apply_selections(control_structure, name_map, run_op_lookup, selections: Selections):
+def compile_annotations(control_structure, compiler: AnnotationCompiler):
+    ''' Compiles the text of each annotation into an expression (see expression.py)
+    '''
+    for op in control_structure:
+        op['expression'] = compiler.compile(op['text'])
+
+def apply_selections(control_structure, selections: SelectionSet, ctx: MogrifyContext):
     ''' 
         Determines how to handle toggles, section vs table
 
@@ -441,111 +258,140 @@ def apply_selections(control_structure, name_map, run_op_lookup, selections: Sel
         + `[COLUMN YES have_CO2Sen]` - Keep this column if a CO2 sensor is present. Otherwise remove.
         + `[COLUMN AND [any toggle] [any toggle]]` - Keep this column if both nested toggles would keep the column. Otherwise remove.
     '''
+    outlines = ctx.scan['outlines']
     for op in control_structure:
-        if op['op'] in OP_LIST:
-            if evaluate_annotation(op, name_map, selections):
-                remove_section(op['paragraph'], run_op_lookup)
+        expression = op['expression']
 
-        if op['op'] in TABLE_OP_LIST:
-            text_op = op['text'].replace(f"{op['op']} ", "")
-            tokens = utils.remove_empty_strings(re.split(r'\W+', text_op))
-            next_op = tokens[0]
+        if isinstance(expression, Condition):
+            if selections.deletes(expression):
+                remove_section(op['paragraph'], outlines)
 
-            if next_op in OP_LIST:
-                table_op = {**op, 'text': text_op, 'op': next_op}
-                if evaluate_annotation(table_op, name_map, selections):
-                    edit_table(op)
-            else:
-                logging.error('Invlaid format for tag: %s', op['text'])
+        if isinstance(expression, TableToggle):
+            if 'table' not in op:
+                ctx.diagnostics.error('Table tag outside of a table: %s', op['text'])
+            elif selections.deletes(expression.condition):
+                edit_table(op, ctx)
 
+    for element in outlines.removed_elements():
+        remove_element(element, ctx)
 
     # return not necessary - just reinforcing that control_structure is what is modified
     return control_structure
 
-def convert_units(control_structure, name_map, selections: Selections):
-    ''' Based on unit selection, goes through doc to update
+def get_unit_selection(name_map, diagnostics: Diagnostics) -> Optional[Tuple[str, Dict[str, str]]]:
+    ''' The long name of the unit system selection and the unit system ('SI'
+        or 'IP') each of its values stands for, or None (after reporting why)
+        if the name map lacks one of them. Depends on the name map only, so
+        templates work it out once (see template.Template).
     '''
-    short_name = "UNITS"
-    si_short_name = "SI"
-    ip_short_name = "IP"
+    for short_name in [UNITS_OP] + UNIT_SYSTEMS:
+        if short_name not in name_map:
+            diagnostics.error('%s not found', short_name)
+            return None
 
-    if short_name not in name_map:
-        logging.error('%s not found', short_name)
-        return
-    if si_short_name not in name_map:
-        logging.error('%s not found', si_short_name)
-        return
-    if ip_short_name not in name_map:
-        logging.error('%s not found', ip_short_name)
-        return
+    return name_map[UNITS_OP], {name_map[system]: system for system in UNIT_SYSTEMS}
 
-    long_name = name_map[short_name]
-    si_long_name = name_map[si_short_name]
-    ip_long_name = name_map[ip_short_name]
+def get_unit_system(unit_selection: Optional[Tuple[str, Dict[str, str]]], selections: Selections, diagnostics: Diagnostics) -> Optional[str]:
+    ''' The selected unit system, 'SI' or 'IP', or None (after reporting why)
+        if it can't be determined. unit_selection is from get_unit_selection.
+    '''
+    if unit_selection is None:
+        return None
 
+    long_name, unit_systems = unit_selection
     if long_name not in selections:
-        logging.error('Path "%s" not found in store', long_name)
+        diagnostics.error('Path "%s" not found in store', long_name)
+        return None
+
+    value = selections[long_name][0]
+    unit_system = unit_systems.get(value) if isinstance(value, str) else None
+    if unit_system is None:
+        diagnostics.error('"%s" is not a valid unit system', value)
+
+    return unit_system
+
+def get_unit_text(units: Units, unit_system: str) -> str:
+    return units.si_text if unit_system == 'SI' else units.ip_text
+
+def get_unit_ops(control_structure) -> List[Dict]:
+    ''' The UNITS annotations of a control structure. Malformed UNITS tags
+        are reported when compiled.
+    '''
+    return [op for op in control_structure if isinstance(op['expression'], Units)]
+
+def convert_units(units: List[Dict], unit_selection, selections: Selections, diagnostics: Diagnostics):
+    ''' Replaces the first run of each UNITS annotation (see get_unit_ops)
+        with its text for the selected unit system
+    '''
+    if not units:
+        return
+    unit_system = get_unit_system(unit_selection, selections, diagnostics)
+    if unit_system is None:
         return
 
-    for op in control_structure:
-        if op['op'] == short_name:
-            match = re.match(r'\[UNITS \[(.+)] \[(.+)]]', op['text'])
-            if not match:
-                logging.error('Invalid format for tag:  %s', op['text'])
-                continue
-            unit_selection = selections[long_name][0]
-            if unit_selection == si_long_name:
-                # TODO: use this as an approach for 'writes' to the docx 
-                op['runs'][0].text = match.group(1)
-                op['runs'][0].style = None
-            elif unit_selection == ip_long_name:
-                op['runs'][0].text = match.group(2)
-                op['runs'][0].style = None
-            else:
-                logging.error('"%s" is not a valid unit system', unit_selection)
-
-def remove_toggles(doc):
+    for op in units:
+        # TODO: use this as an approach for 'writes' to the docx
+        op['runs'][0].text = get_unit_text(op['expression'], unit_system)
+        op['runs'][0].style = None
+
+def remove_toggles(ctx: MogrifyContext):
     ''' Step through and remove 'toggle' text
     '''
-    for para in doc.paragraphs:
-        for run in para.runs:
-            if run.style.name == ANNOTATION_STYLE:
-                remove_node(run)
-
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for para in cell.paragraphs:
-                    for run in para.runs:
-                        if run.style.name == ANNOTATION_STYLE:
-                            remove_node(run)
-
-def mogrify_doc(doc: Document, name_map: Dict, selections: Selections) -> Document:
+    for run in ctx.scan['toggle_runs']:
+        # convert_units keeps a run by clearing its toggle style
+        if get_run_style_id(run):
+            remove_node(run, ctx)
+
+def mogrify_doc(doc: Document, name_map: Dict, selections: Selections, ctx: MogrifyContext = None) -> Document:
     ''' Applies selections to the provided document. This mutates the provided
         document
+
+        ctx holds the state of the run. A scan of doc can be handed over in it
+        (see template.Template.instantiate), otherwise doc is scanned here.
+        The time of each pass and counters are recorded in ctx.stats.
     '''
-    initialize_remove_list()
+    if ctx is None:
+        ctx = MogrifyContext()
+    stats = ctx.stats
     # walk through source_doc to find each conditional point in the doc
-    control_structure, run_op_lookup = create_control_structures(doc)
-
-    # Remove info and Instruction Boxes - updates remove_list internally
-    remove_info_and_instr_boxes(doc, selections)
+    if ctx.scan is None:
+        with stats.phase('create_control_structures'):
+            ctx.scan = scan_document(doc)
+    control_structure = ctx.scan['control_structure']
+    if any('expression' not in op for op in control_structure):
+        with stats.phase('create_control_structures'):
+            compiler = AnnotationCompiler(name_map, ctx.diagnostics)
+            compile_annotations(control_structure, compiler)
+        stats.count_compile_errors(compiler)
+    stats.count_annotations(control_structure)
+
+    # Remove info and Instruction Boxes - updates the deletion plan
+    with stats.phase('remove_info_and_instr_boxes'):
+        remove_info_and_instr_boxes(selections, ctx)
 
     # apply all paragraph and table selections
-    apply_selections(control_structure, name_map, run_op_lookup, selections)
+    with stats.phase('apply_selections'):
+        apply_selections(control_structure, SelectionSet(selections, ctx.diagnostics), ctx)
 
-    # convert units
-    convert_units(control_structure, name_map, selections)
+    # convert units, with the UNITS annotations and unit system selection
+    # found when the template was loaded if it was
+    with stats.phase('convert_units'):
+        if 'units' not in ctx.scan:
+            ctx.scan['units'] = get_unit_ops(control_structure)
+            ctx.scan['unit_selection'] = get_unit_selection(name_map, ctx.diagnostics) if ctx.scan['units'] else None
+        convert_units(ctx.scan['units'], ctx.scan['unit_selection'], selections, ctx.diagnostics)
 
     # remove toggle text
-    remove_toggles(doc)
+    with stats.phase('remove_toggles'):
+        remove_toggles(ctx)
 
     # finally remove all nodes flagged for deletion
-    for el in elements_to_delete:
-        try:
-            el.getparent().remove(el)
-        except AttributeError:
-            logging.info('Element "%s" was already gone', el)
-            pass
+    with stats.phase('apply_deletions'):
+        stats.count('elements_scheduled', len(ctx.deletions))
+        stats.count('elements_deleted', ctx.deletions.apply())
+
+    # problems seen during the run, logged once each
+    stats.count_diagnostics(ctx.diagnostics)
+    ctx.diagnostics.emit()
 
     return doc
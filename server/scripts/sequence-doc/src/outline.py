@@ -0,0 +1,141 @@
+'''
+Section extents used when a toggle deletes a paragraph. Deleting a paragraph
+deletes its section: every following sibling up to the next paragraph with the
+same or a higher heading level (any paragraph for a body text paragraph) or the
+end of the document section. Info box paragraphs are deleted on their own.
+
+An Outline holds, for each child of a container (the document body or a table
+cell), the end of the section starting there, so deleting a section is a range
+lookup. Outlines only depend on the template and are shared by its copies.
+'''
+from typing import Dict, Iterator, List, Tuple
+from diagnostics import Diagnostics
+from styles import BODY_TEXT_LEVEL, StyleTable
+
+P_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}p'
+BOOKMARK_TAGS = ['{http://schemas.openxmlformats.org/wordprocessingml/2006/main}bookmarkEnd', "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}bookmarkStart"]
+SECTION_TAG = ["{http://schemas.openxmlformats.org/wordprocessingml/2006/main}sectPr"]
+TABLE_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tbl'
+# properties of a table cell container, never deleted with a section
+TCPR_TAG = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}tcPr'
+
+class Outline:
+    ''' Section extents of the children of one container.
+        ends[i] is the (exclusive) index where the section starting at child i
+        ends and deletable[i] tells if child i is removed along with a section
+        spanning it (paragraphs, tables and bookmarks).
+    '''
+    def __init__(self, ends: List[int], deletable: List[bool]):
+        self.ends = ends
+        self.deletable = deletable
+
+    def section(self, index: int) -> Iterator[int]:
+        ''' Indexes of the children deleted with the section starting at index
+        '''
+        yield index
+        for position in range(index + 1, self.ends[index]):
+            if self.deletable[position]:
+                yield position
+
+def build_outline(elements: List, get_level) -> Outline:
+    ''' Computes the extents of every section within elements, the children of a
+        container. get_level returns the heading level of a paragraph element
+        or None for an info box.
+    '''
+    count = len(elements)
+    ends = [count] * count
+    deletable = [False] * count
+    # (level, index) of the following paragraphs and section properties that can
+    # end a section, levels never decrease towards the top of the stack
+    stops: List[Tuple[int, int]] = []
+    diagnostics = Diagnostics()
+
+    for index in range(count - 1, -1, -1):
+        element = elements[index]
+        if element.tag == P_TAG:
+            deletable[index] = True
+            level = get_level(element)
+            info_box = level is None
+            if info_box:
+                level = BODY_TEXT_LEVEL
+            while stops and stops[-1][0] > level:
+                stops.pop()
+            if info_box:
+                ends[index] = index + 1
+            elif stops:
+                ends[index] = stops[-1][1]
+            stops.append((level, index))
+        elif element.tag == TABLE_TAG or element.tag in BOOKMARK_TAGS:
+            # Assume table matches indentation of parent paragraph
+            deletable[index] = True
+        elif element.tag in SECTION_TAG:
+            stops = [(-1, index)]
+        elif element.tag == TCPR_TAG:
+            pass
+        else:
+            diagnostics.error('Saw unrecognized tag "%s"', element.tag)
+
+    diagnostics.emit()
+    return Outline(ends, deletable)
+
+class OutlineIndex:
+    ''' Outlines of the containers of one document, built as sections get deleted
+        (or handed over by a template), and the sections deleted so far.
+        Sections nested in another deleted section collapse into it.
+    '''
+    def __init__(self, styles: StyleTable, outlines: Dict = None):
+        self.styles = styles
+        self._outlines = dict(outlines or {})
+        self._children = {}
+        self._positions = {}
+        self._sections = {}
+
+    def get_level(self, p):
+        ''' Heading level of a paragraph element, None for info boxes
+        '''
+        style = self.styles.paragraph(p.style)
+        if style.is_info_box:
+            return None
+        return style.heading_level
+
+    def get_outline(self, container) -> Outline:
+        outline = self._outlines.get(container)
+        if outline is None:
+            outline = self._outlines[container] = build_outline(self._get_children(container), self.get_level)
+        return outline
+
+    def _get_children(self, container) -> List:
+        children = self._children.get(container)
+        if children is None:
+            children = self._children[container] = list(container)
+        return children
+
+    def _get_position(self, container, element) -> int:
+        positions = self._positions.get(container)
+        if positions is None:
+            positions = self._positions[container] = {
+                child: index for index, child in enumerate(self._get_children(container))
+            }
+        return positions[element]
+
+    def remove_section(self, p):
+        ''' Marks the section starting at paragraph element p for deletion
+        '''
+        container = p.getparent()
+        self.get_outline(container)
+        self._sections.setdefault(container, set()).add(self._get_position(container, p))
+
+    def removed_elements(self) -> Iterator:
+        ''' Elements of every section marked for deletion
+        '''
+        for container, starts in self._sections.items():
+            outline = self._outlines[container]
+            children = self._children[container]
+            end = -1
+            for start in sorted(starts):
+                if start < end:
+                    # nested in the previous section
+                    continue
+                end = outline.ends[start]
+                for position in outline.section(start):
+                    yield children[position]
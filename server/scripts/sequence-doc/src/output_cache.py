@@ -0,0 +1,106 @@
+'''
+On-disk cache of generated documents. Documents are stored under a hash of
+what they are generated from: the version, the digest of the version's files
+and the selections its annotations actually read (see
+template.Template.get_relevant_selections), so selections the document doesn't
+depend on don't cause misses.
+
+The cache is bounded in size, evicting the least recently used documents. It
+can be shared by several processes (e.g. the batch mode workers).
+'''
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional
+from template import Template
+
+# bump when the generated output changes for the same inputs
+CACHE_FORMAT = 2
+CACHE_DIR_ENV = 'SEQUENCE_DOC_CACHE_DIR'
+DEFAULT_CACHE_SIZE = 512 * 1024 * 1024
+FILE_SUFFIX = '.docx'
+
+def get_cache_key(version: str, template: Template, selections: dict, *packaging) -> str:
+    ''' packaging: options changing the bytes but not the content of the document
+    '''
+    canonical = json.dumps({
+        'format': CACHE_FORMAT,
+        'version': version,
+        'template': template.digest,
+        'packaging': packaging,
+        'selections': template.get_relevant_selections(selections),
+    }, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class OutputCache:
+    ''' Size bounded least recently used store of documents. Reading an entry
+        updates its modification time, which orders the entries for eviction.
+    '''
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / (key + FILE_SUFFIX)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return data
+
+    def put(self, key: str, data: bytes):
+        # written to a temporary file first so readers never see a partial document
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(temp_path, self._path(key))
+
+        self.evict()
+
+    def evict(self):
+        ''' Removes the least recently used documents until the cache fits in max_size
+        '''
+        entries = []
+        for path in self.directory.glob('*' + FILE_SUFFIX):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                # removed by another process
+                pass
+            size -= file_size
+
+    def __len__(self):
+        return sum(1 for _ in self.directory.glob('*' + FILE_SUFFIX))
+
+output_cache: Optional[OutputCache] = None
+
+def configure(directory: Optional[str], max_size: int = DEFAULT_CACHE_SIZE):
+    ''' Sets (or with no directory, disables) the cache used by generate_doc.generate_doc_bytes
+    '''
+    global output_cache
+    output_cache = OutputCache(directory, max_size) if directory else None
+    if output_cache:
+        logging.info('Caching generated documents in %s', directory)
+
+def get_output_cache() -> Optional[OutputCache]:
+    return output_cache
@@ -0,0 +1,176 @@
+'''
+Previews of a generated document without building or packaging a docx: the
+text of the paragraphs and tables that survive the selections, read straight
+from the template and filtered with the keep-mask of a RenderSession (see
+incremental.py).
+
+The outline is a sequence of blocks, written as JSON lines so a client can
+render them as they arrive:
+
+    {"type": "heading", "level": 2, "style": "Heading 2", "text": "..."}
+    {"type": "paragraph", "style": "Normal", "text": "..."}
+    {"type": "table", "rows": [["cell text", ...], ...]}
+
+Empty paragraphs are left out.
+'''
+import html
+import json
+import weakref
+from typing import Dict, Iterator, List, Optional, TextIO
+from docx.oxml.ns import qn
+from diagnostics import Diagnostics
+from incremental import RenderSession
+from mogrifier import get_unit_system, get_unit_text
+from styles import BODY_TEXT_LEVEL
+from template import Template, get_element_path
+
+P_TAG = qn('w:p')
+TABLE_TAG = qn('w:tbl')
+TR_TAG = qn('w:tr')
+TC_TAG = qn('w:tc')
+R_TAG = qn('w:r')
+HYPERLINK_TAG = qn('w:hyperlink')
+
+# headings deeper than this are rendered as <h6>
+MAX_HTML_HEADING = 6
+
+# template structure used by previews, per template
+preview_models = weakref.WeakKeyDictionary()
+
+def get_paragraph_model(p, styles) -> Dict:
+    style = styles.paragraph(p.style)
+    runs = []
+    for child in p:
+        if child.tag == R_TAG:
+            runs.append((get_element_path(child), child.text))
+        elif child.tag == HYPERLINK_TAG:
+            runs.extend((get_element_path(r), r.text) for r in child.iterchildren(R_TAG))
+
+    return {
+        'type': 'paragraph',
+        'path': get_element_path(p),
+        'style': style.name,
+        'level': style.heading_level,
+        'runs': runs,
+    }
+
+def get_preview_model(template: Template) -> List[Dict]:
+    ''' Paragraphs (with the text of their runs) and tables of the template's
+        body, with the paths they are hidden by
+    '''
+    model = preview_models.get(template)
+    if model is not None:
+        return model
+
+    model = []
+    for element in template.document.element.body:
+        if element.tag == P_TAG:
+            model.append(get_paragraph_model(element, template.styles))
+        elif element.tag == TABLE_TAG:
+            model.append({
+                'type': 'table',
+                'path': get_element_path(element),
+                'rows': [
+                    {
+                        'path': get_element_path(tr),
+                        'cells': [
+                            {
+                                'path': get_element_path(tc),
+                                'paragraphs': [get_paragraph_model(p, template.styles) for p in tc.iterchildren(P_TAG)],
+                            }
+                            for tc in tr.iterchildren(TC_TAG)
+                        ],
+                    }
+                    for tr in element.iterchildren(TR_TAG)
+                ],
+            })
+
+    preview_models[template] = model
+    return model
+
+def get_unit_texts(session: RenderSession, diagnostics: Diagnostics) -> Dict[tuple, str]:
+    ''' Text replacing the first run of each UNITS annotation
+    '''
+    template = session.template
+    if not template.unit_annotations:
+        return {}
+
+    unit_system = get_unit_system(template.unit_selection, session.selections, diagnostics)
+    if unit_system is None:
+        return {}
+
+    return {
+        template.annotations[position]['runs'][0]: get_unit_text(template.annotations[position]['expression'], unit_system)
+        for position in template.unit_annotations
+    }
+
+def get_paragraph_text(paragraph: Dict, hidden, unit_texts: Dict) -> str:
+    text = []
+    for path, run_text in paragraph['runs']:
+        if path in unit_texts:
+            text.append(unit_texts[path])
+        elif path not in hidden:
+            text.append(run_text)
+
+    return ''.join(text).strip()
+
+def get_outline(session: RenderSession, diagnostics: Optional[Diagnostics] = None) -> Iterator[Dict]:
+    ''' The blocks of the document generated for the session's selections
+    '''
+    diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+    hidden = session.mask
+    unit_texts = get_unit_texts(session, diagnostics)
+
+    for block in get_preview_model(session.template):
+        if block['path'] in hidden:
+            continue
+
+        if block['type'] == 'paragraph':
+            text = get_paragraph_text(block, hidden, unit_texts)
+            if not text:
+                continue
+            if block['level'] == BODY_TEXT_LEVEL:
+                yield {'type': 'paragraph', 'style': block['style'], 'text': text}
+            else:
+                yield {'type': 'heading', 'level': block['level'], 'style': block['style'], 'text': text}
+            continue
+
+        rows = []
+        for row in block['rows']:
+            if row['path'] in hidden:
+                continue
+            cells = []
+            for cell in row['cells']:
+                if cell['path'] in hidden:
+                    continue
+                texts = (
+                    get_paragraph_text(paragraph, hidden, unit_texts)
+                    for paragraph in cell['paragraphs'] if paragraph['path'] not in hidden
+                )
+                cells.append('\n'.join(text for text in texts if text))
+            if cells:
+                rows.append(cells)
+        if rows:
+            yield {'type': 'table', 'rows': rows}
+
+def write_outline(blocks: Iterator[Dict], output: TextIO):
+    for block in blocks:
+        output.write(json.dumps(block) + '\n')
+
+def write_html(blocks: Iterator[Dict], output: TextIO):
+    ''' Writes the blocks as a plain html fragment
+    '''
+    for block in blocks:
+        if block['type'] == 'heading':
+            tag = f"h{min(block['level'], MAX_HTML_HEADING)}"
+            output.write(f"<{tag}>{html.escape(block['text'])}</{tag}>\n")
+        elif block['type'] == 'paragraph':
+            output.write(f"<p>{html.escape(block['text'])}</p>\n")
+        else:
+            output.write('<table>\n')
+            for row in block['rows']:
+                cells = ''.join(
+                    '<td>{}</td>'.format(html.escape(text).replace('\n', '<br>')) for text in row
+                )
+                output.write(f'<tr>{cells}</tr>\n')
+            output.write('</table>\n')
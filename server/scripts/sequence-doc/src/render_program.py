@@ -0,0 +1,232 @@
+'''
+Render programs: keep-mask rendering (see keep_mask.py) compiled ahead of time.
+Most of a template's document part is the same in every generated document,
+only the elements annotations can hide or rewrite vary. A RenderProgram cuts the
+serialized document part at the boundaries of those elements into segments:
+
+    (start, stop, conditions, replacement)
+
+A segment is left out when any of its conditions holds. Conditions are:
+- ALWAYS: toggle text and instruction boxes
+- INFO_BOXES: info boxes, when DEL_INFO_BOX is selected
+- one per annotation: its section, table or row is deleted
+- one per cell and grid column of the tables with COLUMN toggles: all the grid
+  columns of the cell, or the grid column, were removed
+Segments with a replacement (converted unit runs and cells a COLUMN toggle may
+narrow) are written with the bytes chosen for the selections instead.
+
+Rendering evaluates the annotations and joins slices of the serialized document
+part: no xml is parsed or serialized and the template's document isn't needed.
+A program is compiled on first use, or stored in the template's bundle along
+with the serialized document part (see template.Template.save_bundle), in which
+case the slices are views of the mapped bundle.
+
+The output is byte for byte the document part mogrify_doc produces.
+'''
+from array import array
+from typing import Dict, FrozenSet, List, Optional, Set
+from diagnostics import Diagnostics
+from expression import Condition, TableToggle
+from keep_mask import evaluate_annotations, get_keep_mask_layout
+from mogrifier import get_unit_system
+from stats import GenerationStats
+from template import INFO_BOX_SELECTION, Template
+import utils
+
+ALWAYS = 0
+INFO_BOXES = 1
+FIRST_ANNOTATION = 2
+
+# a segment without replacement
+NO_REPLACEMENT = -1
+# a replacement choice keeping the segment's own bytes
+KEEP = object()
+
+class RenderProgram:
+    def __init__(self, template: Template):
+        layout = get_keep_mask_layout(template)
+        index = layout.index
+        self.data = index.data
+
+        # conditions leaving out each element, by path
+        conditions: Dict[tuple, Set[int]] = {}
+
+        def add_condition(paths, condition: int):
+            for path in paths:
+                conditions.setdefault(path, set()).add(condition)
+
+        self.replacements: List[Dict] = []
+        replaced: Dict[tuple, int] = {}
+
+        # converted units replace their first run instead of leaving it out
+        self.units = []
+        for path, variants in layout.units.items():
+            replaced[path] = len(self.replacements)
+            self.units.append(len(self.replacements))
+            self.replacements.append(variants)
+        add_condition((path for path in template.toggle_runs if path not in replaced), ALWAYS)
+        add_condition(template.instr_boxes, ALWAYS)
+        add_condition(template.info_boxes, INFO_BOXES)
+
+        for position, (located, effects) in enumerate(zip(template.annotations, layout.effects)):
+            expression = located['expression']
+            if isinstance(expression, Condition) or (isinstance(expression, TableToggle) and located['op'] != 'COLUMN'):
+                add_condition(effects, FIRST_ANNOTATION + position)
+
+        # cells and grid columns of the tables with COLUMN toggles, each with
+        # their own condition
+        self.condition_count = FIRST_ANNOTATION + len(template.annotations)
+        self.tables = {}
+        for table, table_layout in layout.tables.items():
+            cells = {}
+            for path, (start, span, narrowed) in table_layout['cells'].items():
+                replacement = NO_REPLACEMENT
+                if narrowed:
+                    replacement = replaced[narrowed['path']] = len(self.replacements)
+                    self.replacements.append(narrowed['variants'])
+                add_condition([path], self.condition_count)
+                cells[path] = (start, span, self.condition_count, replacement)
+                self.condition_count += 1
+            grid_columns = []
+            for path in table_layout['grid_columns']:
+                add_condition([path], self.condition_count)
+                grid_columns.append(self.condition_count)
+                self.condition_count += 1
+            self.tables[table] = {'cells': cells, 'grid_columns': grid_columns}
+
+        # the distinct sets of conditions of the segments
+        self.condition_sets: List[FrozenSet[int]] = []
+        set_numbers: Dict[FrozenSet[int], int] = {}
+        self.starts = array('I')
+        self.stops = array('I')
+        self.sets = array('I')
+        self.segment_replacements = array('i')
+
+        def add_segment(start: int, stop: int, segment_conditions: FrozenSet[int], replacement: int = NO_REPLACEMENT):
+            if start == stop:
+                return
+            number = set_numbers.get(segment_conditions)
+            if number is None:
+                number = set_numbers[segment_conditions] = len(self.condition_sets)
+                self.condition_sets.append(segment_conditions)
+            if (
+                replacement == NO_REPLACEMENT and self.stops and self.stops[-1] == start
+                and self.sets[-1] == number and self.segment_replacements[-1] == NO_REPLACEMENT
+            ):
+                self.stops[-1] = stop
+                return
+            self.starts.append(start)
+            self.stops.append(stop)
+            self.sets.append(number)
+            self.segment_replacements.append(replacement)
+
+        # positions of the children holding or being a hidden or replaced element
+        branches: Dict[tuple, Set[int]] = {}
+        for path in list(conditions) + list(replaced):
+            while path:
+                positions = branches.setdefault(path[:-1], set())
+                if path[-1] in positions:
+                    break
+                positions.add(path[-1])
+                path = path[:-1]
+
+        def compile_node(node: int, path: tuple, node_conditions: FrozenSet[int]):
+            cursor = index.starts[node]
+            children = index.children(node)
+            for position in sorted(branches.get(path, ())):
+                child = children[position]
+                child_path = path + (position,)
+                add_segment(cursor, index.starts[child], node_conditions)
+                child_conditions = node_conditions | conditions.get(child_path, frozenset())
+                if child_path in replaced:
+                    add_segment(index.starts[child], index.stops[child], child_conditions, replaced[child_path])
+                elif child_path in branches:
+                    compile_node(child, child_path, child_conditions)
+                else:
+                    add_segment(index.starts[child], index.stops[child], child_conditions)
+                cursor = index.stops[child]
+            add_segment(cursor, index.stops[node], node_conditions)
+
+        add_segment(0, index.starts[0], frozenset())
+        compile_node(0, (), frozenset())
+
+    def __getstate__(self) -> Dict:
+        # the serialized document part is stored on its own, see Template.save_bundle
+        return {name: value for name, value in self.__dict__.items() if name != 'data'}
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def render(self, template: Template, selections: Dict, diagnostics: Diagnostics) -> bytes:
+        ''' The document part generated for selections
+        '''
+        active = [False] * self.condition_count
+        active[ALWAYS] = True
+        active[INFO_BOXES] = utils.reduce_to_boolean(selections[INFO_BOX_SELECTION])
+
+        deletes, removed_columns = evaluate_annotations(template, self.tables, selections, diagnostics)
+        for position, deleted in enumerate(deletes):
+            if deleted:
+                active[FIRST_ANNOTATION + position] = True
+
+        choices = [KEEP] * len(self.replacements)
+        for table, columns in removed_columns.items():
+            for start, span, condition, replacement in self.tables[table]['cells'].values():
+                remaining = span - len(columns.intersection(range(start, start + span)))
+                if not remaining:
+                    active[condition] = True
+                elif remaining < span:
+                    choices[replacement] = self.replacements[replacement][remaining]
+            grid_columns = self.tables[table]['grid_columns']
+            for column in columns:
+                if column < len(grid_columns):
+                    active[grid_columns[column]] = True
+
+        # unit runs are toggle text unless the unit system is known
+        unit_system = get_unit_system(template.unit_selection, selections, diagnostics) if self.units else None
+        for replacement in self.units:
+            choices[replacement] = None if unit_system is None else self.replacements[replacement][unit_system]
+
+        hidden = [any(active[condition] for condition in conditions) for conditions in self.condition_sets]
+        data = memoryview(self.data)
+        output = []
+        for start, stop, number, replacement in zip(self.starts, self.stops, self.sets, self.segment_replacements):
+            if hidden[number]:
+                continue
+            if replacement != NO_REPLACEMENT and choices[replacement] is not KEEP:
+                if choices[replacement] is not None:
+                    output.append(choices[replacement])
+                continue
+            output.append(data[start:stop])
+
+        return b''.join(output)
+
+def get_render_program(template: Template) -> RenderProgram:
+    ''' The render program of a template, compiled on first use unless it was
+        loaded from the template's bundle
+    '''
+    if template.program is None:
+        template.program = RenderProgram(template)
+    return template.program
+
+def render_document_xml(template: Template, selections: Dict, stats: Optional[GenerationStats] = None) -> bytes:
+    ''' The document part generated for selections, see the module docstring.
+        Timings and counters are recorded in stats if given.
+    '''
+    if stats is None:
+        stats = GenerationStats()
+    diagnostics = Diagnostics()
+
+    with stats.phase('compile_program'):
+        program = get_render_program(template)
+    stats.count_compile_errors(template.compiler)
+    stats.count_annotations(template.annotations)
+    stats.count('segments', len(program))
+
+    with stats.phase('write_xml'):
+        data = program.render(template, selections, diagnostics)
+
+    stats.count_diagnostics(diagnostics)
+    diagnostics.emit()
+
+    return data
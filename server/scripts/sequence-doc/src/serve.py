@@ -0,0 +1,156 @@
+'''
+Long-running mode for the sequence document generator. Instead of starting a new
+python process per document, a single process reads a stream of jobs and writes
+back one response per job.
+
+Jobs and responses are framed as JSON lines (one JSON object per line):
+
+    job:      {"id": 1, "version": "Current G36 Decisions", "output": "/tmp/doc.docx", "selections": {...}}
+    response: {"id": 1, "status": "ok", "output": "/tmp/doc.docx"}
+
+If a job has no "output" the generated docx is returned base64 encoded in a
+"docx" field. "compression" and "compress_level" are optional, see
+generate_doc.generate_doc_bytes, and so is "renderer" ("mogrify", "mask" or
+"program", which generate the same document). Jobs with "format": "outline" get the preview
+blocks of the document (see preview.py) in an "outline" field instead. Jobs with
+"stats": true get the timings and counters of the generation (see stats.py) in
+a "stats" field. Failed jobs respond with "status": "error" and an "error" message.
+
+A job {"id": 2, "command": "templates"} gets the versions whose templates were
+requested, their estimated memory and usage (see template.TemplateCache.stats)
+in a "templates" field instead.
+
+Given a workers.WorkerPool, jobs are handed to its forked workers and answered
+as they complete, not necessarily in order; {"command": "workers"} gets the
+pool's stats.
+'''
+import base64
+import io
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from typing import TextIO
+from generate_doc import generate_doc_bytes, generate_preview, DEFAULT_DOC_VERSION
+from stats import GenerationStats
+from template import get_template_stats
+
+def run_job(job: dict) -> dict:
+    ''' Generates the document for a single job and builds its response
+    '''
+    response = {'id': job.get('id')}
+    start = time.perf_counter()
+    stats = GenerationStats()
+
+    try:
+        version = job.get('version') or DEFAULT_DOC_VERSION
+        if job.get('command') == 'templates':
+            response['templates'] = get_template_stats()
+        elif job.get('format') == 'outline':
+            response['outline'] = generate_preview(job['selections'], version, stats)
+        else:
+            data = generate_doc_bytes(
+                job['selections'],
+                version,
+                job.get('compression') or 'deflate',
+                job.get('compress_level'),
+                stats,
+                job.get('renderer') or 'mogrify',
+            )
+            output = job.get('output')
+            if output:
+                with open(output, 'wb') as fh:
+                    fh.write(data)
+                response['output'] = output
+            else:
+                response['docx'] = base64.b64encode(data).decode('ascii')
+        response['status'] = 'ok'
+    except Exception as e:
+        logging.exception('Job "%s" failed', job.get('id'))
+        response['status'] = 'error'
+        response['error'] = f'{type(e).__name__}: {e}'
+
+    response['seconds'] = round(time.perf_counter() - start, 4)
+    if job.get('stats'):
+        response['stats'] = stats.as_dict()
+
+    return response
+
+def serve_stream(input_stream: TextIO, output_stream: TextIO, pool=None):
+    ''' Handles jobs line by line until the input stream is closed and, with
+        a worker pool, the jobs submitted to it are answered
+    '''
+    lock = threading.Condition()
+    # jobs submitted to the pool and not answered yet
+    outstanding = 0
+
+    def respond(response: dict):
+        with lock:
+            output_stream.write(json.dumps(response) + '\n')
+            output_stream.flush()
+
+    def respond_submitted(response: dict):
+        nonlocal outstanding
+        respond(response)
+        with lock:
+            outstanding -= 1
+            lock.notify_all()
+
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError('job must be a JSON object')
+        except ValueError as e:
+            respond({'id': None, 'status': 'error', 'error': f'Invalid job: {e}'})
+            continue
+
+        if job.get('command') == 'workers':
+            if pool is None:
+                respond({'id': job.get('id'), 'status': 'error', 'error': 'Not running workers (see --workers)'})
+            else:
+                respond({'id': job.get('id'), 'status': 'ok', 'workers': pool.stats()})
+        elif pool is None:
+            respond(run_job(job))
+        else:
+            with lock:
+                outstanding += 1
+            pool.submit(job, respond_submitted)
+
+    with lock:
+        while outstanding:
+            lock.wait()
+
+class JobStreamHandler(socketserver.StreamRequestHandler):
+    ''' Serves the JSON lines protocol over a socket connection
+    '''
+    def handle(self):
+        input_stream = io.TextIOWrapper(self.rfile, encoding='utf-8')
+        output_stream = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+        serve_stream(input_stream, output_stream, self.server.pool)
+
+class ThreadingJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    pool = None
+
+def serve_socket(socket_path: str, pool=None):
+    ''' Listens on a local unix socket, handling each connection in its own
+        thread so several documents can be generated at once (by the workers of
+        pool if given)
+    '''
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    with ThreadingJobServer(socket_path, JobStreamHandler) as server:
+        server.pool = pool
+        logging.info('Serving sequence documents on %s', socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(socket_path)
@@ -0,0 +1,64 @@
+'''
+Timings and counters of one document generation. A GenerationStats is handed
+through the pipeline (see mogrifier.MogrifyContext) and each stage records its
+wall time and what it did, so a slow generation can be traced to a stage and
+the records of many generations aggregated per phase.
+
+As a dict (or one JSON line) a record looks like:
+
+    {"phases": {"load_template": 0.0, "instantiate": 0.13, "apply_selections": 0.2, ...},
+     "counts": {"elements_deleted": 1240, "invalid_tags": 2, "missing_names": 1, ...},
+     "annotations": {"YES": 412, "ROW": 95, ...},
+     "diagnostics": {"Path \"%s\" not found in store, deleting": 33, ...}}
+
+Phases are in seconds. A phase entered several times adds up.
+'''
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable
+
+class GenerationStats:
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        # compiled annotations by operation
+        self.annotations = Counter()
+        # occurrences of each message logged by the run, see diagnostics.py
+        self.diagnostics = Counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, value: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def count_annotations(self, control_structure: Iterable[Dict]):
+        self.annotations.update(op['op'] for op in control_structure if op.get('expression') is not None)
+
+    def count_compile_errors(self, compiler):
+        ''' Invalid annotations and short names missing from the name map,
+            from an expression.AnnotationCompiler
+        '''
+        self.counts['invalid_tags'] = len(compiler.invalid_tags)
+        self.counts['missing_names'] = len(compiler.missing_names)
+
+    def count_diagnostics(self, diagnostics):
+        self.diagnostics.update(diagnostics.counts())
+
+    def as_dict(self) -> Dict:
+        return {
+            'phases': {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            'counts': dict(self.counts),
+            'annotations': dict(sorted(self.annotations.items())),
+            'diagnostics': dict(self.diagnostics),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict())
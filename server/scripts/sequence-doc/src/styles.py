@@ -0,0 +1,97 @@
+'''
+The mogrifier decides what a paragraph or run is (a toggle, an info box, a
+heading...) by its style. Resolving a style id through python-docx searches the
+styles part on every access, so a StyleTable resolves every style of a document
+once and the mogrifier passes look up the raw w:styleId attribute value.
+'''
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+
+ANNOTATION_STYLE = 'Toggle'
+INFO_BOX_STYLES = ['Info. box', 'InfoboxList', 'InfoTableTitle']
+INSTR_BOX_STYLE = 'Instr. box'
+
+# level of paragraphs that aren't headings
+BODY_TEXT_LEVEL = 100
+
+HEADING_PATTERN = re.compile(r'Heading (\d+)')
+
+def get_level_from_name(name: str) -> int:
+    match = HEADING_PATTERN.match(name)
+    if not match:
+        return BODY_TEXT_LEVEL
+    return int(match.group(1))
+
+@dataclass(frozen=True)
+class StyleInfo:
+    style_id: Optional[str]
+    name: str
+    type: WD_STYLE_TYPE
+    heading_level: int
+    is_toggle: bool
+    is_info_box: bool
+    is_instr_box: bool
+
+def get_style_info(style) -> StyleInfo:
+    # python-docx translates builtin names, e.g. 'heading 1' to 'Heading 1'
+    name = style.name or ''
+    paragraph = style.type == WD_STYLE_TYPE.PARAGRAPH
+    character = style.type == WD_STYLE_TYPE.CHARACTER
+
+    return StyleInfo(
+        style_id=style.style_id,
+        name=name,
+        type=style.type,
+        heading_level=get_level_from_name(name) if paragraph else BODY_TEXT_LEVEL,
+        is_toggle=character and name == ANNOTATION_STYLE,
+        is_info_box=paragraph and name in INFO_BOX_STYLES,
+        is_instr_box=paragraph and name == INSTR_BOX_STYLE,
+    )
+
+# used when a document has no default style for a type
+NO_STYLE = StyleInfo(None, '', None, BODY_TEXT_LEVEL, False, False, False)
+
+class StyleTable:
+    ''' The styles of a document by id. Lookups resolve like python-docx's
+        Paragraph.style and Run.style: a missing or unknown id, or the id of a
+        style of another type, gives the default style of the type.
+    '''
+    def __init__(self, doc: Document):
+        self._styles: Dict[str, StyleInfo] = {}
+        self._defaults: Dict[WD_STYLE_TYPE, StyleInfo] = {}
+
+        for style in doc.styles:
+            info = get_style_info(style)
+            # python-docx finds the first style with an id...
+            self._styles.setdefault(info.style_id, info)
+            # ...and the last default of a type
+            if style.element.default:
+                self._defaults[info.type] = info
+
+        self._paragraph = {}
+        self._character = {}
+
+    def _resolve(self, style_id: Optional[str], style_type: WD_STYLE_TYPE) -> StyleInfo:
+        info = self._styles.get(style_id) if style_id else None
+        if info is None or info.type != style_type:
+            return self._defaults.get(style_type, NO_STYLE)
+        return info
+
+    def paragraph(self, style_id: Optional[str]) -> StyleInfo:
+        ''' Style of a paragraph given its w:pStyle value
+        '''
+        info = self._paragraph.get(style_id)
+        if info is None:
+            info = self._paragraph[style_id] = self._resolve(style_id, WD_STYLE_TYPE.PARAGRAPH)
+        return info
+
+    def character(self, style_id: Optional[str]) -> StyleInfo:
+        ''' Style of a run given its w:rStyle value
+        '''
+        info = self._character.get(style_id)
+        if info is None:
+            info = self._character[style_id] = self._resolve(style_id, WD_STYLE_TYPE.CHARACTER)
+        return info
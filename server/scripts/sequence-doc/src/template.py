@@ -0,0 +1,627 @@
+'''
+Loading a version directory (parsing the source docx, reading the mappings csv and
+scanning the document for annotations) costs far more than applying selections.
+A Template does that work once and hands out copies of just the document body,
+the only part of the package that gets modified, for each request.
+'''
+import copy
+import csv
+import hashlib
+import io
+import zipfile
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List
+from docx import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.package import Package
+from docx.parts.document import DocumentPart
+from docx.table import Table, _Cell, _Row
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from bundle import BUNDLE_FILE, BundleError, map_bundle, write_bundle
+from docx_writer import SourcePackage
+from expression import UNITS_OP, AnnotationCompiler, Condition, Units, get_references
+from grid import TableGrid
+from mogrifier import UNIT_SYSTEMS, MogrifyContext, compile_annotations, get_unit_selection, mogrify_doc, scan_document
+from outline import OutlineIndex
+from stats import GenerationStats
+
+MAPPING_FILE_PATH = 'Guideline 36-2021 (mappings).csv'
+SOURCE_DOC_PATH = 'Guideline 36-2021 (sequence selection source).docx'
+# some versions prefix the source document name with their date
+SOURCE_DOC_PATTERN = '*(sequence selection source).docx'
+MAPPINGS_SHORT_ID = 'Short ID'
+MAPPINGS_MODELICA_INSTANCE = 'Modelica Parameter'
+MAPPINGS_MODELICA_VALUES = 'Modelica Path'
+
+VERSION_DIR = Path(os.path.dirname(__file__), 'version')
+
+# One template per version directory
+TEMPLATE_CACHE_SIZE = 6
+MEMORY_BUDGET_ENV = 'SEQUENCE_DOC_MEMORY_BUDGET'
+# approximate memory held per xml element of a loaded template (parsed tree,
+# proxies and scan included), measured on the G36 versions
+ELEMENT_MEMORY = 450
+
+# selections read by the mogrifier besides the ones named in annotations
+INFO_BOX_SELECTION = 'DEL_INFO_BOX'
+
+def generate_name_map(mappings_path: str) -> dict:
+    # load mappings
+    mappings = {}
+
+    with open(mappings_path) as fh:
+        reader = csv.DictReader(fh)
+        for row in reader:
+            if row[MAPPINGS_SHORT_ID] and mappings.get(row[MAPPINGS_SHORT_ID]):
+                logging.error('Duplicate entry for "%s"', row[MAPPINGS_SHORT_ID])
+            if row[MAPPINGS_SHORT_ID]:
+                mappings[row[MAPPINGS_SHORT_ID]] = row[MAPPINGS_MODELICA_INSTANCE] or row[MAPPINGS_MODELICA_VALUES]
+
+    return mappings
+
+def get_local_path_prefix(version: str) -> Path:
+    ''' The directory of a version. Versions come from job input, so only the
+        names of the discovered version directories are accepted: a version
+        leading anywhere else would load (and unpickle) the files found there.
+    '''
+    if (
+        not isinstance(version, str)
+        or not version
+        or '..' in version
+        or any(separator and separator in version for separator in ('/', os.sep, os.altsep))
+        or version not in get_versions()
+    ):
+        raise ValueError(f'Unknown version {version!r}')
+
+    return VERSION_DIR / version
+
+def get_source_doc_path(version_path: Path) -> Path:
+    ''' The source document of a version directory: SOURCE_DOC_PATH, or the
+        (first) file matching SOURCE_DOC_PATTERN
+    '''
+    version_path = Path(version_path)
+    path = version_path / SOURCE_DOC_PATH
+    if path.exists():
+        return path
+
+    matches = sorted(version_path.glob(SOURCE_DOC_PATTERN))
+    if not matches:
+        raise FileNotFoundError(f'No source document in {version_path}')
+    if len(matches) > 1:
+        logging.warning('Several source documents in %s, using "%s"', version_path, matches[0].name)
+
+    return matches[0]
+
+def get_versions(version_dir: Path = VERSION_DIR) -> List[str]:
+    ''' Names of the version directories holding a mappings file and a source document
+    '''
+    return sorted(
+        path.name for path in Path(version_dir).iterdir()
+        if (path / MAPPING_FILE_PATH).exists()
+        and ((path / SOURCE_DOC_PATH).exists() or any(path.glob(SOURCE_DOC_PATTERN)))
+    )
+
+def get_file_stamp(version_path: Path) -> tuple:
+    ''' Modification times and sizes of the files a template is built from,
+        used to notice when a version directory changes on disk
+    '''
+    stamp = []
+    for path in (get_source_doc_path(version_path), Path(version_path, MAPPING_FILE_PATH)):
+        stat = os.stat(path)
+        stamp.append((stat.st_mtime_ns, stat.st_size))
+
+    return tuple(stamp)
+
+def get_file_digest(version_path: Path) -> str:
+    ''' Hash of the contents of the files a template is built from
+    '''
+    digest = hashlib.sha256()
+    for path in (get_source_doc_path(version_path), Path(version_path, MAPPING_FILE_PATH)):
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+def get_element_path(element) -> tuple:
+    ''' Child indexes leading from the root element down to element
+    '''
+    path = []
+    parent = element.getparent()
+    while parent is not None:
+        path.append(parent.index(element))
+        element = parent
+        parent = element.getparent()
+
+    return tuple(reversed(path))
+
+class ElementResolver:
+    ''' Inverse of get_element_path. Indexing into an lxml element walks its
+        children, so the child lists of visited elements are cached.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self._children = {}
+
+    def resolve(self, path: tuple):
+        element = self.root
+        for depth, index in enumerate(path):
+            prefix = path[:depth]
+            children = self._children.get(prefix)
+            if children is None:
+                children = self._children[prefix] = list(element)
+            element = children[index]
+
+        return element
+
+def copy_document(document: Document) -> Document:
+    ''' Copies a document, deep copying the main document part's xml and sharing
+        every other part (styles, numbering, media...) with the original.
+        Only the copy's document body can be safely modified.
+    '''
+    source_part = document.part
+    package = Package()
+    part = DocumentPart(
+        source_part.partname,
+        source_part.content_type,
+        copy.deepcopy(source_part.element),
+        package,
+    )
+    # relationships from the document part to the shared parts
+    part.__dict__['rels'] = source_part.rels
+
+    for rel in source_part.package.rels.values():
+        if rel.is_external:
+            package.load_rel(rel.reltype, rel.target_ref, rel.rId, True)
+        elif rel.reltype == RT.OFFICE_DOCUMENT:
+            package.load_rel(rel.reltype, part, rel.rId)
+        else:
+            package.load_rel(rel.reltype, rel.target_part, rel.rId)
+
+    return part.document
+
+def estimate_memory(template) -> int:
+    ''' Approximate bytes held by a loaded template: its parsed xml parts by
+        number of elements, its binary parts and the compressed source package
+        kept for packaging. Measuring the process memory around a load doesn't
+        work as memory freed by evicted templates gets reused.
+    '''
+    size = sum(len(member.data) for member in template.package.members)
+    for part in template.document.part.package.iter_parts():
+        element = getattr(part, '_element', None)
+        if element is None:
+            size += len(part.blob)
+        else:
+            size += ELEMENT_MEMORY * sum(1 for _ in element.iter())
+
+    return size
+
+class Template:
+    ''' A loaded version directory: the parsed source document, the name map and
+        the location of every annotation found in the source document
+    '''
+    # loaded from the files or a bundle rather than stored in one, or stored
+    # in sections of their own
+    UNBUNDLED_ATTRIBUTES = ['_document', '_document_lock', '_source', 'package', 'program']
+
+    def __init__(self, version_path: Path):
+        self.path = Path(version_path)
+        self.stamp = get_file_stamp(self.path)
+        self.digest = get_file_digest(self.path)
+        self.source_path = get_source_doc_path(self.path)
+        with open(self.source_path, 'rb') as fh:
+            self._source = fh.read()
+        self._document = Document(io.BytesIO(self._source))
+        self._document_lock = threading.Lock()
+        self.package = SourcePackage(self._source)
+        self.document_member = self.document.part.partname.membername
+        # compiled on first use, see render_program.py
+        self.program = None
+        self.name_map = generate_name_map(self.path / MAPPING_FILE_PATH)
+
+        # annotations are compiled once and everything found by the scan is
+        # stored as element paths so it can be found again in each copy of the document
+        scan = scan_document(self.document)
+        self.compiler = AnnotationCompiler(self.name_map)
+        compile_annotations(scan['control_structure'], self.compiler)
+        # positions of the UNITS annotations and how the unit system is
+        # selected, so requests only look the selected unit system up
+        self.unit_annotations = [
+            index for index, op in enumerate(scan['control_structure']) if isinstance(op['expression'], Units)
+        ]
+        self.unit_selection = None
+        if self.unit_annotations:
+            self.unit_selection = get_unit_selection(self.name_map, self.compiler.diagnostics)
+        # compile errors are logged once per load
+        self.compiler.diagnostics.emit()
+        self.annotations = [self._locate(op) for op in scan['control_structure']]
+        self.info_boxes = [get_element_path(p) for p in scan['info_boxes']]
+        self.instr_boxes = [get_element_path(p) for p in scan['instr_boxes']]
+        self.toggle_runs = [get_element_path(r) for r in scan['toggle_runs']]
+        # copies share the styles part
+        self.styles = scan['styles']
+
+        # long names of the selections that can change the generated document,
+        # the values they are compared to
+        references = {INFO_BOX_SELECTION: set()}
+        if UNITS_OP in self.name_map:
+            references[self.name_map[UNITS_OP]] = {
+                self.name_map[system] for system in UNIT_SYSTEMS if system in self.name_map
+            }
+        # and the annotations reading each of them
+        self.dependents = {}
+        for index, op in enumerate(scan['control_structure']):
+            for name, values in get_references(op['expression']).items():
+                references.setdefault(name, set()).update(values)
+                self.dependents.setdefault(name, []).append(index)
+        self.references = {name: frozenset(values) for name, values in references.items()}
+        self.referenced_names = frozenset(self.references)
+
+        # section extents of every container holding a section toggle
+        self.outlines = {}
+        for op in scan['control_structure']:
+            if isinstance(op['expression'], Condition):
+                container = op['paragraph']._p.getparent()
+                self.outlines[get_element_path(container)] = scan['outlines'].get_outline(container)
+
+        # approximate memory held, for the template cache's budget
+        self.memory = estimate_memory(self)
+
+    @classmethod
+    def from_bundle(cls, version_path: Path) -> 'Template':
+        ''' Loads the template of a version directory from its bundle (see
+            save_bundle). The source document is only parsed when first used.
+            Raises BundleError if the bundle is missing or out of date.
+        '''
+        version_path = Path(version_path)
+        bundle_path = version_path / BUNDLE_FILE
+        if not bundle_path.exists():
+            raise BundleError(f'No bundle in {version_path}')
+
+        header, sections = map_bundle(bundle_path)
+        if header['digest'] != get_file_digest(version_path):
+            raise BundleError(f'{bundle_path} was compiled from other files')
+
+        template = cls.__new__(cls)
+        template.__dict__.update(pickle.loads(sections['index']))
+        template.path = version_path
+        template.stamp = get_file_stamp(version_path)
+        template.source_path = get_source_doc_path(version_path)
+        template._source = sections['source']
+        template._document = None
+        template._document_lock = threading.Lock()
+        template.package = SourcePackage(template._source)
+        template.program = pickle.loads(sections['program'])
+        template.program.data = sections['document_xml']
+
+        return template
+
+    def save_bundle(self, path: Path = None) -> Path:
+        ''' Writes the template as a bundle (see bundle.py), by default into its
+            version directory where TemplateCache finds it. The bundle includes
+            the template's render program, compiled if need be.
+        '''
+        # imported here as render_program depends on this module
+        from render_program import get_render_program
+        program = get_render_program(self)
+
+        path = Path(path or self.path / BUNDLE_FILE)
+        index = {
+            name: value for name, value in self.__dict__.items()
+            if name not in self.UNBUNDLED_ATTRIBUTES
+        }
+        header = {
+            'digest': self.digest,
+            'diagnostics': {
+                'invalid_tags': sorted(self.compiler.invalid_tags),
+                'missing_names': sorted(self.compiler.missing_names),
+            },
+        }
+        write_bundle(path, header, {
+            'source': self._source,
+            'document_xml': program.data,
+            'index': pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL),
+            'program': pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL),
+        })
+
+        return path
+
+    @property
+    def document(self) -> Document:
+        ''' The parsed source document, shared by the copies (see copy_document)
+        '''
+        if self._document is None:
+            with self._document_lock:
+                if self._document is None:
+                    self._document = Document(io.BytesIO(self._source))
+
+        return self._document
+
+    def get_relevant_selections(self, selections: dict) -> dict:
+        ''' The part of selections the document depends on: documents generated
+            from selections with the same relevant selections are identical
+        '''
+        return {name: selections[name] for name in self.referenced_names if name in selections}
+
+    def get_selection_manifest(self) -> dict:
+        ''' The selections the template can consult: every long name with the
+            (sorted) values it is compared to
+        '''
+        return {
+            'digest': self.digest,
+            'selections': {name: sorted(self.references[name]) for name in sorted(self.references)},
+        }
+
+    def render(self, selections: dict, stats: GenerationStats = None) -> Document:
+        ''' Generates the document for selections from a fresh copy of the
+            template, recording timings and counters in stats if given
+        '''
+        if stats is None:
+            stats = GenerationStats()
+        with stats.phase('instantiate'):
+            document, scan = self.instantiate()
+        stats.count_compile_errors(self.compiler)
+
+        return mogrify_doc(document, self.name_map, selections, MogrifyContext(scan, stats))
+
+    def serialize(self, document: Document, method: int = zipfile.ZIP_DEFLATED, level: int = None) -> bytes:
+        ''' Packages a document instantiated from this template. Only its main
+            document part is serialized and compressed (with method and level),
+            the other members are copied from the source docx as they are.
+        '''
+        return self.serialize_xml(document.part.blob, method, level)
+
+    def serialize_xml(self, data: bytes, method: int = zipfile.ZIP_DEFLATED, level: int = None) -> bytes:
+        ''' Packages the xml of a main document part generated from this
+            template, see serialize
+        '''
+        buffer = io.BytesIO()
+        self.package.write(buffer, {self.document_member: data}, method, level)
+
+        return buffer.getvalue()
+
+    def _locate(self, op: dict) -> dict:
+        located = {
+            'text': op['text'],
+            'op': op['op'],
+            'expression': op['expression'],
+            'paragraph': get_element_path(op['paragraph']._p),
+            'runs': [get_element_path(run._r) for run in op['runs']],
+        }
+        if 'table' in op:
+            located['table'] = get_element_path(op['table']._tbl)
+            located['row'] = get_element_path(op['row']._tr)
+            located['cell'] = get_element_path(op['cell']._tc)
+            located['column'] = op['column']
+
+        return located
+
+    def instantiate(self):
+        ''' Returns a fresh copy of the source document along with its scan
+            (see mogrifier.scan_document)
+        '''
+        document = copy_document(self.document)
+        resolve = ElementResolver(document.element).resolve
+        control_structure = []
+        run_op_lookup = {}
+        grids = {}
+
+        for located in self.annotations:
+            op = {'text': located['text'], 'op': located['op'], 'expression': located['expression']}
+
+            if 'table' in located:
+                table = Table(resolve(located['table']), document._body)
+                op['table'] = table
+                if located['table'] not in grids:
+                    grids[located['table']] = TableGrid(table._tbl)
+                op['grid'] = grids[located['table']]
+                op['row'] = _Row(resolve(located['row']), table)
+                op['column'] = located['column']
+                op['cell'] = _Cell(resolve(located['cell']), table)
+                op['paragraph'] = Paragraph(resolve(located['paragraph']), table)
+            else:
+                op['paragraph'] = Paragraph(resolve(located['paragraph']), document._body)
+
+            op['runs'] = [Run(resolve(path), op['paragraph']) for path in located['runs']]
+
+            if 'table' not in located:
+                for run in op['runs']:
+                    run_op_lookup[run.element] = op
+            control_structure.append(op)
+
+        scan = {
+            'control_structure': control_structure,
+            'run_op_lookup': run_op_lookup,
+            'info_boxes': [resolve(path) for path in self.info_boxes],
+            'instr_boxes': [resolve(path) for path in self.instr_boxes],
+            'toggle_runs': [resolve(path) for path in self.toggle_runs],
+            'units': [control_structure[index] for index in self.unit_annotations],
+            'unit_selection': self.unit_selection,
+            'styles': self.styles,
+            'outlines': OutlineIndex(
+                self.styles,
+                {resolve(path): outline for path, outline in self.outlines.items()},
+            ),
+        }
+
+        return document, scan
+
+def load_template(version_path: Path) -> Template:
+    ''' The template of a version directory, from its bundle if it has an up
+        to date one
+    '''
+    if (Path(version_path) / BUNDLE_FILE).exists():
+        try:
+            return Template.from_bundle(version_path)
+        except BundleError as e:
+            logging.warning('%s, loading the template from the version files', e)
+        except Exception:
+            logging.exception('Unable to load the bundle of %s', version_path)
+
+    return Template(version_path)
+
+def compile_bundles(versions: List[str]) -> List[Dict]:
+    ''' Compiles the bundles of versions (all discovered versions for ['all'])
+        from their files, returning what was written
+    '''
+    if versions == ['all']:
+        versions = get_versions()
+
+    compiled = []
+    for version in versions:
+        template = Template(get_local_path_prefix(version))
+        path = template.save_bundle()
+        compiled.append({
+            'version': version,
+            'bundle': str(path),
+            'size': path.stat().st_size,
+            'annotations': len(template.annotations),
+            'segments': len(template.program),
+            'invalid_tags': sorted(template.compiler.invalid_tags),
+            'missing_names': sorted(template.compiler.missing_names),
+        })
+
+    return compiled
+
+class TemplateCache:
+    ''' Registry of the loaded templates, keyed by version directory. Templates
+        are loaded on first use (or ahead of time, see preload), from their
+        bundle when there is one, and reloaded if their files changed on disk. The least recently used templates are
+        evicted once there are more than max_size of them or their estimated
+        memory (see estimate_memory) exceeds memory_budget bytes; the template
+        just requested is always kept.
+
+        Safe to use from several threads. A template is loaded holding only a
+        lock for its own version, so requests for other versions aren't held up.
+    '''
+    def __init__(self, max_size: int = TEMPLATE_CACHE_SIZE, memory_budget: int = None):
+        self.max_size = max_size
+        self.memory_budget = memory_budget
+        self._templates = OrderedDict()
+        # hits, loads and load times per version directory, kept after eviction
+        self._usage: Dict[str, Dict] = {}
+        self._loading: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, version_path: Path) -> Template:
+        key = str(version_path)
+        stamp = get_file_stamp(Path(version_path))
+
+        with self._lock:
+            template = self._get_current(key, stamp)
+            if template is not None:
+                return template
+            loading = self._loading.setdefault(key, threading.Lock())
+
+        with loading:
+            # loaded by another thread while waiting for the version's lock
+            with self._lock:
+                template = self._get_current(key, stamp)
+                if template is not None:
+                    return template
+
+            start = time.perf_counter()
+            template = load_template(version_path)
+            seconds = time.perf_counter() - start
+
+            with self._lock:
+                self._templates[key] = template
+                usage = self._get_usage(key)
+                usage['loads'] += 1
+                usage['load_seconds'] = seconds
+                self._evict(keep=key)
+
+        return template
+
+    def _get_current(self, key: str, stamp: tuple):
+        template = self._templates.get(key)
+        if template is None or template.stamp != stamp:
+            return None
+
+        self._templates.move_to_end(key)
+        self._get_usage(key)['hits'] += 1
+        return template
+
+    def _get_usage(self, key: str) -> Dict:
+        return self._usage.setdefault(key, {'hits': 0, 'loads': 0, 'load_seconds': None})
+
+    def _evict(self, keep: str = None):
+        while len(self._templates) > 1 and (
+            len(self._templates) > self.max_size
+            or (self.memory_budget is not None and self.memory() > self.memory_budget)
+        ):
+            key = next(iter(self._templates))
+            if key == keep:
+                self._templates.move_to_end(key)
+                key = next(iter(self._templates))
+            self._templates.pop(key)
+            logging.info('Evicted the template of %s', key)
+
+    def configure(self, max_size: int = TEMPLATE_CACHE_SIZE, memory_budget: int = None):
+        with self._lock:
+            self.max_size = max_size
+            self.memory_budget = memory_budget
+            self._evict()
+
+    def preload(self, version_paths: List[Path]) -> List[Template]:
+        ''' Loads templates ahead of their first use. Templates that don't fit
+            in the budget are evicted again, least recently used first.
+        '''
+        return [self.get(path) for path in version_paths]
+
+    def memory(self) -> int:
+        ''' Estimated bytes held by the loaded templates
+        '''
+        return sum(template.memory for template in self._templates.values())
+
+    def stats(self) -> List[Dict]:
+        ''' Per version directory ever requested: whether its template is
+            loaded, its estimated memory, hits, loads and the last load time
+        '''
+        with self._lock:
+            return [
+                {
+                    'version': Path(key).name,
+                    'loaded': key in self._templates,
+                    'memory': self._templates[key].memory if key in self._templates else None,
+                    **usage,
+                }
+                for key, usage in self._usage.items()
+            ]
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def __len__(self):
+        return len(self._templates)
+
+template_cache = TemplateCache()
+
+def get_template(version: str) -> Template:
+    ''' Gets the (cached) template for a version
+    '''
+    return template_cache.get(get_local_path_prefix(version))
+
+def preload_templates(versions: List[str]) -> List[Template]:
+    ''' Loads the templates of versions (all discovered versions for ['all'])
+        so their first requests don't pay for it
+    '''
+    if versions == ['all']:
+        versions = get_versions()
+
+    return template_cache.preload([get_local_path_prefix(version) for version in versions])
+
+def get_template_stats() -> Dict:
+    return {
+        'memory': template_cache.memory(),
+        'memory_budget': template_cache.memory_budget,
+        'versions': template_cache.stats(),
+    }
@@ -0,0 +1,358 @@
+'''
+Pre-forked worker pool for the long-running mode (see serve.py). One serving
+process generates one document at a time behind the GIL. Instead, the supervisor
+loads every template (and compiles its render program, see render_program.py)
+and then forks workers. The workers inherit the loaded templates copy-on-write,
+so N workers generate N documents at once without N copies of the templates.
+
+Jobs wait for a worker in a queue of bounded depth. A job submitted while the
+queue is full is shed: it is answered at once with "status": "overloaded" so
+clients can back off instead of piling up work. A worker retires once it has
+handled --max-jobs jobs or its resident memory exceeds --max-rss MB, as the pages
+it writes to stop being shared and documents fragment its heap. The supervisor
+then forks a replacement, as it does for a worker that died. A job whose worker
+died is answered with an error. Replacements are forked by the thread collecting
+the responses while other threads run, so forks hold the logging locks (see
+fork_process).
+
+A {"command": "workers"} job gets the pool's counters and the stats of each
+worker in a "workers" field, see WorkerPool.stats.
+'''
+import collections
+import gc
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import signal
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from render_program import get_render_program
+from serve import run_job
+from template import Template, preload_templates
+
+# default queue depth, per worker
+QUEUE_DEPTH_PER_WORKER = 4
+# seconds between a worker's checks that its supervisor is still running
+POLL_INTERVAL = 0.5
+# stats reported for each worker, see WorkerPool.stats
+WORKER_STATS = ['worker', 'pid', 'jobs', 'errors', 'busy_seconds', 'total_jobs', 'rss', 'restarts']
+
+def get_rss() -> int:
+    ''' Resident memory of this process in bytes
+    '''
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # the peak rather than the current resident memory, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def prepare_templates(versions: List[str]) -> List[Template]:
+    ''' Loads the templates of versions (all discovered versions for ['all'])
+        with what rendering builds on first use, so workers forked afterwards
+        share it instead of each building their own
+    '''
+    templates = preload_templates(versions)
+    for template in templates:
+        get_render_program(template)
+
+    return templates
+
+def get_logging_handlers() -> List[logging.Handler]:
+    handlers = list(logging.root.handlers)
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        if isinstance(logger, logging.Logger):
+            handlers.extend(handler for handler in logger.handlers if handler not in handlers)
+    return handlers
+
+def fork_process(process):
+    ''' Starts the forked process holding the logging locks, so no other
+        thread is writing a log record (and holding the lock of a handler or
+        of its stream) as the process inherits them. Objects surviving so far
+        are frozen for the fork only: they are never collected in the child,
+        so collections there don't write to (and unshare) the pages of the
+        templates, while the supervisor still collects them.
+    '''
+    handlers = get_logging_handlers()
+    with logging._lock:
+        for handler in handlers:
+            handler.acquire()
+        try:
+            gc.freeze()
+            try:
+                process.start()
+            finally:
+                gc.unfreeze()
+        finally:
+            for handler in reversed(handlers):
+                handler.release()
+
+def run_worker(connection, max_jobs: Optional[int], max_rss: Optional[int]):
+    ''' Runs the jobs the supervisor sends through connection, sending back
+        their responses, until it sends None or this worker reaches its job or
+        memory limit
+    '''
+    # interrupts are for the supervisor, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    supervisor = os.getppid()
+    handled = 0
+
+    while True:
+        # workers forked later hold the supervisor's end of the connection
+        # too, so it isn't closed when the supervisor dies
+        while not connection.poll(POLL_INTERVAL):
+            if os.getppid() != supervisor:
+                return
+        job = connection.recv()
+        if job is None:
+            return
+
+        start = time.perf_counter()
+        response = run_job(job)
+        handled += 1
+        rss = get_rss()
+        retiring = None
+        if max_jobs and handled >= max_jobs:
+            retiring = 'max_jobs'
+        elif max_rss and rss > max_rss:
+            retiring = 'max_rss'
+        connection.send((response, time.perf_counter() - start, rss, retiring))
+
+        if retiring:
+            return
+
+class WorkerPool:
+    ''' Forks workers generating the submitted jobs, see the module docstring.
+        max_rss is in bytes. Templates must be loaded before start.
+
+        Each worker has its own connection to the supervisor, which hands it
+        one job at a time: a worker dying never leaves a lock shared with the
+        other workers held, and the supervisor knows which job it was running.
+    '''
+    def __init__(self, workers: int, queue_depth: int = None, max_jobs: int = None, max_rss: int = None):
+        self.workers = workers
+        self.queue_depth = queue_depth or workers * QUEUE_DEPTH_PER_WORKER
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+
+        self._context = multiprocessing.get_context('fork')
+        self._lock = threading.Lock()
+        # signaled when the last submitted job is answered
+        self._idle = threading.Condition(self._lock)
+        # jobs waiting for a worker, with their callbacks
+        self._queue = collections.deque()
+        # the worker of each slot: its process, the supervisor's end of its
+        # connection, the id and callback of the job it runs, why it retires
+        # and its stats (see WORKER_STATS)
+        self._workers: Dict[int, Dict] = {}
+        self.counters = {'submitted': 0, 'shed': 0, 'completed': 0, 'lost': 0, 'restarts': 0}
+        self._stopping = False
+        self._collector = None
+
+    def start(self):
+        # the workers are forked from this thread before the collector starts
+        # and from the collector afterwards, see fork_process
+        with self._lock:
+            for slot in range(self.workers):
+                self._start_worker(slot)
+            self._dispatch()
+        self._collector = threading.Thread(target=self._collect, name='worker-pool', daemon=True)
+        self._collector.start()
+        logging.info('Started %d workers (queue depth %d)', self.workers, self.queue_depth)
+
+    def submit(self, job: Dict, respond: Callable[[Dict], None]) -> bool:
+        ''' Queues job, respond is called with its response from the
+            supervisor's thread. A job shed as the queue is full is answered
+            right away and False is returned.
+        '''
+        with self._lock:
+            self.counters['submitted'] += 1
+            shed = len(self._queue) >= self.queue_depth
+            if shed:
+                self.counters['shed'] += 1
+            else:
+                self._queue.append((job, respond))
+                self._dispatch()
+
+        if shed:
+            respond({
+                'id': job.get('id'),
+                'status': 'overloaded',
+                'error': f'Queue full ({self.queue_depth} jobs waiting), try again later',
+            })
+        return not shed
+
+    def stats(self) -> Dict:
+        ''' The pool's counters and, per worker: its pid, the jobs it handled,
+            failed and the seconds it spent on them since it was forked, its
+            jobs over all restarts, its resident memory after its last job, its
+            restarts and its uptime
+        '''
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_depth': self.queue_depth,
+                'queued': len(self._queue),
+                'running': sum(worker['running'] is not None for worker in self._workers.values()),
+                **self.counters,
+                'worker_stats': [
+                    {
+                        **{name: worker[name] for name in WORKER_STATS},
+                        'uptime': round(time.monotonic() - worker['started'], 3),
+                    }
+                    for _, worker in sorted(self._workers.items())
+                ],
+            }
+
+    def stop(self):
+        ''' Waits for the submitted jobs to be answered and stops the workers
+        '''
+        with self._idle:
+            while not self._is_idle():
+                self._idle.wait()
+            self._stopping = True
+            for worker in self._workers.values():
+                if worker['process'] is not None and not worker['retiring']:
+                    worker['connection'].send(None)
+
+        if self._collector is not None:
+            self._collector.join()
+        logging.info('Stopped the workers: %s', self.counters)
+
+    def _is_idle(self) -> bool:
+        return not self._queue and all(worker['running'] is None for worker in self._workers.values())
+
+    def _start_worker(self, slot: int):
+        connection, worker_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=run_worker,
+            args=(worker_connection, self.max_jobs, self.max_rss),
+            name=f'worker-{slot}',
+            daemon=True,
+        )
+        fork_process(process)
+        worker_connection.close()
+
+        previous = self._workers.get(slot)
+        self._workers[slot] = {
+            'process': process,
+            'connection': connection,
+            'running': None,
+            'retiring': None,
+            'started': time.monotonic(),
+            'worker': slot,
+            'pid': process.pid,
+            'jobs': 0,
+            'errors': 0,
+            'busy_seconds': 0.0,
+            'total_jobs': previous['total_jobs'] if previous else 0,
+            'rss': None,
+            'restarts': previous['restarts'] + 1 if previous else 0,
+        }
+        if previous:
+            self.counters['restarts'] += 1
+
+    def _dispatch(self):
+        ''' Hands the queued jobs to the idle workers, with the lock held
+        '''
+        for worker in self._workers.values():
+            if not self._queue:
+                return
+            if worker['process'] is None or worker['running'] is not None or worker['retiring']:
+                continue
+            job, respond = self._queue.popleft()
+            try:
+                worker['connection'].send(job)
+            except OSError:
+                # it died, the collector replaces it
+                self._queue.appendleft((job, respond))
+                worker['retiring'] = 'died'
+                continue
+            worker['running'] = (job.get('id'), respond)
+
+    def _collect(self):
+        ''' Answers the jobs the workers complete and replaces the workers
+            that retired or died, until the pool is stopped
+        '''
+        while True:
+            with self._lock:
+                workers = [worker for worker in self._workers.values() if worker['process'] is not None]
+            if self._stopping and not workers:
+                return
+
+            waitables = {}
+            for worker in workers:
+                waitables[worker['connection']] = worker
+                waitables[worker['process'].sentinel] = worker
+            ready = multiprocessing.connection.wait(list(waitables), POLL_INTERVAL)
+
+            for waitable in ready:
+                if waitable is waitables[waitable]['connection']:
+                    self._receive(waitables[waitable])
+            for waitable in ready:
+                if waitable is waitables[waitable]['process'].sentinel:
+                    self._exited(waitables[waitable])
+
+    def _receive(self, worker: Dict):
+        answered = []
+        try:
+            while worker['connection'].poll():
+                response, seconds, rss, retiring = worker['connection'].recv()
+                with self._lock:
+                    _, respond = worker['running']
+                    worker['running'] = None
+                    worker['retiring'] = retiring
+                    worker['jobs'] += 1
+                    worker['total_jobs'] += 1
+                    worker['errors'] += response.get('status') != 'ok'
+                    worker['busy_seconds'] = round(worker['busy_seconds'] + seconds, 6)
+                    worker['rss'] = rss
+                    self.counters['completed'] += 1
+                answered.append((respond, response))
+        except (EOFError, OSError):
+            # it exited, see _exited
+            pass
+
+        with self._lock:
+            self._dispatch()
+        self._answer(answered)
+
+    def _exited(self, worker: Dict):
+        # the responses it sent before exiting
+        self._receive(worker)
+
+        answered = []
+        with self._lock:
+            process = worker['process']
+            process.join()
+            worker['connection'].close()
+            slot = worker['worker']
+
+            if worker['running'] is not None:
+                job_id, respond = worker['running']
+                answered.append((respond, {'id': job_id, 'status': 'error', 'error': 'The worker running the job died'}))
+                self.counters['lost'] += 1
+                worker['running'] = None
+            if worker['retiring'] in ('max_jobs', 'max_rss'):
+                logging.info('Worker %d (pid %d) retired after %d jobs (%s)', slot, process.pid, worker['jobs'], worker['retiring'])
+            elif not self._stopping or answered:
+                logging.error('Worker %d (pid %d) died with exit code %s', slot, process.pid, process.exitcode)
+
+            if self._stopping:
+                worker['process'] = None
+            else:
+                self._start_worker(slot)
+                self._dispatch()
+
+        self._answer(answered)
+
+    def _answer(self, answered: List):
+        for respond, response in answered:
+            respond(response)
+        if answered:
+            with self._lock:
+                if self._is_idle():
+                    self._idle.notify_all()
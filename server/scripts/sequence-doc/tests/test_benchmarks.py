@@ -0,0 +1,46 @@
+'''
+Benchmark suite tests
+'''
+from expression import TableToggle, Units
+from run import compare_results, get_corpus
+from synthetic import BASE_DEPTH, BASE_TABLES, TABLE_ROWS, write_synthetic_version
+from template import Template
+
+def get_results(load, memory=10.0):
+    return {'cases': {'synthetic/x1': {'time': {'load': load}, 'memory': {'load': memory}}}}
+
+def test_synthetic_template(tmp_path):
+    template = Template(write_synthetic_version(tmp_path / 'x1'))
+
+    ops = [located['op'] for located in template.annotations]
+    assert ops.count('TABLE') == BASE_TABLES
+    assert ops.count('COLUMN') == BASE_TABLES
+    assert ops.count('ROW') == BASE_TABLES * (TABLE_ROWS - 1)
+    assert any(isinstance(located['expression'], Units) for located in template.annotations)
+    levels = {template.styles.paragraph(p.style.style_id).heading_level for p in template.document.paragraphs}
+    assert set(range(1, BASE_DEPTH + 1)) < levels
+    assert template.info_boxes and template.instr_boxes
+
+    for selections in get_corpus(template, 2, 0):
+        assert template.serialize(template.render(selections))
+
+def test_synthetic_template_scale(tmp_path):
+    small = Template(write_synthetic_version(tmp_path / 'x1', 1))
+    large = Template(write_synthetic_version(tmp_path / 'x2', 2))
+
+    assert len(large.annotations) == 2 * len(small.annotations)
+    assert sum(isinstance(located['expression'], TableToggle) for located in large.annotations) == \
+        2 * sum(isinstance(located['expression'], TableToggle) for located in small.annotations)
+
+def test_compare_results():
+    baseline = get_results(1.0)
+
+    assert compare_results(get_results(1.2), baseline, 0.25) == []
+    assert len(compare_results(get_results(1.5), baseline, 0.25)) == 1
+    assert len(compare_results(get_results(1.0, 20.0), baseline, 0.25)) == 1
+    # differences within the noise floor aren't regressions
+    assert compare_results(get_results(0.006), get_results(0.002), 0.25) == []
+
+    failed = {'cases': {'synthetic/x1': {'error': 'failed'}}}
+    assert compare_results(failed, baseline) == ['synthetic/x1: failed']
+    assert compare_results(baseline, failed) == []
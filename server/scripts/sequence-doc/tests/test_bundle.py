@@ -0,0 +1,58 @@
+'''
+Compiled template bundle tests
+'''
+import csv
+import shutil
+import pytest
+from bundle import BUNDLE_FILE, BundleError, map_bundle
+from generate_doc import DEFAULT_DOC_VERSION, extract_input
+from render_program import render_document_xml
+from template import MAPPING_FILE_PATH, MAPPINGS_MODELICA_INSTANCE, MAPPINGS_SHORT_ID, Template, get_local_path_prefix, load_template
+
+@pytest.fixture
+def version_path(tmp_path):
+    path = tmp_path / 'version'
+    shutil.copytree(get_local_path_prefix(DEFAULT_DOC_VERSION), path)
+    return path
+
+def test_bundle_round_trip(version_path):
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    template = Template(version_path)
+    bundle_path = template.save_bundle()
+    assert bundle_path == version_path / BUNDLE_FILE
+
+    header, sections = map_bundle(bundle_path)
+    assert header['digest'] == template.digest
+    assert header['diagnostics']['invalid_tags'] == sorted(template.compiler.invalid_tags)
+    assert bytes(sections['source']) == template.source_path.read_bytes()
+
+    loaded = load_template(version_path)
+    assert loaded is not template
+    # the render program is bundled, so rendering with it needs no parsing
+    assert loaded.serialize_xml(render_document_xml(loaded, selections)) == template.serialize(template.render(selections))
+    # the source document is parsed on first use
+    assert loaded._document is None
+    assert loaded.get_selection_manifest() == template.get_selection_manifest()
+    assert loaded.serialize(loaded.render(selections)) == template.serialize(template.render(selections))
+    assert loaded._document is not None
+
+def test_stale_bundle_is_ignored(version_path):
+    Template(version_path).save_bundle()
+    with open(version_path / MAPPING_FILE_PATH, newline='') as fh:
+        fieldnames = csv.DictReader(fh).fieldnames
+    with open(version_path / MAPPING_FILE_PATH, 'a', newline='') as fh:
+        csv.DictWriter(fh, fieldnames).writerow({MAPPINGS_SHORT_ID: 'EXTRA', MAPPINGS_MODELICA_INSTANCE: 'Extra.name'})
+
+    with pytest.raises(BundleError):
+        Template.from_bundle(version_path)
+    template = load_template(version_path)
+    assert template._document is not None
+    assert template.name_map['EXTRA'] == 'Extra.name'
+
+def test_invalid_bundle(version_path):
+    (version_path / BUNDLE_FILE).write_bytes(b'not a bundle at all')
+    with pytest.raises(BundleError):
+        Template.from_bundle(version_path)
+    assert load_template(version_path).annotations
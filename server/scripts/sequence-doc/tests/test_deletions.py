@@ -0,0 +1,16 @@
+from lxml import etree
+from deletions import DeletionPlan
+
+def test_deletion_plan_prunes_descendants():
+    root = etree.fromstring('<body><p><r/><r/></p><p><r/></p><tbl><tr/></tbl></body>')
+    first, second, table = root
+    plan = DeletionPlan()
+
+    for element in (first[0], first, first[1], first, table[0], second[0]):
+        plan.add(element)
+
+    assert len(plan) == 5
+    assert plan.roots() == [first, table[0], second[0]]
+    assert plan.apply() == 3
+    assert etree.tostring(root) == b'<body><p/><tbl/></body>'
+    assert len(plan) == 0
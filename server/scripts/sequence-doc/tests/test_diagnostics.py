@@ -0,0 +1,49 @@
+'''
+Diagnostics tests
+'''
+import logging
+import pytest
+from diagnostics import LOG_LEVEL_ENV, Diagnostics, get_log_level
+from expression import AnnotationCompiler, SelectionSet
+
+def test_messages_are_deduplicated(caplog):
+    diagnostics = Diagnostics()
+    for _ in range(3):
+        diagnostics.error('Path "%s" not found in store, deleting', 'a')
+    diagnostics.error('Path "%s" not found in store, deleting', 'b')
+    diagnostics.warning('Something else')
+
+    assert len(diagnostics) == 3
+    assert diagnostics.counts() == {'Path "%s" not found in store, deleting': 4, 'Something else': 1}
+
+    with caplog.at_level(logging.WARNING):
+        diagnostics.emit()
+    assert [record.getMessage() for record in caplog.records] == [
+        'Path "a" not found in store, deleting (seen 3 times)',
+        'Path "b" not found in store, deleting',
+        'Something else',
+    ]
+    assert len(diagnostics) == 0
+
+def test_evaluation_reports_missing_selections_once():
+    compiler = AnnotationCompiler({'CO2': 'have_CO2Sen', 'OCC': 'have_occSen'})
+    selections = SelectionSet({'have_occSen': [True]})
+    for text in ['[YES CO2]', '[NO CO2]', '[AND [YES OCC] [NO CO2]]', '[YES OCC]']:
+        selections.deletes(compiler.compile(text))
+
+    assert selections.diagnostics.counts() == {
+        'Path "%s" not found in store, deleting': 2,
+    }
+    assert len(selections.diagnostics) == 1
+
+def test_log_level(monkeypatch):
+    monkeypatch.delenv(LOG_LEVEL_ENV, raising=False)
+    assert get_log_level() == 'WARNING'
+    assert get_log_level('debug') == 'DEBUG'
+
+    monkeypatch.setenv(LOG_LEVEL_ENV, 'error')
+    assert get_log_level() == 'ERROR'
+    assert get_log_level('INFO') == 'INFO'
+
+    with pytest.raises(ValueError):
+        get_log_level('LOUD')
@@ -0,0 +1,109 @@
+'''
+Annotation expression tests
+'''
+from expression import AnnotationCompiler, And, AnyOf, Constant, Equals, Or, SelectionSet, TableToggle, Units, Yes, get_references, parse_annotation
+
+NAME_MAP = {
+    'CO2': 'have_CO2Sen',
+    'OCC': 'have_occSen',
+    'WIN': 'have_winSen',
+    'BSP': 'buiPreCon',
+    'RELIEF': 'ReliefFan',
+    'RETURN': 'ReturnFan',
+}
+
+SELECTIONS = {
+    'have_CO2Sen': [True],
+    'have_occSen': [False],
+    'have_winSen': [False],
+    'buiPreCon': ['ReturnFan'],
+}
+
+def deletes(text, selections=SELECTIONS):
+    expression = AnnotationCompiler(NAME_MAP).compile(text)
+    return SelectionSet(selections).deletes(expression)
+
+def test_parse_nested_groups():
+    items = parse_annotation('[OR [YES CO2] [AND [NO OCC] [NO WIN]]]')
+    assert len(items) == 1
+    operation = items[0].items
+    assert operation[0] == 'OR'
+    assert operation[1].items == ['YES', 'CO2']
+    assert operation[2].items[0] == 'AND'
+    assert operation[2].items[2].raw == 'NO WIN'
+
+def test_compile_resolves_long_names():
+    compiler = AnnotationCompiler(NAME_MAP)
+    assert compiler.compile('[YES CO2]') == Yes('have_CO2Sen')
+    assert compiler.compile('[EQUALS BSP RELIEF]') == Equals('buiPreCon', 'ReliefFan')
+    assert compiler.compile('[ANY BSP RELIEF RETURN]') == AnyOf('buiPreCon', frozenset(['ReliefFan', 'ReturnFan']))
+    assert compiler.compile('[YES UNKNOWN]') == Constant(True)
+    assert compiler.compile('[NOT_EQUALS BSP UNKNOWN]') == Constant(False)
+    assert compiler.compile('Delete the following paragraph') is None
+
+def test_shared_sub_expressions():
+    compiler = AnnotationCompiler(NAME_MAP)
+    first = compiler.compile('[AND [YES CO2] [NO OCC]]')
+    second = compiler.compile('[OR [YES CO2] [NO WIN]]')
+    assert first.operands[0] is second.operands[0]
+    assert compiler.compile('[AND [YES CO2] [NO OCC]]') is first
+
+def test_simple_conditions():
+    assert not deletes('[YES CO2]')
+    assert deletes('[NO CO2]')
+    assert deletes('[YES OCC]')
+    assert deletes('[EQUALS BSP RELIEF]')
+    assert not deletes('[NOT_EQUALS BSP RELIEF]')
+    assert not deletes('[ANY BSP RELIEF RETURN]')
+    assert deletes('[DELETE]')
+    # missing from the store
+    assert deletes('[YES CO2]', {})
+    assert not deletes('[NOT_EQUALS BSP RELIEF]', {})
+
+def test_any_with_several_selected_values():
+    ''' ANY keeps the section if any selected value is compared to. Before
+        annotations were compiled, the compared values were a map iterator
+        that the first selected value consumed, so later values never matched.
+    '''
+    selections = {**SELECTIONS, 'buiPreCon': ['Other', 'ReturnFan']}
+    # wrongly deleted before
+    assert not deletes('[ANY BSP RELIEF RETURN]', selections)
+    assert not deletes('[ANY BSP RETURN RELIEF]', {**SELECTIONS, 'buiPreCon': ['ReliefFan', 'ReturnFan']})
+    assert deletes('[ANY BSP RELIEF]', {**SELECTIONS, 'buiPreCon': ['Other', 'ReturnFan']})
+
+def test_nested_conditions():
+    assert not deletes('[OR [YES OCC] [YES CO2]]')
+    assert deletes('[AND [YES OCC] [YES CO2]]')
+    # nesting on either side
+    assert not deletes('[OR [OR [YES OCC] [YES WIN]] [YES CO2]]')
+    assert not deletes('[OR [YES OCC] [OR [YES WIN] [YES CO2]]]')
+    assert deletes('[AND [YES CO2] [AND [NO OCC] [YES WIN]]]')
+    assert isinstance(AnnotationCompiler(NAME_MAP).compile('[AND [YES CO2] [OR [NO OCC] [YES WIN]]]').operands[1], Or)
+
+def test_invalid_conditions_delete():
+    assert deletes('[YES CO2 OCC]')
+    assert deletes('[AND [YES CO2]]')
+    assert deletes('[AND [MAYBE CO2] [YES CO2]]')
+
+def test_compile_errors_are_recorded():
+    compiler = AnnotationCompiler(NAME_MAP)
+    for text in ['[YES CO2 OCC]', '[AND [YES CO2]]', '[YES CO2]', '[EQUALS BSP UNKNOWN]', '[YES MISSING]', '[YES MISSING]']:
+        compiler.compile(text)
+    assert compiler.invalid_tags == {'[YES CO2 OCC]', '[AND [YES CO2]]'}
+    assert compiler.missing_names == {'UNKNOWN', 'MISSING'}
+
+def test_table_and_units_wrappers():
+    compiler = AnnotationCompiler(NAME_MAP)
+    assert compiler.compile('[ROW YES CO2]') == TableToggle('ROW', Yes('have_CO2Sen'))
+    assert compiler.compile('[ROW [YES CO2]]') == TableToggle('ROW', Yes('have_CO2Sen'))
+    assert isinstance(compiler.compile('[COLUMN AND [YES CO2] [NO OCC]]').condition, And)
+    assert compiler.compile('[UNITS [F = [2 * A] ^ 2] [F = [4 * A] ^ 2]].') == Units('F = [2 * A] ^ 2', 'F = [4 * A] ^ 2')
+    assert compiler.compile('[UNITS [] []]') == Constant(False)
+
+def test_referenced_names():
+    compiler = AnnotationCompiler(NAME_MAP)
+
+    assert set(get_references(compiler.compile('[AND [YES CO2] [OR [NO OCC] [EQUALS BSP RELIEF]]]'))) == {'have_CO2Sen', 'have_occSen', 'buiPreCon'}
+    assert set(get_references(compiler.compile('[ROW YES WIN]'))) == {'have_winSen'}
+    assert set(get_references(compiler.compile('[DELETE]'))) == set()
+    assert set(get_references(compiler.compile('[UNITS [m] [ft]]'))) == set()
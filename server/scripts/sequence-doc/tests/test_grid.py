@@ -0,0 +1,50 @@
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from grid import GRID_COL_TAG, TC_TAG, TableGrid
+from mogrifier import mogrify_doc
+
+def make_table(rows: int, cols: int):
+    document = Document()
+    document.styles.add_style('Toggle', WD_STYLE_TYPE.CHARACTER)
+    table = document.add_table(rows, cols)
+    for row_index, row in enumerate(table.rows):
+        for col_index, cell in enumerate(row.cells):
+            cell.text = f'{row_index}.{col_index}'
+    return document, table
+
+def get_texts(table):
+    return [[tc.xpath('string(.)') for tc in tr.iterchildren(TC_TAG)] for tr in table._tbl.tr_lst]
+
+def test_positions_honor_grid_span():
+    _, table = make_table(3, 3)
+    table.cell(0, 0).merge(table.cell(0, 1))
+    grid = TableGrid(table._tbl)
+
+    first, last = table._tbl.tr_lst[0].tc_lst
+    assert grid.get_columns(first) == range(0, 2)
+    assert grid.get_columns(last) == range(2, 3)
+    assert grid.positions[table._tbl.tr_lst[1].tc_lst[1]] == (1, 1, 1)
+
+def test_remove_columns_narrows_spanning_cells():
+    _, table = make_table(2, 3)
+    table.cell(0, 0).merge(table.cell(0, 1))
+    grid = TableGrid(table._tbl)
+
+    to_delete = grid.remove_columns(range(1, 2))
+    assert [el.tag for el in to_delete] == [TC_TAG, GRID_COL_TAG]
+    assert table._tbl.tr_lst[0].tc_lst[0].grid_span == 1
+
+    # removing the same column again does nothing
+    assert grid.remove_columns(range(1, 2)) == []
+    assert len(grid.remove_columns(range(0, 1))) == 3
+
+def test_column_toggle():
+    document, table = make_table(3, 3)
+    # the same text in another column doesn't matter
+    for cell in (table.cell(0, 1), table.cell(0, 0)):
+        cell.paragraphs[0].add_run(' [COLUMN YES co2]', 'Toggle')
+
+    mogrify_doc(document, {'co2': 'have_CO2Sen'}, {'have_CO2Sen': [False], 'DEL_INFO_BOX': [False], 'DEL_INSTR_BOX': [False]})
+
+    assert get_texts(table) == [['0.2'], ['1.2'], ['2.2']]
+    assert len(table._tbl.tblGrid.gridCol_lst) == 1
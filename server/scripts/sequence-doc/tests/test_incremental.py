@@ -0,0 +1,44 @@
+'''
+Incremental preview tests
+'''
+from generate_doc import DEFAULT_DOC_VERSION, extract_input
+from incremental import RenderSession
+from template import get_template
+
+def get_variants(template, selections):
+    ''' Selections with one referenced selection changed at a time '''
+    for name in sorted(template.referenced_names):
+        values = sorted(template.references[name]) or [True, False]
+        for value in values:
+            yield {**selections, name: [value]}
+
+def test_updates_match_fresh_sessions():
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    template = get_template(DEFAULT_DOC_VERSION)
+
+    session = RenderSession(template)
+    first = session.update(selections)
+    assert len(first['changed']) > 0
+    assert session.hidden()
+
+    for variant in get_variants(template, selections):
+        hidden = set(session.hidden())
+        patch = session.update(variant)
+
+        fresh = RenderSession(template)
+        fresh.update(variant)
+        assert session.mask == fresh.mask
+        assert session.outcomes == fresh.outcomes
+        assert set(session.hidden()) == (hidden - set(patch['shown'])) | set(patch['hidden'])
+
+    # unchanged selections evaluate nothing
+    assert session.update(dict(session.selections)) == {'changed': [], 'hidden': [], 'shown': []}
+
+def test_render_uses_session_selections():
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    session = RenderSession(get_template(DEFAULT_DOC_VERSION))
+    session.update(selections)
+    assert session.render().paragraphs
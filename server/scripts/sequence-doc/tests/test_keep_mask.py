@@ -0,0 +1,94 @@
+'''
+Keep-mask rendering and render program tests
+'''
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
+from generate_doc import DEFAULT_DOC_VERSION, extract_input, generate_doc_bytes
+from keep_mask import get_keep_mask, render_document_xml
+from render_program import get_render_program, render_document_xml as run_program
+from template import MAPPING_FILE_PATH, MAPPINGS_MODELICA_INSTANCE, MAPPINGS_MODELICA_VALUES, MAPPINGS_SHORT_ID, SOURCE_DOC_PATH, Template, get_template
+
+def get_selection_sets():
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    return [
+        selections,
+        {**selections, 'Buildings.Templates.Data.AllSystems.sysUni': ['Buildings.Templates.Types.Units.IP']},
+        {**selections, 'DEL_INFO_BOX': [False]},
+        {name: value for name, value in selections.items() if name != 'Buildings.Templates.Data.AllSystems.sysUni'},
+    ]
+
+def test_matches_mogrified_document():
+    template = get_template(DEFAULT_DOC_VERSION)
+    source = template.document.part.blob
+
+    for selections in get_selection_sets():
+        expected = template.render(selections).part.blob
+        assert render_document_xml(template, selections) == expected
+        assert run_program(template, selections) == expected
+
+    # the template is only read
+    assert template.document.part.blob == source
+
+def test_generated_docx_is_identical():
+    selections = get_selection_sets()[0]
+    expected = generate_doc_bytes(selections, DEFAULT_DOC_VERSION)
+    assert generate_doc_bytes(selections, DEFAULT_DOC_VERSION, renderer='mask') == expected
+    assert generate_doc_bytes(selections, DEFAULT_DOC_VERSION, renderer='program') == expected
+
+def test_program_segments():
+    template = get_template(DEFAULT_DOC_VERSION)
+    program = get_render_program(template)
+
+    # segments cover the document part in order
+    assert program.starts[0] == 0
+    assert program.stops[-1] == len(program.data)
+    assert all(stop <= start for stop, start in zip(program.stops, program.starts[1:]))
+    # most of the document is static
+    assert len(program) < len(template.toggle_runs) + len(template.annotations)
+
+def test_concurrent_renders():
+    template = get_template(DEFAULT_DOC_VERSION)
+    selection_sets = get_selection_sets()
+    expected = [render_document_xml(template, selections) for selections in selection_sets]
+
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(lambda s: render_document_xml(template, s), selection_sets * 2)) == expected * 2
+
+def write_table_version(path):
+    ''' A version directory with a table whose first row has a cell spanning
+        two columns, the second of which has a COLUMN toggle
+    '''
+    with open(path / MAPPING_FILE_PATH, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, [MAPPINGS_SHORT_ID, MAPPINGS_MODELICA_INSTANCE, MAPPINGS_MODELICA_VALUES])
+        writer.writeheader()
+        writer.writerow({MAPPINGS_SHORT_ID: 'co2', MAPPINGS_MODELICA_INSTANCE: 'have_CO2Sen'})
+
+    document = Document()
+    document.styles.add_style('Toggle', WD_STYLE_TYPE.CHARACTER)
+    table = document.add_table(3, 3)
+    for row_index, row in enumerate(table.rows):
+        for col_index, cell in enumerate(row.cells):
+            cell.text = f'{row_index}.{col_index}'
+    table.cell(1, 1).paragraphs[0].add_run('[COLUMN YES co2]', 'Toggle')
+    table.cell(0, 0).merge(table.cell(0, 1))
+    document.save(path / SOURCE_DOC_PATH)
+
+def test_column_toggle_narrows_spanning_cells(tmp_path):
+    write_table_version(tmp_path)
+    template = Template(tmp_path)
+    selections = {'have_CO2Sen': [False], 'DEL_INFO_BOX': [False]}
+
+    mask = get_keep_mask(template, selections)
+    assert len(mask.replaced) == 1
+    expected = template.render(selections).part.blob
+    assert render_document_xml(template, selections) == expected
+    assert run_program(template, selections) == expected
+
+    selections = {'have_CO2Sen': [True], 'DEL_INFO_BOX': [False]}
+    assert not get_keep_mask(template, selections).replaced
+    expected = template.render(selections).part.blob
+    assert render_document_xml(template, selections) == expected
+    assert run_program(template, selections) == expected
@@ -0,0 +1,47 @@
+from lxml import etree
+from outline import P_TAG, TABLE_TAG, TCPR_TAG, BOOKMARK_TAGS, SECTION_TAG, build_outline
+
+def make_elements(*items):
+    ''' items are heading levels (None for an info box) or tags '''
+    elements = []
+    for item in items:
+        if isinstance(item, str):
+            elements.append(etree.Element(item))
+        else:
+            p = etree.Element(P_TAG)
+            if item is not None:
+                p.set('level', str(item))
+            elements.append(p)
+    return elements
+
+def get_level(p):
+    level = p.get('level')
+    return int(level) if level else None
+
+def test_section_extents():
+    elements = make_elements(1, 2, 100, TABLE_TAG, 2, 100, 1, SECTION_TAG[0])
+    outline = build_outline(elements, get_level)
+
+    assert outline.ends == [6, 4, 4, 8, 6, 6, 7, 8]
+    assert list(outline.section(0)) == [0, 1, 2, 3, 4, 5]
+    # body text deletes itself and the tables up to the next paragraph
+    assert list(outline.section(2)) == [2, 3]
+    # sections end at the section properties
+    assert list(outline.section(6)) == [6]
+
+def test_info_boxes_and_unknown_tags():
+    elements = make_elements(2, None, 100, BOOKMARK_TAGS[0], '{test}unknown', 2)
+    outline = build_outline(elements, get_level)
+
+    assert list(outline.section(1)) == [1]
+    assert outline.ends[0] == 5
+    assert list(outline.section(0)) == [0, 1, 2, 3]
+
+def test_table_cell_sections(caplog):
+    # the children of a table cell start with its properties
+    elements = make_elements(TCPR_TAG, 1, 100, TABLE_TAG, 1)
+    outline = build_outline(elements, get_level)
+
+    assert list(outline.section(1)) == [1, 2, 3]
+    assert not outline.deletable[0]
+    assert not caplog.records
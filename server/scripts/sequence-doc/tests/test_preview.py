@@ -0,0 +1,46 @@
+'''
+Preview output tests
+'''
+import io
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from generate_doc import DEFAULT_DOC_VERSION, extract_input, generate_doc, generate_preview
+from preview import write_html
+
+def get_document_blocks(document):
+    ''' The text of the body paragraphs and tables of a generated document '''
+    blocks = []
+    for element in document.element.body.iterchildren():
+        if element.tag.endswith('}p'):
+            text = Paragraph(element, document._body).text.strip()
+            if text:
+                blocks.append(text)
+        elif element.tag.endswith('}tbl'):
+            rows = []
+            for row in Table(element, document._body).rows:
+                cells = []
+                for tc in row._tr.tc_lst:
+                    texts = (Paragraph(p, document._body).text.strip() for p in tc.iterchildren('{*}p'))
+                    cells.append('\n'.join(text for text in texts if text))
+                rows.append(cells)
+            blocks.append(rows)
+    return blocks
+
+def test_outline_matches_document():
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    outline = generate_preview(selections, DEFAULT_DOC_VERSION)
+    document = generate_doc(selections, DEFAULT_DOC_VERSION)
+
+    assert {block['type'] for block in outline} == {'heading', 'paragraph', 'table'}
+    assert [block['rows'] if block['type'] == 'table' else block['text'] for block in outline] == get_document_blocks(document)
+
+def test_html():
+    output = io.StringIO()
+    write_html([
+        {'type': 'heading', 'level': 8, 'style': 'Heading 8', 'text': 'A & B'},
+        {'type': 'table', 'rows': [['1\n2']]},
+    ], output)
+
+    assert output.getvalue() == '<h6>A &amp; B</h6>\n<table>\n<tr><td>1<br>2</td></tr>\n</table>\n'
@@ -1,9 +1,31 @@
 '''
 Basic sequence doc tests
 '''
-from generate_doc import parse_args, extract_input, DEFAULT_DOC_VERSION, generate_doc, generate_name_map
+import gc
+import io
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import output_cache
+from generate_doc import parse_args, extract_input, DEFAULT_DOC_VERSION, generate_doc, generate_doc_bytes, generate_name_map, generate_preview, get_selection_manifest
+from output_cache import OutputCache, get_cache_key
+from serve import serve_stream
+from batch import MANIFEST_FILE_NAME, read_jobs, run_batch
+from workers import WorkerPool, prepare_templates
+from template import SOURCE_DOC_PATH, VERSION_DIR, Template, TemplateCache, get_local_path_prefix, get_template, get_template_stats, get_versions
+from mogrifier import MogrifyContext, get_unit_selection, get_unit_system, mogrify_doc
+from diagnostics import Diagnostics
+from expression import Units
+from stats import GenerationStats
 from docx import Document
-# from lmxl import etree
+from lxml import etree
 
 ## Test Command Line Args
 def test_command_line_args():
@@ -19,6 +41,12 @@ def test_command_line_args():
 
     default_args = parse_args([])
     assert default_args.version == DEFAULT_DOC_VERSION
+    assert default_args.output == 'Current Guideline 36.docx'
+
+    # the default output matches the format instead of naming an outline .docx
+    assert parse_args(['--format', 'outline']).output == 'Current Guideline 36.jsonl'
+    assert parse_args(['--format', 'html']).output == 'Current Guideline 36.html'
+    assert parse_args(['--format', 'html', '--output', test_path]).output == test_path
 
 def test_input_extraction():
     ''' Uses a file as an example IO stream
@@ -54,4 +82,439 @@ def test_name_map_generation():
     test_mappings = {'SHORTNAME': 'LONGNAME', 'SHORTNAME1': 'VALUENAME'}
 
     mappings = generate_name_map("tests/static/example_mappings.csv")
-    assert mappings == test_mappings
\ No newline at end of file
+    assert mappings == test_mappings
+
+def test_serve_stream(tmp_path):
+    ''' Runs a valid and an invalid job through the long-running mode
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    output_path = tmp_path / 'served.docx'
+    jobs = [
+        'not json',
+        json.dumps({'id': 'job-1', 'version': DEFAULT_DOC_VERSION, 'output': str(output_path), 'selections': selections}),
+        json.dumps({'id': 'job-2', 'format': 'outline', 'stats': True, 'selections': selections}),
+    ]
+    output_stream = io.StringIO()
+    serve_stream(io.StringIO('\n'.join(jobs)), output_stream)
+
+    invalid, valid, outline = [json.loads(line) for line in output_stream.getvalue().splitlines()]
+    assert invalid['status'] == 'error'
+    assert valid['id'] == 'job-1'
+    assert valid['status'] == 'ok'
+    assert 'stats' not in valid
+    assert Document(output_path)
+    assert 'preview' in outline['stats']['phases']
+
+
+def test_serve_rejects_unknown_versions(tmp_path):
+    ''' A job's version can't lead outside the version directory, even to a
+        directory holding a valid version
+    '''
+    shutil.copytree(get_local_path_prefix(DEFAULT_DOC_VERSION), tmp_path / 'elsewhere')
+    traversal = os.path.relpath(tmp_path / 'elsewhere', VERSION_DIR)
+    jobs = [
+        json.dumps({'id': version, 'version': version, 'selections': {}})
+        for version in [traversal, str(tmp_path / 'elsewhere'), '..', 'missing']
+    ]
+    output_stream = io.StringIO()
+    serve_stream(io.StringIO('\n'.join(jobs)), output_stream)
+
+    responses = [json.loads(line) for line in output_stream.getvalue().splitlines()]
+    assert len(responses) == 4
+    for response in responses:
+        assert response['status'] == 'error'
+        assert 'Unknown version' in response['error']
+    assert not any(stats['version'] == 'elsewhere' for stats in get_template_stats()['versions'])
+
+def test_template_copies_are_independent():
+    ''' Each instantiated document can be modified without touching the cached template
+    '''
+    template = get_template(DEFAULT_DOC_VERSION)
+    assert get_template(DEFAULT_DOC_VERSION) is template
+
+    first, _ = template.instantiate()
+    second, scan = template.instantiate()
+    assert len(scan['control_structure']) == len(template.annotations)
+
+    body_length = len(template.document.element.body)
+    first.element.body.remove(first.element.body[0])
+    assert len(second.element.body) == body_length
+    assert len(template.document.element.body) == body_length
+
+
+def test_template_cache_eviction(mocker):
+    ''' The least recently used template is dropped once the cache is full
+    '''
+    mocker.patch('template.get_file_stamp', return_value=())
+    mocker.patch('template.Template', side_effect=lambda path: mocker.Mock(path=path, stamp=(), memory=0))
+
+    cache = TemplateCache(max_size=2)
+    first = cache.get('first')
+    second = cache.get('second')
+    assert cache.get('first') is first
+    cache.get('third')
+
+    assert len(cache) == 2
+    assert cache.get('first') is first
+    assert cache.get('second') is not second
+
+def test_template_cache_memory_budget(mocker):
+    ''' The least recently used templates are dropped once over the memory budget
+    '''
+    mocker.patch('template.get_file_stamp', return_value=())
+    mocker.patch('template.Template', side_effect=lambda path: mocker.Mock(path=path, stamp=(), memory=40))
+
+    cache = TemplateCache(memory_budget=100)
+    first = cache.preload(['first', 'second'])[0]
+    assert cache.get('first') is first
+    cache.get('third')
+    assert len(cache) == 2
+    assert cache.memory() == 80
+
+    stats = {entry['version']: entry for entry in cache.stats()}
+    assert stats['first'] == {'version': 'first', 'loaded': True, 'memory': 40, 'hits': 1, 'loads': 1, 'load_seconds': mocker.ANY}
+    assert not stats['second']['loaded']
+
+    # a template larger than the budget is still served
+    cache.configure(memory_budget=10)
+    assert len(cache) == 1
+    assert cache.get('first') is not first
+    assert len(cache) == 1
+
+def test_version_discovery():
+    versions = get_versions()
+    assert DEFAULT_DOC_VERSION in versions
+    # versions whose source document name starts with a date
+    dated = [version for version in versions if not (get_local_path_prefix(version) / SOURCE_DOC_PATH).exists()]
+    assert dated
+    template = get_template(dated[0])
+    assert template.source_path.name.endswith('(sequence selection source).docx')
+    assert generate_doc_bytes({'DEL_INFO_BOX': [True]}, dated[0])
+
+
+def test_batch_generation(tmp_path):
+    ''' Renders two selection sets read from a directory with a pool of two workers
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    source = tmp_path / 'selections'
+    source.mkdir()
+    (source / 'ahu-1.json').write_text(json.dumps(selections))
+    (source / 'ahu-2.json').write_text(json.dumps({'selections': selections, 'version': 'missing-version'}))
+
+    jobs = list(read_jobs(str(source), DEFAULT_DOC_VERSION, {'renderer': 'program', 'compression': 'store'}))
+    assert [job['id'] for job in jobs] == ['ahu-1', 'ahu-2']
+    assert [job['renderer'] for job in jobs] == ['program', 'program']
+
+    # items keep their own options
+    (source / 'ahu-3.json').write_text(json.dumps({'selections': selections, 'renderer': 'mask'}))
+    assert list(read_jobs(str(source), DEFAULT_DOC_VERSION, {'renderer': 'program'}))[-1]['renderer'] == 'mask'
+    (source / 'ahu-3.json').unlink()
+
+    # the command line options are passed to the items, outlines aren't written
+    with pytest.raises(SystemExit):
+        parse_args(['--batch', str(source), '--format', 'outline'])
+
+    output_dir = tmp_path / 'output'
+    manifest = run_batch(jobs, str(output_dir), processes=2)
+
+    assert [entry['status'] for entry in manifest] == ['ok', 'error']
+    assert Document(output_dir / 'ahu-1.docx')
+    with zipfile.ZipFile(output_dir / 'ahu-1.docx') as package:
+        assert package.getinfo('word/document.xml').compress_type == zipfile.ZIP_STORED
+    with open(output_dir / MANIFEST_FILE_NAME) as f:
+        assert [json.loads(line)['id'] for line in f] == ['ahu-1', 'ahu-2']
+
+
+def test_batch_isolates_bad_items(tmp_path, mocker):
+    ''' Unreadable lines fail on their own, ids can't write outside of the
+        output directory or over each other
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    def job(job_id, **fields):
+        return json.dumps({'id': job_id, 'renderer': 'program', 'selections': selections, **fields})
+
+    source = tmp_path / 'selections.jsonl'
+    source.write_text('\n'.join([
+        job('../escape'),
+        job('dup'),
+        job('dup'),
+        'not json',
+        '["a", "list"]',
+        job('outside', output=str(tmp_path / 'outside.docx')),
+        job('inside', output='nested.docx'),
+        job('unhashable', version=['a', 'list']),
+        job('broken', version='broken'),
+    ]))
+
+    def load(version):
+        # a version whose mappings can't be read
+        if version == 'broken':
+            raise KeyError('Short ID')
+        return get_template(version)
+    mocker.patch('batch.get_template', side_effect=load)
+
+    output_dir = tmp_path / 'output'
+    jobs = list(read_jobs(str(source), DEFAULT_DOC_VERSION))
+    manifest = run_batch(jobs, str(output_dir), processes=1)
+
+    assert [(entry['id'], entry['status']) for entry in manifest] == [
+        ('../escape', 'ok'), ('dup', 'ok'), ('dup', 'ok'), ('4', 'error'), ('5', 'error'), ('outside', 'error'), ('inside', 'ok'),
+        ('unhashable', 'error'), ('broken', 'error'),
+    ]
+    assert 'KeyError' in manifest[-1]['error']
+    assert (output_dir / MANIFEST_FILE_NAME).exists()
+    assert sorted(path.name for path in output_dir.glob('*.docx')) == ['_escape.docx', 'dup-2.docx', 'dup.docx', 'nested.docx']
+    assert not (tmp_path / 'escape.docx').exists()
+    assert not (tmp_path / 'outside.docx').exists()
+
+
+def test_worker_pool(tmp_path):
+    ''' Sheds a job submitted to a full queue, then serves jobs with forked
+        workers replaced after each job and after being killed
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    prepare_templates([DEFAULT_DOC_VERSION])
+
+    pool = WorkerPool(2, queue_depth=1, max_jobs=1)
+    shed = []
+    # no worker takes jobs before the pool starts
+    assert pool.submit({'id': 'first', 'renderer': 'program', 'selections': selections}, lambda response: None)
+    assert not pool.submit({'id': 'shed', 'selections': selections}, shed.append)
+    assert shed[0]['status'] == 'overloaded'
+
+    pool.start()
+    try:
+        # the supervisor only freezes its objects while forking
+        assert gc.get_freeze_count() == 0
+        jobs = [
+            json.dumps({
+                'id': f'job-{number}',
+                'renderer': 'program',
+                'output': str(tmp_path / f'{number}.docx'),
+                'selections': selections,
+            })
+            for number in range(3)
+        ]
+        output_stream = io.StringIO()
+        # one at a time, as the queue holds a single job
+        for job in jobs:
+            serve_stream(io.StringIO(job), output_stream, pool)
+
+        responses = [json.loads(line) for line in output_stream.getvalue().splitlines()]
+        assert [response['id'] for response in responses] == ['job-0', 'job-1', 'job-2']
+        assert all(response['status'] == 'ok' for response in responses)
+        assert Document(tmp_path / '0.docx')
+
+        stats = pool.stats()
+        assert stats['completed'] == 4
+        assert stats['shed'] == 1
+        assert sum(worker['total_jobs'] for worker in stats['worker_stats']) == 4
+
+        # a killed worker is replaced
+        pid = stats['worker_stats'][0]['pid']
+        os.kill(pid, signal.SIGKILL)
+        deadline = time.monotonic() + 30
+        while pool.stats()['worker_stats'][0]['pid'] == pid and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert pool.stats()['worker_stats'][0]['pid'] != pid
+        assert gc.get_freeze_count() == 0
+
+        output_stream = io.StringIO()
+        serve_stream(io.StringIO(jobs[0]), output_stream, pool)
+        assert json.loads(output_stream.getvalue())['status'] == 'ok'
+
+        output_stream = io.StringIO()
+        serve_stream(io.StringIO(json.dumps({'id': 'workers', 'command': 'workers'})), output_stream)
+        assert json.loads(output_stream.getvalue())['status'] == 'error'
+    finally:
+        pool.stop()
+
+
+def test_unit_selection():
+    ''' The unit system selection is worked out once per template, requests
+        only look the selected value up
+    '''
+    diagnostics = Diagnostics()
+    unit_selection = get_unit_selection({'UNITS': 'units', 'SI': 'si', 'IP': 'ip'}, diagnostics)
+    assert unit_selection == ('units', {'si': 'SI', 'ip': 'IP'})
+    assert get_unit_system(unit_selection, {'units': ['ip']}, diagnostics) == 'IP'
+    assert not diagnostics
+    assert get_unit_system(unit_selection, {'units': ['other']}, diagnostics) is None
+    assert get_unit_system(unit_selection, {}, diagnostics) is None
+    assert get_unit_system(unit_selection, {}, diagnostics) is None
+
+    assert get_unit_selection({'UNITS': 'units', 'SI': 'si'}, diagnostics) is None
+    # reported through the diagnostics, each distinct message logged once
+    assert diagnostics.counts() == {
+        '"%s" is not a valid unit system': 1,
+        'Path "%s" not found in store': 2,
+        '%s not found': 1,
+    }
+
+    template = get_template(DEFAULT_DOC_VERSION)
+    assert template.unit_annotations
+    assert all(isinstance(template.annotations[index]['expression'], Units) for index in template.unit_annotations)
+    assert template.unit_selection[0] == template.name_map['UNITS']
+
+    # previews count the message in their stats too
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    del selections[template.unit_selection[0]]
+    stats = GenerationStats()
+    generate_preview(selections, DEFAULT_DOC_VERSION, stats)
+    assert stats.as_dict()['diagnostics']['Path "%s" not found in store'] == 1
+
+
+def test_template_matches_fresh_document():
+    ''' Mogrifying a template copy gives the same result as scanning a freshly loaded document
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    template = get_template(DEFAULT_DOC_VERSION)
+    fresh = mogrify_doc(Document(template.path / SOURCE_DOC_PATH), template.name_map, selections)
+    cached = generate_doc(selections, DEFAULT_DOC_VERSION)
+
+    assert etree.tostring(cached.element) == etree.tostring(fresh.element)
+
+    # toggles are gone but unit text was kept
+    body = cached.element.body
+    assert not body.xpath('.//w:r/w:rPr/w:rStyle[@w:val="Toggle"]')
+    text = ''.join(body.itertext())
+    assert '[UNITS' not in text
+    assert '°C' in text
+
+def test_concurrent_generation():
+    ''' Documents generated from several threads match the ones generated one at a time
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    ip_selections = {**selections, 'Buildings.Templates.Data.AllSystems.sysUni': ['Buildings.Templates.Types.Units.IP']}
+    selection_sets = [selections, ip_selections] * 2
+
+    expected = [etree.tostring(generate_doc(s, DEFAULT_DOC_VERSION).element) for s in selection_sets[:2]]
+    with ThreadPoolExecutor(4) as executor:
+        documents = list(executor.map(lambda s: generate_doc(s, DEFAULT_DOC_VERSION), selection_sets))
+
+    assert [etree.tostring(document.element) for document in documents] == expected * 2
+    assert expected[0] != expected[1]
+
+def test_output_to_stdout():
+    ''' With "--output -" the document is written to stdout and no file is created
+    '''
+    with open("tests/static/selections", "rb") as f:
+        result = subprocess.run(
+            [sys.executable, 'src/generate_doc.py', '--output', '-'],
+            stdin=f, capture_output=True, check=True,
+        )
+
+    assert result.stdout.startswith(b'PK')
+    assert Document(io.BytesIO(result.stdout)).paragraphs
+
+def test_output_cache(tmp_path, mocker):
+    ''' Selections the document doesn't depend on don't change the cache key
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    template = get_template(DEFAULT_DOC_VERSION)
+
+    key = get_cache_key(DEFAULT_DOC_VERSION, template, selections)
+    assert key == get_cache_key(DEFAULT_DOC_VERSION, template, {**selections, 'not.a.referenced.name': [1]})
+    name = next(name for name in template.referenced_names if name in selections)
+    assert key != get_cache_key(DEFAULT_DOC_VERSION, template, {**selections, name: ['changed']})
+
+    output_cache.configure(str(tmp_path))
+    try:
+        generate = mocker.spy(Template, 'render')
+        first = generate_doc_bytes(selections, DEFAULT_DOC_VERSION)
+        second = generate_doc_bytes({**selections, 'not.a.referenced.name': [1]}, DEFAULT_DOC_VERSION)
+        assert first == second
+        assert generate.call_count == 1
+    finally:
+        output_cache.configure(None)
+
+def test_output_cache_eviction(tmp_path):
+    cache = OutputCache(str(tmp_path), max_size=10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    os.utime(tmp_path / 'b.docx', ns=(1, 1))
+    cache.put('c', b'12345')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == b'12345'
+    assert len(cache) == 2
+
+def test_selection_manifest():
+    ''' Projecting selections to the manifest doesn't change the document
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+
+    manifest = get_selection_manifest(DEFAULT_DOC_VERSION)
+    assert manifest['version'] == DEFAULT_DOC_VERSION
+    assert 'DEL_INFO_BOX' in manifest['selections']
+
+    projected = {name: value for name, value in selections.items() if name in manifest['selections']}
+    assert len(projected) < len(selections)
+    assert (
+        etree.tostring(generate_doc(projected, DEFAULT_DOC_VERSION).element)
+        == etree.tostring(generate_doc(selections, DEFAULT_DOC_VERSION).element)
+    )
+
+def test_passthrough_packaging():
+    ''' Only the document xml is rewritten, other members keep their source bytes
+    '''
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    template = get_template(DEFAULT_DOC_VERSION)
+    document = generate_doc(selections, DEFAULT_DOC_VERSION)
+
+    source = zipfile.ZipFile(template.path / SOURCE_DOC_PATH)
+    for method in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+        output = zipfile.ZipFile(io.BytesIO(template.serialize(document, method)))
+        assert output.testzip() is None
+        assert output.namelist() == source.namelist()
+        for info in output.infolist():
+            if info.filename == 'word/document.xml':
+                assert info.compress_type == method
+                assert output.read(info) == document.part.blob
+            else:
+                assert output.read(info) == source.read(info.filename)
+
+    assert Document(io.BytesIO(template.serialize(document))).paragraphs
+
+def test_generation_stats():
+    with open("tests/static/selections") as f:
+        selections = extract_input(f)
+    template = get_template(DEFAULT_DOC_VERSION)
+
+    stats = GenerationStats()
+    assert generate_doc_bytes(selections, DEFAULT_DOC_VERSION, stats=stats)
+    record = json.loads(stats.to_json())
+
+    assert list(record['phases']) == [
+        'load_template', 'instantiate', 'remove_info_and_instr_boxes', 'apply_selections',
+        'convert_units', 'remove_toggles', 'apply_deletions', 'save',
+    ]
+    # toggle text that isn't an operation isn't counted
+    assert sum(record['annotations'].values()) == sum(
+        located['expression'] is not None for located in template.annotations
+    )
+    assert record['counts']['invalid_tags'] == len(template.compiler.invalid_tags)
+    assert 0 < record['counts']['elements_deleted'] <= record['counts']['elements_scheduled']
+    # the test selections leave out some of the selections the template reads
+    assert record['diagnostics']['Path "%s" not found in store, deleting'] > 0
+
+    # without a template the document is scanned by mogrify_doc
+    stats = GenerationStats()
+    document = Document(template.path / SOURCE_DOC_PATH)
+    mogrify_doc(document, template.name_map, selections, MogrifyContext(stats=stats))
+    assert 'create_control_structures' in stats.phases
+    assert stats.counts['missing_names'] == len(template.compiler.missing_names)
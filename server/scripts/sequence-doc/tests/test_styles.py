@@ -0,0 +1,22 @@
+from generate_doc import DEFAULT_DOC_VERSION
+from styles import StyleTable, get_level_from_name
+from template import get_template
+
+def test_style_table_matches_python_docx():
+    document = get_template(DEFAULT_DOC_VERSION).document
+    styles = StyleTable(document)
+
+    for paragraph in document.paragraphs[:500]:
+        style = styles.paragraph(paragraph._p.style)
+        assert style.name == paragraph.style.name
+        # python-docx resolves the style the level is read from
+        assert style.heading_level == get_level_from_name(paragraph.style.name)
+        for run in paragraph.runs:
+            assert styles.character(run._r.style).name == run.style.name
+
+    # unknown ids and ids of another style type resolve to the default style
+    assert styles.paragraph('NotAStyle').name == 'Normal'
+    assert styles.paragraph(None).name == 'Normal'
+    toggle = next(style for style in document.styles if style.name == 'Toggle')
+    assert styles.character(toggle.style_id).is_toggle
+    assert styles.paragraph(toggle.style_id).name == 'Normal'
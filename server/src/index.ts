@@ -93,14 +93,12 @@ app.post("/api/sequence", async (req, res) => {
   }
 
   try {
-    const { file, filePath } = await writeControlSequenceDocument(sequenceData);
+    const { file } = await writeControlSequenceDocument(sequenceData);
     res.send(file);
-    res.on('finish', () => {
-      fs.unlinkSync(filePath);
-    });
   } catch (error) {
     console.error(error);
-    res.send(error);
+    // an Error would be sent as {}
+    res.send(error instanceof Error ? error.message : error);
   }
 });
 
@@ -1,15 +1,10 @@
-import fs from "fs/promises";
-import path from "path";
 import util from "util";
 import process from "process";
-import { exec, spawn, ChildProcess } from "child_process";
+import { exec, spawn } from "child_process";
 import _ from "underscore";
 // Enables the use of async/await keywords when executing external processes.
 const execPromise = util.promisify(exec);
 
-const SEQUENCE_PATH = path.resolve('/tmp');
-const SEQUENCE_OUTPUT_PATH = `${SEQUENCE_PATH}`;
-
 export type Selections = {
   [key: string]: any;
 };
@@ -18,44 +13,81 @@ export type SequenceData = {
   [key: string]: any[];
 }
 
-export async function getDocument(convertedDocumentPath: string) {
-  const file = await fs.readFile(convertedDocumentPath);
-  return file;
-}
-
-export async function generateDoc(selections: SequenceData, path: string) {
+/**
+ * Generates the document with its bytes streamed back over stdout ('-o -'),
+ * so nothing gets written to disk. The generator's per-phase timings and
+ * counters ('--stats') are logged from stderr as one JSON line.
+ */
+export async function generateDocBuffer(selections: SequenceData) {
   const program = `python3`;
-  const scriptArgs = ['scripts/sequence-doc/src/generate_doc.py', '-o', `${path}`];
+  const scriptArgs = ['scripts/sequence-doc/src/generate_doc.py', '-o', '-', '--stats'];
 
-  return new Promise<ChildProcess>((resolve, reject) => {
+  return new Promise<Buffer>((resolve, reject) => {
     const scriptProcess = spawn(program, scriptArgs);
-    // pipe in selections
-    // TODO: selections may need to be sanitized
+    const chunks: Buffer[] = [];
+    const errors: Buffer[] = [];
     scriptProcess.stdin.write(JSON.stringify(selections));
     scriptProcess.stdin.end();
 
-    // stdout and stderr need to have callbacks to close the process
-    // TODO: figure out best place to log response
-    scriptProcess.stdout.on('data', (data) => console.log(`${data}`));
-    scriptProcess.stderr.on('data', (data) => console.log(`${data}`));
+    scriptProcess.stdout.on('data', (data: Buffer) => chunks.push(data));
+    scriptProcess.stderr.on('data', (data: Buffer) => {
+      errors.push(data);
+      console.log(`${data}`);
+    });
+    scriptProcess.on("error", reject);
     scriptProcess.on("close", (code) => {
       if (code === 0) {
-        resolve(scriptProcess);
+        resolve(Buffer.concat(chunks));
       } else {
-        reject(code);
+        const stderr = Buffer.concat(errors).toString().trim();
+        reject(new Error(`Sequence document generation exited with code ${code}: ${stderr}`));
       }
     });
   });
 }
 
+export type SelectionManifest = {
+  version: string;
+  digest: string;
+  selections: { [key: string]: string[] };
+};
+
+let selectionManifest: Promise<SelectionManifest> | undefined;
+
+/**
+ * Selection long names (and the values they are compared to) the generator's
+ * default version can consult. Loaded once per server process.
+ */
+export async function getSelectionManifest() {
+  if (!selectionManifest) {
+    selectionManifest = execPromise(
+      'python3 scripts/sequence-doc/src/generate_doc.py --manifest',
+      { maxBuffer: 16 * 1024 * 1024 },
+    ).then(({ stdout }) => JSON.parse(stdout) as SelectionManifest);
+    selectionManifest.catch(() => {
+      selectionManifest = undefined;
+    });
+  }
+  return selectionManifest;
+}
+
+/**
+ * Drops the selections the document can't depend on
+ */
+export function projectSelections(
+  selections: SequenceData,
+  manifest: SelectionManifest,
+): SequenceData {
+  return _.pick(selections, Object.keys(manifest.selections));
+}
+
 export async function writeControlSequenceDocument(selections: SequenceData) {
-  const timeMarker = new Date().toISOString();
-  const fileName = `sequence-${timeMarker}`;
-  const filePath = `${SEQUENCE_OUTPUT_PATH}/${fileName}.docx`;
-
-  const { stdout, stderr } = await generateDoc(selections, filePath);
-  const file = await getDocument(filePath);
-  // console.log(stdout);
-  // console.log(stderr);
-  return { file, filePath };
+  let projected = selections;
+  try {
+    projected = projectSelections(selections, await getSelectionManifest());
+  } catch (error) {
+    console.error(error);
+  }
+  const file = await generateDocBuffer(projected);
+  return { file };
 }